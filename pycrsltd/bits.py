@@ -29,16 +29,24 @@ __docformat__ = "restructuredtext en"
 
 DEBUG=True
 
-import sys, time, glob
+import sys, time, glob, hashlib, ctypes, threading
 import numpy
-import shaders
-from copy import copy
+from collections import OrderedDict, deque
+import shaders, encode
 try:
     from psychopy import logging
 except:
     import logging
 import serial
+try:
+    import asyncio
+except ImportError:
+    try:
+        import trollius as asyncio #the backport for python 2
+    except ImportError:
+        asyncio = None
 from OpenGL import GL
+from OpenGL.raw.GL.VERSION.GL_3_3 import glGetQueryObjectui64v as _glGetQueryObjectui64v
 try:
     from psychopy.ext import _bits
     haveBitsDLL=True
@@ -61,6 +69,476 @@ NOGAMMACORRECT     =  0x00004000  #/* Gamma correction mode */
 GAMMACORRECT       =  0x00008000  #/* Gamma correction mode */
 VIDEOENCODEDCOMMS  =  0x00080000 # needs to be set so that LUT is read from screen
 
+def _LUTrangeToIndices(LUTrange):
+    """(private) Convert a LUTrange (as for BitsBox.setLUT) into the start and
+    end indices of the LUT entries it covers (python-style, end is excluded)
+    """
+    LUTrange=numpy.asarray(LUTrange)
+    if LUTrange.size==1:
+        startII = int(round((0.5-LUTrange/2.0)*255.0))
+        endII = int(round((0.5+LUTrange/2.0)*255.0))+1 #+1 because python ranges exclude last value
+    elif LUTrange.size==2:
+        multiplier=1.0
+        if LUTrange[1]<=1: multiplier=255.0
+        startII= int(round(LUTrange[0]*multiplier))
+        endII = int(round(LUTrange[1]*multiplier))+1 #+1 because python ranges exclude last value
+    return startII, endII
+
+def _gammaRGB(gamma):
+    """(private) Returns a gamma value (single value, [R,G,B] or [Lum,R,G,B])
+    as a tuple of 3 floats (R,G,B)
+    """
+    gamma = numpy.asarray(gamma, 'd').ravel()
+    if gamma.size==1:
+        gamma = gamma.repeat(3)
+    return tuple(gamma[-3:])
+
+class LUTCache(object):
+    """A bounded cache of encoded LUTs for :class:`BitsBox`, keyed by the
+    settings used to create them. When full, the least recently used entry
+    is discarded.
+
+    Don't create this directly, use :meth:`BitsBox.enableLUTcache` and then
+    see BitsBox.LUTcache.hits and BitsBox.LUTcache.misses to check how well
+    it's working.
+    """
+    def __init__(self, maxSize=64):
+        self.maxSize = maxSize
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+    def __len__(self):
+        return len(self._entries)
+    def get(self, key):
+        """Returns the entry for this key (or None) and counts the hit/miss
+        """
+        entry = self._entries.pop(key, None)
+        if entry is None:
+            self.misses += 1
+        else:
+            self._entries[key] = entry #re-insert as the most recently used
+            self.hits += 1
+        return entry
+    def add(self, key, entry):
+        """Store an entry, discarding the least recently used if necessary
+        """
+        self._entries[key] = entry
+        while len(self._entries)>self.maxSize:
+            self._entries.popitem(last=False)
+    def clear(self):
+        """Remove all entries (e.g. after the monitor calibration has changed)
+        """
+        self._entries.clear()
+
+class LUTScheduler(object):
+    """Applies LUTs from a timeline at the frames they're scheduled for, for
+    LUT animation. Create one with :meth:`BitsBox.scheduleLUTs`.
+
+    A background thread builds the LUTs in advance (in timeline order, each
+    starting from the previous one) into a ring of header+LUT rows, so that
+    at each screen refresh the only work is to copy the due row into place.
+
+    Useful attributes:
+        frameN : the number of screen refreshes since the schedule started
+        nApplied : how many timeline entries have been used
+        nPrefetched : how many timeline entries have been built
+        prefetchedUpTo : the last frame whose LUT has been built (or None)
+        missedDeadlines : list of (frameN, scheduledFrameN) for each refresh
+            at which the LUT due wasn't ready (it's then applied as soon as
+            it is, and any earlier one that's ready is applied meanwhile)
+    """
+    def __init__(self, bitsBox, timeline, ringSize=64):
+        self.bitsBox = bitsBox
+        if hasattr(timeline, 'items'):
+            timeline = timeline.items()
+        timeline = sorted(timeline, key=lambda entry: entry[0])
+        self.scheduledFrames = [frameN for frameN, settings in timeline]
+        self._settings = [self._normalise(settings) for frameN, settings in timeline]
+        self.ringSize = ringSize
+        self.ringRows = numpy.zeros((ringSize,524,3), numpy.uint8)
+        self.ringLUTs = numpy.zeros((ringSize,256,3), 'd')
+        self.frameN = 0
+        self.nApplied = 0
+        self.nPrefetched = 0
+        self.missedDeadlines = []
+        self._condition = threading.Condition()
+        self._stopped = False
+        #the LUTs are built on from the current one
+        self._thread = threading.Thread(target=self._prefetch,
+                                        args=(bitsBox.LUT.copy(), bitsBox._HEADandLUT[:,0,:].copy()))
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _normalise(self, settings):
+        """(private) Convert a timeline entry into the arguments of _buildLUT
+        """
+        if isinstance(settings, dict):
+            settings = dict(settings)
+        elif isinstance(settings, tuple):
+            settings = {'contrast': settings[0], 'LUTrange': settings[1]}
+        else:
+            settings = {'newLUT': numpy.asarray(settings, 'd')}
+        for key in settings:
+            if key not in ['newLUT', 'contrast', 'gamma', 'LUTrange', 'gammaCorrect']:
+                raise ValueError("Unknown LUT setting '%s' in timeline" %key)
+        settings.setdefault('newLUT', None)
+        settings.setdefault('contrast', self.bitsBox.contrast)
+        settings.setdefault('gamma', self.bitsBox.gamma)
+        settings.setdefault('LUTrange', 1.0)
+        settings.setdefault('gammaCorrect', True)
+        return settings
+
+    @property
+    def prefetchedUpTo(self):
+        if self.nPrefetched==0:
+            return None
+        return self.scheduledFrames[self.nPrefetched-1]
+
+    def _prefetch(self, LUT, row):
+        """(private) Runs on the background thread, building the LUTs into the
+        ring whenever there's space
+        """
+        scratch = numpy.empty((256,3), numpy.uint16)
+        rampBuffer = numpy.empty(256, 'd')
+        for entryN, settings in enumerate(self._settings):
+            with self._condition:
+                while not self._stopped and entryN-self.nApplied>=self.ringSize:
+                    self._condition.wait()
+                if self._stopped:
+                    return
+            startII, endII = _LUTrangeToIndices(settings['LUTrange'])
+            try:
+                self.bitsBox._buildLUT(LUT[startII:endII], row[12+2*startII:12+2*endII],
+                                       scratch, rampBuffer, settings['newLUT'],
+                                       settings['gammaCorrect'], settings['contrast'], settings['gamma'])
+            except Exception, err:
+                logging.error("LUTScheduler couldn't build the LUT for frame %i: %s"
+                              %(self.scheduledFrames[entryN], err))
+            slot = entryN%self.ringSize
+            self.ringLUTs[slot] = LUT
+            self.ringRows[slot] = row
+            with self._condition:
+                self.nPrefetched = entryN+1
+
+    def onFlip(self):
+        """Apply any LUT that is due at this screen refresh. Called by
+        BitsBox._drawLUTtoScreen() so this isn't normally needed by users.
+        """
+        frameN = self.frameN
+        self.frameN += 1
+        if self.nApplied>=len(self.scheduledFrames) or self.scheduledFrames[self.nApplied]>frameN:
+            return #nothing due
+        #only the latest of any LUTs that are due needs to be used
+        with self._condition:
+            lastDue = self.nApplied
+            while lastDue+1<len(self.scheduledFrames) and self.scheduledFrames[lastDue+1]<=frameN:
+                lastDue += 1
+            entryN = min(lastDue, self.nPrefetched-1) #the latest that's ready
+            if entryN<lastDue:
+                #(if an earlier one is ready that's used meanwhile)
+                if not self.missedDeadlines or self.missedDeadlines[-1][1]!=self.scheduledFrames[lastDue]:
+                    logging.warning("LUT for frame %i wasn't ready in time" %self.scheduledFrames[lastDue])
+                self.missedDeadlines.append((frameN, self.scheduledFrames[lastDue]))
+            if entryN<self.nApplied:
+                return
+            slot = entryN%self.ringSize
+            self.bitsBox.LUT[:] = self.ringLUTs[slot]
+            self.bitsBox._HEADandLUT[:,0,:] = self.ringRows[slot]
+            self.nApplied = entryN+1
+            self._condition.notify()
+        self.bitsBox._markLUTdirty(0, 256)
+
+    def stop(self):
+        """Stop building and applying the LUTs
+        """
+        with self._condition:
+            self._stopped = True
+            self._condition.notify()
+        if self.bitsBox._LUTscheduler is self:
+            self.bitsBox._LUTscheduler = None
+
+class PBOFrameUploader(object):
+    """Upload frames to textures asynchronously, through a ring of OpenGL
+    pixel buffer objects (PBOs), so that the next frame can be uploading while
+    the current one is drawn. Each PBO has its own texture.
+
+    If a PBO is still being used by the graphics card when it comes round to
+    be reused that is counted as a stall (in PBOFrameUploader.stalls, one
+    entry per upload, and PBOFrameUploader.nStalls). Use more buffers if there
+    are stalls.
+
+    Used by :meth:`BitsBox.playFrames` (and needs a current OpenGL context).
+    """
+    def __init__(self, width, height, nBuffers=3):
+        self.width, self.height = width, height
+        self.nBuffers = nBuffers
+        self.nBytes = width*height*3
+        self.stalls = []
+        self.nStalls = 0
+        self._nextSlot = 0
+        self._fences = [None]*nBuffers
+        self.textures = numpy.ravel(GL.glGenTextures(nBuffers))
+        for tex in self.textures:
+            GL.glBindTexture(GL.GL_TEXTURE_2D, tex)
+            GL.glTexParameteri(GL.GL_TEXTURE_2D, GL.GL_TEXTURE_MIN_FILTER, GL.GL_NEAREST)
+            GL.glTexParameteri(GL.GL_TEXTURE_2D, GL.GL_TEXTURE_MAG_FILTER, GL.GL_NEAREST)
+            GL.glTexParameteri(GL.GL_TEXTURE_2D, GL.GL_TEXTURE_WRAP_S, GL.GL_CLAMP_TO_EDGE)
+            GL.glTexParameteri(GL.GL_TEXTURE_2D, GL.GL_TEXTURE_WRAP_T, GL.GL_CLAMP_TO_EDGE)
+            GL.glTexImage2D(GL.GL_TEXTURE_2D, 0, GL.GL_RGB8, width, height, 0,
+                            GL.GL_RGB, GL.GL_UNSIGNED_BYTE, None)
+        GL.glBindTexture(GL.GL_TEXTURE_2D, 0)
+        self.PBOs = numpy.ravel(GL.glGenBuffers(nBuffers))
+        for pbo in self.PBOs:
+            GL.glBindBuffer(GL.GL_PIXEL_UNPACK_BUFFER, pbo)
+            GL.glBufferData(GL.GL_PIXEL_UNPACK_BUFFER, self.nBytes, None, GL.GL_STREAM_DRAW)
+        GL.glBindBuffer(GL.GL_PIXEL_UNPACK_BUFFER, 0)
+
+    def upload(self, frame):
+        """Start uploading a frame (uint8, height x width x 3, first row at the
+        top) and return the texture that it's being uploaded to. This returns
+        as soon as the frame is copied into the PBO.
+        """
+        slot = self._nextSlot
+        self._nextSlot = (slot+1)%self.nBuffers
+        frame = numpy.ascontiguousarray(frame, numpy.uint8)
+        if frame.nbytes!=self.nBytes:
+            raise ValueError("Frame should be %ix%i pixels (RGB)" %(self.width, self.height))
+        #is the card still uploading from this PBO?
+        stalled = False
+        if self._fences[slot] is not None:
+            if GL.glClientWaitSync(self._fences[slot], 0, 0)==GL.GL_TIMEOUT_EXPIRED:
+                stalled = True
+                GL.glClientWaitSync(self._fences[slot], GL.GL_SYNC_FLUSH_COMMANDS_BIT, 10**9)
+            GL.glDeleteSync(self._fences[slot])
+        self.stalls.append(int(stalled))
+        self.nStalls += stalled
+        #copy the frame into the PBO (no need for the driver to keep the old contents)
+        GL.glBindBuffer(GL.GL_PIXEL_UNPACK_BUFFER, self.PBOs[slot])
+        ptr = GL.glMapBufferRange(GL.GL_PIXEL_UNPACK_BUFFER, 0, self.nBytes,
+                                  GL.GL_MAP_WRITE_BIT|GL.GL_MAP_INVALIDATE_BUFFER_BIT)
+        ctypes.memmove(ptr, frame.ctypes.data, self.nBytes)
+        GL.glUnmapBuffer(GL.GL_PIXEL_UNPACK_BUFFER)
+        #the texture is filled from the PBO, asynchronously
+        GL.glBindTexture(GL.GL_TEXTURE_2D, self.textures[slot])
+        GL.glPixelStorei(GL.GL_UNPACK_ALIGNMENT, 1)
+        GL.glTexSubImage2D(GL.GL_TEXTURE_2D, 0, 0, 0, self.width, self.height,
+                           GL.GL_RGB, GL.GL_UNSIGNED_BYTE, ctypes.c_void_p(0))
+        GL.glBindTexture(GL.GL_TEXTURE_2D, 0)
+        GL.glBindBuffer(GL.GL_PIXEL_UNPACK_BUFFER, 0)
+        self._fences[slot] = GL.glFenceSync(GL.GL_SYNC_GPU_COMMANDS_COMPLETE, 0)
+        return self.textures[slot]
+
+    def draw(self, texture, winSize):
+        """Draw a texture (from upload()) to fill a window of size `winSize`,
+        pixel for pixel, with the first row of the frame at the top
+        """
+        GL.glMatrixMode(GL.GL_PROJECTION)
+        GL.glPushMatrix()
+        GL.glLoadIdentity()
+        GL.glOrtho( 0, winSize[0],winSize[1], 0, 0, 1 )	#this also sets the 0,0 to be top-left
+        GL.glMatrixMode(GL.GL_MODELVIEW)
+        GL.glLoadIdentity()
+        GL.glActiveTexture(GL.GL_TEXTURE0)
+        GL.glEnable(GL.GL_TEXTURE_2D)
+        GL.glBindTexture(GL.GL_TEXTURE_2D, texture)
+        GL.glTexEnvi(GL.GL_TEXTURE_ENV, GL.GL_TEXTURE_ENV_MODE, GL.GL_REPLACE)
+        GL.glBegin(GL.GL_QUADS)
+        GL.glTexCoord2f(0,0); GL.glVertex2i(0, 0)
+        GL.glTexCoord2f(1,0); GL.glVertex2i(self.width, 0)
+        GL.glTexCoord2f(1,1); GL.glVertex2i(self.width, self.height)
+        GL.glTexCoord2f(0,1); GL.glVertex2i(0, self.height)
+        GL.glEnd()
+        GL.glBindTexture(GL.GL_TEXTURE_2D, 0)
+        GL.glDisable(GL.GL_TEXTURE_2D)
+        GL.glMatrixMode( GL.GL_PROJECTION )
+        GL.glPopMatrix()
+        GL.glMatrixMode( GL.GL_MODELVIEW )
+
+    def delete(self):
+        """Release the textures, buffers and fences
+        """
+        for fence in self._fences:
+            if fence is not None:
+                GL.glDeleteSync(fence)
+        self._fences = [None]*self.nBuffers
+        GL.glDeleteBuffers(self.nBuffers, self.PBOs)
+        GL.glDeleteTextures(self.textures)
+
+class GPUProfiler(object):
+    """Measures how long (named) sections of each frame take on the graphics
+    card, and how long each frame takes on the CPU, without ever waiting for
+    the card: each section is bracketed by a pair of GL timestamp queries
+    (so sections may be nested) whose results are collected, once they're
+    available, on later frames.
+
+    A new frame starts when a section begins that has already been measured
+    in the current frame (or at :meth:`endFrame`). Completed frames are kept
+    in GPUProfiler.frames (the most recent `nFrames`), each a dict with:
+
+        - 'gpu': {section: seconds}
+        - 'cpu': {section: seconds} (from begin() to end() on the CPU)
+        - 'frameTime': seconds from the start of this frame to the next
+        - 'overran': True if frameTime, or the total GPU time of the
+          sections, exceeded the frame budget
+
+    Use it through :meth:`BitsBox.enableProfiler` (needs a current OpenGL
+    context with timer queries, GL 3.3 or ARB_timer_query).
+    """
+    def __init__(self, frameBudget=1/60.0, nFrames=300, poolSize=32):
+        self.frameBudget = frameBudget
+        self.frames = deque(maxlen=nFrames)
+        self.nOverruns = 0
+        self.poolSize = poolSize
+        self._freeQueries = []
+        self._allQueries = []
+        self._open = {} #section: (startQuery, cpuStart)
+        self._pending = deque() #[frame, section, startQuery, endQuery]
+        self._unresolved = deque() #frames waiting for their gpu times
+        self._frame = None
+        self._frameStart = None
+        self._result = ctypes.c_uint64()
+
+    def _getQuery(self):
+        """(private) A free query from the pool (which grows if necessary)
+        """
+        if not self._freeQueries:
+            newQueries = [int(query) for query in numpy.ravel(GL.glGenQueries(self.poolSize))]
+            self._allQueries.extend(newQueries)
+            self._freeQueries.extend(newQueries)
+        return self._freeQueries.pop()
+
+    def _newFrame(self, now):
+        """(private) Finish the current frame (if any) and start another
+        """
+        if self._frame is not None:
+            self._frame['frameTime'] = now-self._frameStart
+            self._unresolved.append(self._frame)
+        self._frame = {'gpu': {}, 'cpu': {}, 'frameTime': None, 'overran': False, 'nPending': 0}
+        self._frameStart = now
+        self.poll()
+
+    def begin(self, section):
+        """Start timing a section of the frame (if the section is already
+        being timed, e.g. loadShader() twice without revertShader(), that
+        measurement ends here)
+        """
+        if section in self._open:
+            self.end(section)
+        now = time.time()
+        if self._frame is None or section in self._frame['cpu']:
+            self._newFrame(now)
+        startQuery = self._getQuery()
+        GL.glQueryCounter(startQuery, GL.GL_TIMESTAMP)
+        self._open[section] = (startQuery, now)
+
+    def end(self, section):
+        """Stop timing a section (started with begin())
+        """
+        if section not in self._open:
+            return
+        startQuery, cpuStart = self._open.pop(section)
+        endQuery = self._getQuery()
+        GL.glQueryCounter(endQuery, GL.GL_TIMESTAMP)
+        self._frame['cpu'][section] = time.time()-cpuStart
+        self._frame['nPending'] += 1
+        self._pending.append((self._frame, section, startQuery, endQuery))
+
+    def endFrame(self):
+        """Mark the end of a frame (e.g. just after the window flip), rather
+        than waiting for the next frame to begin. Any sections still being
+        timed end here, as part of this frame
+        """
+        for section in list(self._open):
+            self.end(section)
+        self._newFrame(time.time())
+        self._frame = None
+
+    def _queryResult(self, query):
+        """(private) The result (nanoseconds) of a completed query
+        """
+        _glGetQueryObjectui64v(query, GL.GL_QUERY_RESULT, ctypes.byref(self._result))
+        return self._result.value
+
+    def poll(self):
+        """Collect the results of any queries that the card has completed
+        (without waiting for the others) and move any frames that are now
+        complete into GPUProfiler.frames
+        """
+        while self._pending:
+            frame, section, startQuery, endQuery = self._pending[0]
+            if not GL.glGetQueryObjectiv(endQuery, GL.GL_QUERY_RESULT_AVAILABLE):
+                break #later queries can't be ready either
+            self._pending.popleft()
+            elapsed = self._queryResult(endQuery)-self._queryResult(startQuery)
+            frame['gpu'][section] = elapsed/1.0e9
+            frame['nPending'] -= 1
+            self._freeQueries.extend([startQuery, endQuery])
+        while self._unresolved and self._unresolved[0]['nPending']==0:
+            frame = self._unresolved.popleft()
+            del frame['nPending']
+            frame['overran'] = frame['frameTime']>self.frameBudget or \
+                               sum(frame['gpu'].values())>self.frameBudget
+            self.nOverruns += frame['overran']
+            self.frames.append(frame)
+
+    def stats(self):
+        """Summary of the frames in GPUProfiler.frames: a dict with the
+        'mean', 'max' and 'p95' (95th percentile) of the frameTime and of
+        the gpu and cpu times of each section (as e.g. 'gpu:encode'), plus
+        'nFrames' and 'nOverruns' (among those frames)
+        """
+        summary = {'nFrames': len(self.frames),
+                   'nOverruns': sum([frame['overran'] for frame in self.frames])}
+        series = {'frameTime': [frame['frameTime'] for frame in self.frames]}
+        for frame in self.frames:
+            for kind in ['gpu', 'cpu']:
+                for section, val in frame[kind].items():
+                    series.setdefault('%s:%s' %(kind, section), []).append(val)
+        for name, vals in series.items():
+            if vals:
+                summary[name] = {'mean': numpy.mean(vals), 'max': numpy.max(vals),
+                                 'p95': numpy.percentile(vals, 95)}
+        return summary
+
+    def delete(self):
+        """Free the queries
+        """
+        if self._allQueries:
+            GL.glDeleteQueries(len(self._allQueries), self._allQueries)
+        self._allQueries, self._freeQueries = [], []
+        self._pending.clear()
+
+#replies from the Bits# end with this
+REPLY_TERMINATOR = '\n\r'
+
+def _splitReplies(buffer):
+    """(private) Split the characters received from a Bits# into complete
+    replies (each ending with REPLY_TERMINATOR) and whatever is left over
+    (the start of a reply that hasn't finished arriving).
+
+    :return: (replies, remainder)
+    """
+    parts = buffer.split(REPLY_TERMINATOR)
+    return [part+REPLY_TERMINATOR for part in parts[:-1]], parts[-1]
+
+def _replyName(reply):
+    """(private) The command name that a reply is for (e.g. 'ProductType'
+    for '#ProductType;Bits_Sharp;\n\r') or None
+    """
+    if not reply.startswith('#'):
+        return None
+    return reply[1:].split(';', 1)[0].strip()
+
+def _replyValue(reply, name):
+    """(private) The contents of a reply to command `name`, without the
+    '#name;' at the start and the terminator (and any trailing ';' or null)
+    """
+    reply = reply.replace(REPLY_TERMINATOR, '')
+    prefix = '#%s;' %name
+    if reply.startswith(prefix):
+        reply = reply[len(prefix):]
+    return reply.rstrip(';\x00')
+
 class BitsSharp(object):
     """A class to support functions of the Bits#
     (for the Americans, Brits call the # symbol 'sharp')
@@ -72,7 +550,18 @@ class BitsSharp(object):
     On windows you must specify the COM port name.
     On OSX, if you don't specify a port then the first match of /dev/tty.usbmodemfa* will be used
     ON linux, if you don't specify a port then /dev/ttyS0 will be used
+
+    The object keeps a record (`.state`) of what it knows of the box's state
+    (its 'mode', 'temporalDithering', 'gammaFile', 'monitorEDID' and 'info')
+    and commands that wouldn't change that (e.g. switching to the mode the
+    box is already in, which takes seconds) are skipped unless called with
+    force=True. Anything not in `.state` is unknown, so the next command for
+    it is always sent. If the box may have been changed by something else
+    (the front panel, another program) call :meth:`refresh`.
     """
+    #how long (secs) after a request times out its reply is still expected
+    #(and dropped when it arrives)
+    lateReplyWindow = 5.0
     def __init__(self, portName=None):
         if portName==None:
             if sys.platform == 'darwin':
@@ -80,6 +569,10 @@ class BitsSharp(object):
             elif sys.platform.startswith('linux'):
                 portName = '/dev/ttyS0'
         self.portName = portName
+        self._rxBuffer = '' #characters received after the end of the last reply
+        self._discardingReply = False #True while the rest of a timed-out reply is to be dropped
+        self._lateReplies = {} #command name: deque of when its requests timed out (with no reply)
+        self.state = {} #what's known of the box's state (see the class docs)
         self._com = self._connect()
         if self._com:
             self.OK=True
@@ -97,23 +590,38 @@ class BitsSharp(object):
     def __del__(self):
         """If the user discards this object then close the serial port so it is released"""
         self._com.close()
-    def getInfo(self):
-        """Returns a python dictionary of info about the box
+    def getInfo(self, force=False):
+        """Returns a python dictionary of info about the box (which is only
+        read from the box the first time, or with force=True)
+        """
+        if force or 'info' not in self.state:
+            self.state['info'] = self._readInfo()
+        return dict(self.state['info'])
+    def _readInfo(self):
+        """(private) Read the product ('Bits_Sharp'?), serial number and
+        firmware date from the box
         """
         info={}
-        #get product ('Bits_Sharp'?)
-        self.sendMessage('$ProductType\r')
-        time.sleep(0.1)
-        info['ProductType'] = self.read().replace('#ProductType;','').replace(';\n\r','')
-        #get serial number
-        self.sendMessage('$SerialNumber\r')
-        time.sleep(0.1)
-        info['SerialNumber'] = self.read().replace('#SerialNumber;','').replace('\x00\n\r','')
-        #get firmware date
-        self.sendMessage('$FirmwareDate\r')
-        time.sleep(0.1)
-        info['FirmwareDate'] = self.read().replace('#FirmwareDate;','').replace(';\n\r','')
+        for name in ['ProductType', 'SerialNumber', 'FirmwareDate']:
+            info[name] = self._query(name)
         return info
+    def refresh(self):
+        """Forget what's known of the box's state and read its info again.
+        The mode etc. can't be read from the box, so they stay unknown (and
+        the next command to set each is sent regardless)
+        """
+        self.state.clear()
+        return self.getInfo()
+    def _setState(self, key, value, msg, force=False):
+        """(private) Send `msg` to set state[key] to value, unless that's
+        known to be the value already. Returns True if the message was sent
+        """
+        if not force and key in self.state and self.state[key]==value:
+            logging.debug("BitsSharp %s is already %s (not sending %s)" %(key, value, repr(msg)))
+            return False
+        self.sendMessage(msg)
+        self.state[key] = value
+        return True
 
     #switch modes
     def startMassStorageMode(self):
@@ -121,41 +629,44 @@ class BitsSharp(object):
         To get out of mass storage mode you need to restart the device
         """
         self.sendMessage('$USB_massStorage\r')
-    def startColourPlusPlusMode(self):
-        """Switch to Color++ mode
+        #(after the restart the state could be anything)
+        self.state.clear()
+        self.state['mode'] = 'massStorage'
+    def startColourPlusPlusMode(self, force=False):
+        """Switch to Color++ mode (unless already in it)
         """
-        self.sendMessage('$colourPlusPlus\r')
-    def startMonoPlusPlusMode(self):
-        """Switch to Mono++ mode
+        self._setState('mode', 'color++', '$colourPlusPlus\r', force)
+    def startMonoPlusPlusMode(self, force=False):
+        """Switch to Mono++ mode (unless already in it)
         """
-        self.sendMessage('$monoPlusPlus\r')
-    def startBitsPlusPlusMode(self):
-        """Switch to Bits++ mode
+        self._setState('mode', 'mono++', '$monoPlusPlus\r', force)
+    def startBitsPlusPlusMode(self, force=False):
+        """Switch to Bits++ mode (unless already in it)
         """
-        self.sendMessage('$BitsPlusPlus\r')
-    def startAutoPlusPlusMode(self):
+        self._setState('mode', 'bits++', '$BitsPlusPlus\r', force)
+    def startAutoPlusPlusMode(self, force=False):
         """Switch to Auto++ mode (the box will determine the mode from a T-lock code
         """
-        self.sendMessage('$autoPlusPlus\r')
-    def showStatusScreen(self):
+        self._setState('mode', 'auto++', '$autoPlusPlus\r', force)
+    def showStatusScreen(self, force=False):
         """Show the status screen to check inputs etc.
         To get out of this mode you need to switch to one of the standard video
         modes.
         """
-        self.sendMessage('$statusScreen\n\r')
+        self._setState('mode', 'status', '$statusScreen\n\r', force)
 
     #video-related settings
     def beep(self, freq=800, dur=1):
         """Make a beep with the internal
         """
         self.sendMessage('$Beep=[%i %.4f]\r' %(freq, dur))
-    def setTemporalDithering(self, dither=True):
+    def setTemporalDithering(self, dither=True, force=False):
         """Set temporal dithering to be True or False
         """
         if dither:
-            self.sendMessage('$TemporalDithering=[ON]\r')
+            self._setState('temporalDithering', True, '$TemporalDithering=[ON]\r', force)
         else:
-            self.sendMessage('$TemporalDithering=[OFF]\r')
+            self._setState('temporalDithering', False, '$TemporalDithering=[OFF]\r', force)
     def getVideoLine(self, lineN, nPixels):
         """Return the r,g,b values for a number of pixels on a particular video line
 
@@ -164,14 +675,74 @@ class BitsSharp(object):
 
         :return: an Nx3 numpy array of uint8 values
         """
-        self.sendMessage('$GetVideoLine=[%i %i]\r' %(lineN, nPixels))
-        time.sleep(0.5)
-        raw = self.read(timeout=0.5)
-        vals = raw.split(';')[1:-1]
+        raw = self._query('GetVideoLine', '$GetVideoLine=[%i %i]\r' %(lineN, nPixels), timeout=2.0)
+        return self._parseVideoLine(raw)
+    def _parseVideoLine(self, raw):
+        """(private) The Nx3 values from the contents of a GetVideoLine reply
+        """
+        vals = numpy.fromstring(raw, sep=';', dtype=int)
         if len(vals)==0:
             logging.warning("No values returned by BitsSharp.getVideoLine(). Possibly not enough time to swith to status mode?")
-        vals = numpy.array(vals, dtype=int).reshape([-1,3])
-        return vals
+        return vals[:len(vals)//3*3].reshape([-1,3])
+    def getVideoRegion(self, lines, nPixels, callback=None, maxPending=16, timeout=2.0):
+        """Return the r,g,b values of the first `nPixels` pixels of several
+        video lines.
+
+        The requests are pipelined (up to `maxPending` are sent before their
+        replies are read) so this takes little more than the time for the box
+        to send the values, rather than a round trip per line.
+
+        :Parameters:
+
+            lines : a list of line numbers, or an int (for lines 0 to lines-1)
+
+            nPixels : the number of pixels to read from each line
+
+            callback : None or a function
+                called as callback(rowN, lineN, row) as each line arrives
+                (row is that line's Nx3 values in the returned array)
+
+            maxPending : the most requests to have awaiting replies
+
+            timeout : how long (secs) to wait for each line
+
+        :return: a (len(lines), nPixels, 3) numpy array of uint8 values
+            (lines that fail to arrive in full are left as zeros)
+        """
+        if isinstance(lines, int):
+            lines = range(lines)
+        region = numpy.zeros((len(lines), nPixels, 3), numpy.uint8)
+        pending = deque()
+        for rowN, lineN in enumerate(lines):
+            pending.append(self._sendVideoLineRequest(lineN, nPixels))
+            if len(pending)>=maxPending:
+                self._storeVideoLine(region, rowN-len(pending)+1, lines,
+                                     self._videoLineReply(pending.popleft(), timeout), callback)
+        while pending:
+            self._storeVideoLine(region, len(lines)-len(pending), lines,
+                                 self._videoLineReply(pending.popleft(), timeout), callback)
+        return region
+    def _sendVideoLineRequest(self, lineN, nPixels):
+        """(private) Send a GetVideoLine request for getVideoRegion and return
+        what _videoLineReply needs to collect its reply
+        """
+        self.sendMessage('$GetVideoLine=[%i %i]\r' %(lineN, nPixels))
+    def _videoLineReply(self, request, timeout=2.0):
+        """(private) The contents of the next GetVideoLine reply
+        """
+        return self._readReply('GetVideoLine', timeout)
+    def _storeVideoLine(self, region, rowN, lines, raw, callback):
+        """(private) Parse a GetVideoLine reply into a row of region
+        """
+        vals = numpy.fromstring(raw, sep=';', dtype=int)
+        nPixels = region.shape[1]
+        if len(vals)<nPixels*3:
+            logging.warning("BitsSharp.getVideoRegion() got %i of %i values for line %i"
+                            %(len(vals), nPixels*3, lines[rowN]))
+            vals = vals[:len(vals)//3*3]
+        region[rowN].flat[:len(vals)] = vals[:nPixels*3]
+        if callback is not None:
+            callback(rowN, lines[rowN], region[rowN])
 
     #helper functions (lower level)
     def sendMessage(self, msg):
@@ -186,28 +757,481 @@ class BitsSharp(object):
     def read(self, timeout=0.1):
         """Get the current waiting characters from the serial port if there are any
         """
-        self._com.setTimeout(timeout)
+        self._com.timeout = timeout
         nChars = self._com.inWaiting()
-        raw = self._com.read(nChars)
+        raw = self._rxBuffer+self._com.read(nChars)
+        self._rxBuffer = ''
         logging.debug("Got BitsSharp reply: %s" %(repr(raw)))
         return raw
+    def readResponse(self, timeout=1.0):
+        """Read one complete reply from the box: returns as soon as the reply's
+        terminator ('\\n\\r') arrives, or with whatever has arrived (possibly
+        '') if that takes longer than `timeout` seconds. Anything received after
+        the terminator is kept for the next reply, and if a reply times out
+        part way through then the rest of it is dropped when it arrives.
+        """
+        deadline = time.time()+timeout
+        buffer = self._rxBuffer
+        while True:
+            if self._discardingReply:
+                if REPLY_TERMINATOR in buffer:
+                    buffer = buffer.split(REPLY_TERMINATOR, 1)[1]
+                    self._discardingReply = False
+                else:
+                    buffer = ''
+            if not self._discardingReply and REPLY_TERMINATOR in buffer:
+                break
+            remaining = deadline-time.time()
+            if remaining<=0:
+                logging.warning("BitsSharp reply timed out (got %s)" %repr(buffer))
+                self._rxBuffer = ''
+                if buffer:
+                    self._discardingReply = True
+                return buffer
+            #wait for at least one character, then take all that are waiting
+            self._com.timeout = remaining
+            buffer += self._com.read(max(1, self._com.inWaiting()))
+        replies, self._rxBuffer = _splitReplies(buffer)
+        #(any further complete replies stay buffered, in order)
+        self._rxBuffer = ''.join(replies[1:])+self._rxBuffer
+        logging.debug("Got BitsSharp reply: %s" %(repr(replies[0])))
+        return replies[0]
+    def _query(self, name, msg=None, timeout=1.0):
+        """(private) Send a command (by default '$name') and return the
+        contents of its reply (without '#name;' or the terminator)
+        """
+        self.sendMessage(msg or '$%s\r' %name)
+        return self._readReply(name, timeout)
+    def _readReply(self, name, timeout=1.0):
+        """(private) The contents of the next reply to command `name`, or ''
+        if that doesn't arrive within `timeout` secs. Replies to other
+        commands are dropped, as are replies to earlier requests for `name`
+        that timed out before any of their reply arrived (if they arrive
+        within `lateReplyWindow` secs) so that they aren't taken for this one.
+        """
+        deadline = time.time()+timeout
+        late = self._lateReplies.setdefault(name, deque())
+        while True:
+            reply = self.readResponse(timeout=max(0, deadline-time.time()))
+            if not reply.endswith(REPLY_TERMINATOR):
+                if not reply:
+                    #(a partial reply is dropped by readResponse, but this
+                    #one may yet arrive in full)
+                    late.append(time.time())
+                return '' #timed out
+            if _replyName(reply)==name:
+                while late and time.time()-late[0] >= self.lateReplyWindow:
+                    late.popleft()
+                if not late:
+                    return _replyValue(reply, name)
+                late.popleft()
+                logging.warning("Dropped late BitsSharp reply %s" %repr(reply))
+                continue
+            logging.warning("Dropped BitsSharp reply %s (waiting for %s)" %(repr(reply), name))
 
     #TO DO: The following are either not yet implemented (or not tested)
-    def setMonitorEDID(self, edidFilename):
+    def setMonitorEDID(self, edidFilename, force=False):
         """Set the EDID file for the monitor (using serial command `$setMonitorType`)
         The edid files will be located in the EDID subdirectory of the flash disk.
         The file “automatic.edid” will be the file read from the connected monitor
         """
-        self.sendMessage('$setMonitorType=[%s]\r' %(EDIDfilename))
-    def setGammaCorrection(self, gammaFilename):
+        self._setState('monitorEDID', edidFilename, '$setMonitorType=[%s]\r' %(edidFilename), force)
+    def setGammaCorrection(self, gammaFilename, force=False):
         """Set the gamma correction file
         """
-        self.sendMessage('$enableGammaCorrection=[%s]\r' %(gammaFilename))
+        self._setState('gammaFile', gammaFilename, '$enableGammaCorrection=[%s]\r' %(gammaFilename), force)
     def start(self):
         pass
     def stop(self):
         pass
 
+class AsyncBitsSharp(BitsSharp):
+    """A :class:`BitsSharp` for use with asyncio (or trollius, its backport
+    for python 2), which never blocks the event loop.
+
+    Commands that have replies (:meth:`getInfo`, :meth:`getVideoLine` and
+    :meth:`query`) return a Future, to be awaited (or `yield From(...)` with
+    trollius). Replies are read as they arrive, without blocking, and each
+    is matched to the oldest request for that command (by the '#Name;' at
+    its start), so several requests can be outstanding at once. Other
+    commands (mode switches etc.) are just sent, as for BitsSharp.
+
+    Where the event loop can watch the serial port (posix) it does,
+    otherwise the port is polled every `pollInterval` seconds.
+
+    If a request times out (or is cancelled) its reply is dropped if it
+    arrives later, so that it isn't taken as the reply to the next request
+    for that command. Replies that no request is waiting for are kept for
+    :meth:`read` and :meth:`readResponse` (which also returns a Future).
+
+    **Example**::
+
+        @asyncio.coroutine
+        def checkBox(box):
+            info = yield From(box.getInfo())
+            line = yield From(box.getVideoLine(lineN=50, nPixels=5))
+
+    """
+    def __init__(self, portName=None, loop=None, pollInterval=0.002):
+        if asyncio is None:
+            raise ImportError, 'AsyncBitsSharp needs asyncio (or trollius for python 2)'
+        self.loop = loop or asyncio.get_event_loop()
+        self.pollInterval = pollInterval
+        self._waiting = {} #command name: deque of [future, time it failed or None]
+        self._unclaimed = deque(maxlen=64) #replies that no request was waiting for
+        self._readers = deque() #futures from readResponse() for the next of those
+        self._pollHandle = None
+        BitsSharp.__init__(self, portName)
+        if not self.OK:
+            return
+        self._com.timeout = 0 #never wait in read()
+        try:
+            self.loop.add_reader(self._com.fileno(), self._onReadable)
+            self._watching = True
+        except (AttributeError, NotImplementedError, ValueError, TypeError):
+            #(e.g. windows, or a port without a file descriptor)
+            self._watching = False
+            self._pollHandle = self.loop.call_later(self.pollInterval, self._poll)
+    def _poll(self):
+        """(private) Check for replies and come back later
+        """
+        self._onReadable()
+        self._pollHandle = self.loop.call_later(self.pollInterval, self._poll)
+    def _onReadable(self):
+        """(private) Take any characters waiting at the port and hand out the
+        replies that are complete
+        """
+        nChars = self._com.inWaiting()
+        if not nChars:
+            return
+        replies, self._rxBuffer = _splitReplies(self._rxBuffer+self._com.read(nChars))
+        for reply in replies:
+            logging.debug("Got BitsSharp reply: %s" %(repr(reply)))
+            waiting = self._waiting.get(_replyName(reply))
+            while waiting:
+                future, failedAt = waiting.popleft()
+                if not future.done():
+                    future.set_result(reply)
+                    break
+                if failedAt is None or time.time()-failedAt < self.lateReplyWindow:
+                    logging.warning("Dropped late BitsSharp reply: %s" %(repr(reply)))
+                    break
+                #(else that request's reply never came, so this is for the next)
+            else:
+                self._handOut(reply)
+    def _handOut(self, reply):
+        """(private) Give a reply that no request was waiting for to the
+        oldest readResponse() still waiting, or keep it for later
+        """
+        while self._readers:
+            future = self._readers.popleft()
+            if not future.done():
+                future.set_result(reply)
+                return
+        self._unclaimed.append(reply)
+    def request(self, name, msg=None, timeout=1.0):
+        """Send a command (by default '$name') and return a Future for its
+        complete reply, which fails with asyncio.TimeoutError if the reply
+        doesn't arrive within `timeout` seconds
+        """
+        future = asyncio.Future(loop=self.loop)
+        entry = [future, None]
+        self._waiting.setdefault(name, deque()).append(entry)
+        self.sendMessage(msg or '$%s\r' %name)
+        def onTimeout():
+            if not future.done():
+                future.set_exception(asyncio.TimeoutError("No reply from BitsSharp to %s" %name))
+        timer = self.loop.call_later(timeout, onTimeout)
+        def onDone(fut):
+            timer.cancel()
+            if fut.cancelled() or fut.exception() is not None:
+                entry[1] = time.time() #its reply may still arrive
+        future.add_done_callback(onDone)
+        return future
+    def _then(self, future, func):
+        """(private) A Future for func(result of `future`)
+        """
+        result = asyncio.Future(loop=self.loop)
+        def done(fut):
+            if result.cancelled():
+                return
+            if fut.cancelled():
+                result.cancel()
+            elif fut.exception() is not None:
+                result.set_exception(fut.exception())
+            else:
+                try:
+                    result.set_result(func(fut.result()))
+                except Exception, err:
+                    result.set_exception(err)
+        future.add_done_callback(done)
+        return result
+    def query(self, name, msg=None, timeout=1.0):
+        """As :meth:`request` but the Future gives just the contents of the
+        reply (without '#name;' or the terminator)
+        """
+        return self._then(self.request(name, msg, timeout), lambda reply: _replyValue(reply, name))
+    def getInfo(self, force=False):
+        """Returns a Future for a python dictionary of info about the box
+        (the three requests are all sent at once, the first time or with
+        force=True)
+        """
+        if not force and 'info' in self.state:
+            info = asyncio.Future(loop=self.loop)
+            info.set_result(dict(self.state['info']))
+            return info
+        names = ['ProductType', 'SerialNumber', 'FirmwareDate']
+        replies = asyncio.gather(*[self.query(name) for name in names], loop=self.loop)
+        def store(vals):
+            self.state['info'] = dict(zip(names, vals))
+            return dict(self.state['info'])
+        return self._then(replies, store)
+    def getVideoLine(self, lineN, nPixels):
+        """Returns a Future for the r,g,b values (an Nx3 numpy array) of a
+        number of pixels on a particular video line (see BitsSharp.getVideoLine)
+        """
+        reply = self.query('GetVideoLine', '$GetVideoLine=[%i %i]\r' %(lineN, nPixels), timeout=2.0)
+        return self._then(reply, self._parseVideoLine)
+    def getVideoRegion(self, lines, nPixels, callback=None, maxPending=16, timeout=2.0):
+        """Returns a Future for the r,g,b values of several video lines (a
+        (len(lines), nPixels, 3) uint8 array), see BitsSharp.getVideoRegion.
+        As there, up to `maxPending` requests are sent at once (each one as
+        the reply to an earlier one arrives), each line must arrive within
+        `timeout` secs of its request being sent, and callback(rowN, lineN,
+        row) is called as each line arrives.
+        """
+        if isinstance(lines, int):
+            lines = range(lines)
+        region = numpy.zeros((len(lines), nPixels, 3), numpy.uint8)
+        result = asyncio.Future(loop=self.loop)
+        rows = iter(enumerate(lines))
+        nPending = [0]
+        def sendNext():
+            for rowN, lineN in rows:
+                reply = self.query('GetVideoLine', '$GetVideoLine=[%i %i]\r' %(lineN, nPixels), timeout)
+                reply.add_done_callback(lambda fut, rowN=rowN: onReply(fut, rowN))
+                nPending[0] += 1
+                return
+            if not nPending[0] and not result.done():
+                result.set_result(region)
+        def onReply(reply, rowN):
+            nPending[0] -= 1
+            if result.done():
+                return #(failed or cancelled already)
+            if reply.cancelled():
+                result.cancel()
+            elif reply.exception() is not None:
+                result.set_exception(reply.exception())
+            else:
+                self._storeVideoLine(region, rowN, lines, reply.result(), callback)
+                sendNext()
+        for n in range(max(1, maxPending)):
+            sendNext()
+        return result
+    def read(self, timeout=0.1):
+        """The replies that have arrived that no request was waiting for
+        """
+        self._onReadable()
+        raw = ''.join(self._unclaimed)
+        self._unclaimed.clear()
+        return raw
+    def readResponse(self, timeout=1.0):
+        """Returns a Future for the next reply that no request was waiting
+        for, which fails with asyncio.TimeoutError if there isn't one within
+        `timeout` seconds
+        """
+        future = asyncio.Future(loop=self.loop)
+        self._onReadable()
+        if self._unclaimed:
+            future.set_result(self._unclaimed.popleft())
+            return future
+        self._readers.append(future)
+        def onTimeout():
+            if not future.done():
+                future.set_exception(asyncio.TimeoutError("No reply from BitsSharp"))
+        timer = self.loop.call_later(timeout, onTimeout)
+        future.add_done_callback(lambda fut: timer.cancel())
+        return future
+    def close(self):
+        """Stop reading from the port (failing any requests still waiting for
+        replies) and close it
+        """
+        if self._pollHandle is not None:
+            self._pollHandle.cancel()
+            self._pollHandle = None
+        if getattr(self, '_watching', False):
+            self.loop.remove_reader(self._com.fileno())
+            self._watching = False
+        for waiting in self._waiting.values():
+            for future, failedAt in waiting:
+                if not future.done():
+                    future.cancel()
+        self._waiting = {}
+        for future in self._readers:
+            future.cancel()
+        self._readers.clear()
+        self._com.close()
+
+class ReplyFuture(object):
+    """The reply to a command sent by a :class:`ThreadedBitsSharp`, which
+    will be filled in by its reader thread
+    """
+    def __init__(self, name):
+        self.name = name
+        self.reply = None
+        self.abandoned = None #when result() stopped waiting for the reply
+        self._event = threading.Event()
+    def _setReply(self, reply):
+        self.reply = reply
+        self._event.set()
+    def done(self):
+        return self._event.is_set()
+    def wait(self, timeout=None):
+        """Wait (up to `timeout` secs) for the reply. Returns True if it has
+        arrived
+        """
+        return self._event.wait(timeout)
+    def result(self, timeout=1.0):
+        """The complete reply (or '' if it doesn't arrive within `timeout`
+        secs, as for BitsSharp.readResponse, in which case the reply is
+        dropped if it arrives later)
+        """
+        if not self._event.wait(timeout):
+            logging.warning("BitsSharp reply to %s timed out" %self.name)
+            self.abandoned = time.time()
+            return ''
+        return self.reply
+
+class ThreadedBitsSharp(BitsSharp):
+    """A :class:`BitsSharp` that can be used from several threads at once.
+
+    A single background thread reads everything that the box sends, splits it
+    into replies and hands each to the oldest request still waiting for a
+    reply to that command (by the '#Name;' at its start). Commands are sent
+    under a lock, so one thread can switch modes while another is reading
+    video lines without the two getting mixed up, and nothing polls or
+    sleeps while waiting for replies.
+
+    The methods are those of BitsSharp, with :meth:`request` to send a command
+    and get a :class:`ReplyFuture` for its reply without waiting for it.
+    If a request times out its reply is dropped if it arrives later (rather
+    than going to the next request for that command). Replies that no request
+    is waiting for are kept for :meth:`read` and :meth:`readResponse`.
+    Call :meth:`close` when finished (to stop the thread).
+    """
+    def __init__(self, portName=None, readTimeout=0.05):
+        self.readTimeout = readTimeout #how often the reader checks if it should stop
+        #for writing, the waiting requests and the state mirror (reentrant, as
+        #_setState holds it while sending)
+        self._lock = threading.RLock()
+        self._waiting = {} #command name: deque of ReplyFutures
+        self._unclaimed = deque(maxlen=64) #replies that no request was waiting for
+        self._replyArrived = threading.Condition(self._lock) #for readResponse
+        self._stopped = False
+        self._thread = None
+        BitsSharp.__init__(self, portName)
+        if not self.OK:
+            return
+        self._thread = threading.Thread(target=self._reader)
+        self._thread.daemon = True
+        self._thread.start()
+    def _reader(self):
+        """(private) Runs in the reader thread, handing out replies as they
+        arrive
+        """
+        buffer = ''
+        while not self._stopped:
+            #wait for at least one character, then take all that are waiting
+            self._com.timeout = self.readTimeout
+            try:
+                buffer += self._com.read(max(1, self._com.inWaiting()))
+            except Exception, err:
+                if not self._stopped:
+                    logging.error("BitsSharp reader stopped: %s" %err)
+                return
+            if REPLY_TERMINATOR not in buffer:
+                continue
+            replies, buffer = _splitReplies(buffer)
+            for reply in replies:
+                logging.debug("Got BitsSharp reply: %s" %(repr(reply)))
+                with self._lock:
+                    futures = self._waiting.get(_replyName(reply))
+                    future = None
+                    while futures:
+                        future = futures.popleft()
+                        if future.abandoned is None or time.time()-future.abandoned < self.lateReplyWindow:
+                            break
+                        future = None #(its reply never came, so this is for the next)
+                    if future is None:
+                        self._unclaimed.append(reply)
+                        self._replyArrived.notify_all()
+                if future is None:
+                    pass
+                elif future.abandoned is not None:
+                    logging.warning("Dropped late BitsSharp reply: %s" %(repr(reply)))
+                else:
+                    future._setReply(reply)
+    def request(self, name, msg=None):
+        """Send a command (by default '$name') and return a
+        :class:`ReplyFuture` for its reply
+        """
+        future = ReplyFuture(name)
+        #registered and sent together, so replies are handed out in the
+        #order their commands were sent
+        with self._lock:
+            self._waiting.setdefault(name, deque()).append(future)
+            BitsSharp.sendMessage(self, msg or '$%s\r' %name)
+        return future
+    def sendMessage(self, msg):
+        with self._lock:
+            BitsSharp.sendMessage(self, msg)
+    def _setState(self, key, value, msg, force=False):
+        #check, send and record together, so that the state can't be
+        #recorded in a different order to the commands being sent
+        with self._lock:
+            return BitsSharp._setState(self, key, value, msg, force)
+    def _query(self, name, msg=None, timeout=1.0):
+        return _replyValue(self.request(name, msg).result(timeout), name)
+    def _readInfo(self):
+        """(private) As BitsSharp._readInfo but the three requests are all
+        sent at once
+        """
+        names = ['ProductType', 'SerialNumber', 'FirmwareDate']
+        futures = [self.request(name) for name in names]
+        return dict([(name, _replyValue(future.result(), name))
+                     for name, future in zip(names, futures)])
+    def _sendVideoLineRequest(self, lineN, nPixels):
+        return self.request('GetVideoLine', '$GetVideoLine=[%i %i]\r' %(lineN, nPixels))
+    def _videoLineReply(self, request, timeout=2.0):
+        return _replyValue(request.result(timeout), 'GetVideoLine')
+    def read(self, timeout=0.1):
+        """The replies that have arrived that no request was waiting for
+        """
+        with self._lock:
+            raw = ''.join(self._unclaimed)
+            self._unclaimed.clear()
+        return raw
+    def readResponse(self, timeout=1.0):
+        """The next reply that no request was waiting for, or '' if there
+        isn't one within `timeout` secs
+        """
+        deadline = time.time()+timeout
+        with self._replyArrived:
+            while not self._unclaimed:
+                remaining = deadline-time.time()
+                if remaining<=0:
+                    return ''
+                self._replyArrived.wait(remaining)
+            return self._unclaimed.popleft()
+    def close(self):
+        """Stop the reader thread and close the port
+        """
+        self._stopped = True
+        if self._thread is not None:
+            self._thread.join(self.readTimeout*10)
+            self._thread = None
+        self._com.close()
+
 class BitsBox(object):
     """The main class to control a bits++ box.
 
@@ -230,19 +1254,13 @@ class BitsBox(object):
         self.contrast=contrast
         self.nEntries=nEntries
         #set standardised name for mode
-        if mode in ['bits','bits++']:
-            self.mode = 'bits++'
-        elif mode in ['color','color++','colour','colour++']:
-            self.mode = 'color++'
-        elif mode in ['mono','mono++']:
-            self.mode = 'mono++'
+        if mode in encode.modeNames:
+            self.mode = encode.modeNames[mode]
         else:
             logging.error("Unknown mode '%s' for BitsBox" %mode)
 
-        if len(gamma)>2: # [Lum,R,G,B] or [R,G,B]
-            self.gamma=gamma[-3:]
-        else:
-            self.gamma = [gamma, gamma, gamma]
+        #a single value, [Lum,R,G,B] or [R,G,B]
+        self.gamma = list(_gammaRGB(gamma))
 
         if init():
             setVideoMode(NOGAMMACORRECT|VIDEOENCODEDCOMMS)
@@ -252,34 +1270,36 @@ class BitsBox(object):
             self.initialised=False
             logging.warning("couldn't initialise bits++")
 
+        self._outputPass = None #see drawOutput()
+        self.profiler = None #see enableProfiler()
+        self._stimulusPasses = {} #see drawStimulus(), by kind of stimulus
         if self.mode == 'bits++':
             #do the processing
             self._HEADandLUT = numpy.zeros((524,1,3),numpy.uint8)
-            self._HEADandLUT[:12,:,0] = numpy.asarray([ 36, 63, 8, 211, 3, 112, 56, 34,0,0,0,0]).reshape([12,1])#R
-            self._HEADandLUT[:12,:,1] = numpy.asarray([ 106, 136, 19, 25, 115, 68, 41, 159,0,0,0,0]).reshape([12,1])#G
-            self._HEADandLUT[:12,:,2] = numpy.asarray([ 133, 163, 138, 46, 164, 9, 49, 208,0,0,0,0]).reshape([12,1])#B
+            self._HEADandLUT[:12,0,:] = encode.bitsPlusPlusHeader
+            #the same (live) array under its old name, e.g. for glDrawPixels
+            self._HEADandLUTstr = self._HEADandLUT
             self.LUT=numpy.zeros((256,3),'d')#just a place holder
+            #preallocated buffers so that setLUT needn't create temporaries
+            self._LUT16 = numpy.zeros((256,3),numpy.uint16)
+            self._rampIndices = numpy.arange(256,dtype='d')
+            self._rampBuffer = numpy.zeros(256,'d')
+            self._LUTdirty = None
+            self.LUTcache = None #see enableLUTcache()
+            #for setLUTAsync()
+            self._asyncLUTlock = threading.Condition()
+            self._asyncLUTrequest = self._asyncLUTready = self._asyncLUTthread = None
+            self._asyncLUTstopped = False
+            self._asyncLUTgeneration = 0 #increased by setLUT, so older async LUTs are dropped
+            self._LUTscheduler = None #see scheduleLUTs()
             self.setLUT()#this will set self.LUT and update self._LUTandHEAD
-        elif haveShaders:
-            self.monoModeShader = shaders.compileProgram(fragment=shaders.bitsMonoModeFrag,
-                                   attachments=[shaders.gammaCorrectionFrag])
-            self.colorModeShader =shaders.compileProgram(fragment=shaders.bitsColorModeFrag,
-                                   attachments=[shaders.gammaCorrectionFrag])
-            GL.glUseProgram(self.colorModeShader)
-            prog = self.colorModeShader
-            GL.glUniform1f(GL.glGetUniformLocation(prog, 'sampleSpacing'), 1.0)
-            #Set default encoding gamma for power-law shader to (1.0, 1.0, 1.0):
-            GL.glUniform3f(GL.glGetUniformLocation(prog, 'ICMEncodingGamma'), 1.0, 1.0, 1.0)
-            # Default min and max luminance is 0.0 to 1.0, therefore reciprocal 1/range is also 1.0:
-            GL.glUniform3f(GL.glGetUniformLocation(prog, 'ICMMinInLuminance'), 0.0, 0.0, 0.0)
-            GL.glUniform3f(GL.glGetUniformLocation(prog, 'ICMMaxInLuminance'), 1.0, 1.0, 1.0)
-            GL.glUniform3f(GL.glGetUniformLocation(prog, 'ICMReciprocalLuminanceRange'), 1.0, 1.0, 1.0)
-            # Default gain to postmultiply is 1.0:
-            GL.glUniform3f(GL.glGetUniformLocation(prog, 'ICMOutputGain'), 1.0, 1.0, 1.0)
-            # Default bias to is 0.0:
-            GL.glUniform3f(GL.glGetUniformLocation(prog, 'ICMOutputBias'), 0.0, 0.0, 0.0)
-            GL.glUniform2f(GL.glGetUniformLocation(prog, 'ICMClampToColorRange'), 0.0, 1.0)
-            GL.glUseProgram(0)
+        else:
+            #shaders are compiled on demand by loadShader() (or warmup())
+            self.monoModeShader = self.colorModeShader = None
+            self.uniforms = None #a shaders.UniformState once compiled
+            self.gammaTable = None #see setGammaTable()
+            self._gammaLUTtexture = None
+            self._moduloLUTtexture = None
 
     def setLUT(self,newLUT=None, gammaCorrect=True, LUTrange=1.0):
         """Sets the LUT to a specific range of values.
@@ -306,106 +1326,530 @@ class BitsBox(object):
 
         (NB by using BitsBox.setContr() and BitsBox.setGamma() users may not
         need this function!?)
+
+        Any LUT from :meth:`setLUTAsync` that hasn't been swapped in yet is
+        dropped (it was asked for before this one).
         """
+        if self._asyncLUTthread is not None:
+            with self._asyncLUTlock:
+                self._asyncLUTgeneration += 1
+                self._asyncLUTrequest = self._asyncLUTready = None
 
         #choose endpoints
-        LUTrange=numpy.asarray(LUTrange)
-        if LUTrange.size==1:
-            startII = int(round((0.5-LUTrange/2.0)*255.0))
-            endII = int(round((0.5+LUTrange/2.0)*255.0))+1 #+1 because python ranges exclude last value
-        elif LUTrange.size==2:
-            multiplier=1.0
-            if LUTrange[1]<=1: multiplier=255.0
-            startII= int(round(LUTrange[0]*multiplier))
-            endII = int(round(LUTrange[1]*multiplier))+1 #+1 because python ranges exclude last value
-        stepLength = 2.0/(endII-startII-1)
+        startII, endII = _LUTrangeToIndices(LUTrange)
+        LUT = self.LUT[startII:endII,:] #a view, so we can work in-place
+        encoded = self._HEADandLUT[12+2*startII:12+2*endII,0,:]
 
+        #have we already built this LUT?
+        if self.LUTcache is not None:
+            cacheKey = self._LUTcacheKey(newLUT, gammaCorrect, startII, endII)
+            cached = self.LUTcache.get(cacheKey)
+            if cached is not None:
+                LUT[:], encoded[:] = cached
+                self._markLUTdirty(startII, endII)
+                return
+
+        self._buildLUT(LUT, encoded, self._LUT16[startII:endII], self._rampBuffer,
+                       newLUT, gammaCorrect, self.contrast, self.gamma)
+        self._markLUTdirty(startII, endII)
+        if self.LUTcache is not None:
+            self.LUTcache.add(cacheKey, (LUT.copy(), encoded.copy()))
+
+    def _buildLUT(self, LUT, encoded, scratch, rampBuffer, newLUT, gammaCorrect, contrast, gamma):
+        """(private) Does the work of setLUT for one range of the LUT, using
+        only the arrays it is given (so that it can also run on the thread
+        used by setLUTAsync).
+
+        :Parameters:
+            LUT : the (float) entries of the LUT to set
+            encoded : the part of the header+LUT row for those entries
+            scratch, rampBuffer : uint16 and float arrays at least as long as LUT
+            newLUT, gammaCorrect : as for setLUT
+            contrast, gamma : the contrast and gamma to use
+        """
+        nEntries = len(LUT)
+        stepLength = 2.0/(nEntries-1)
         if newLUT is None:
             #create a LUT from scratch (based on contrast and gamma)
-            #rampStep = 2.0/(self.nEntries-1)
-            ramp = numpy.arange(-1.0,1.0+stepLength, stepLength)
-            ramp = (ramp*self.contrast+1.0)/2.0
+            #ramp = ((-1.0 + n*stepLength)*contrast + 1.0)/2.0, built in a preallocated buffer
+            ramp = rampBuffer[:nEntries]
+            numpy.multiply(self._rampIndices[:nEntries], stepLength*contrast/2.0, out=ramp)
+            ramp += (1.0-contrast)/2.0
             #self.LUT will be stored as 0.0:1.0 (gamma-corrected)
-            self.LUT[startII:endII,0] = copy(ramp)
-            self.LUT[startII:endII,1] = copy(ramp)
-            self.LUT[startII:endII,2] = copy(ramp)
+            LUT[:] = ramp[:,None]
         elif type(newLUT) in [float, int] or (newLUT.shape==()):
-            self.LUT[startII:endII,0]= newLUT
-            self.LUT[startII:endII,1]= newLUT
-            self.LUT[startII:endII,2]= newLUT
+            LUT[:] = newLUT
         elif len(newLUT.shape) == 1: #one dimensional LUT
             #replicate LUT to other channels
             #check range is 0:1
-            if newLUT>1.0:
+            if newLUT.max()>1.0:
                 logging.warning('newLUT should be float in range 0.0:1.0')
-            self.LUT[startII:endII,0]= copy(newLUT.flat)
-            self.LUT[startII:endII,1]= copy(newLUT.flat)
-            self.LUT[startII:endII,2]= copy(newLUT.flat)
+            LUT[:] = newLUT[:,None]
 
         elif len(newLUT.shape) == 2: #one dimensional LUT
             #use LUT as is
             #check range is 0:1
-            if max(max(newLUT))>1.0:
+            if newLUT.max()>1.0:
                 raise AttributeError, 'newLUT should be float in range 0.0:1.0'
-            self.LUT[startII:endII,:]= newLUT
+            LUT[:] = newLUT
 
         else:
             logging.warning('newLUT can be None, nx1 or nx3')
 
         #do gamma correction if necessary
         if gammaCorrect==True:
-            gamma=self.gamma
             if hasattr(self.win.monitor, 'lineariseLums'):
-                self.LUT[startII:endII, : ] = self.win.monitor.lineariseLums(self.LUT[startII:endII, : ], overrideGamma=gamma)
+                LUT[:] = self.win.monitor.lineariseLums(LUT, overrideGamma=gamma)
 
         #update the bits++ box with new LUT
-        #get bits into correct order, shape and add to header
-        ramp16 = (self.LUT*(2**16-1)).astype(numpy.uint16) #go from ubyte to uint16
-        ramp16 = numpy.reshape(ramp16,(256,1,3))
-        #set most significant bits
-        self._HEADandLUT[12::2,:,:] = (ramp16[:,:,:]>>8).astype(numpy.uint8)
-        #set least significant bits
-        self._HEADandLUT[13::2,:,:] = (ramp16[:,:,:]&255).astype(numpy.uint8)
-        self._HEADandLUTstr = self._HEADandLUT.tostring()
+        #re-encode just the entries that changed, in place in the header+LUT row
+        encode.packLUT(LUT, encoded, scratch=scratch[:nEntries])
+
+    def setLUTAsync(self, newLUT=None, gammaCorrect=True, LUTrange=1.0):
+        """Like :meth:`BitsBox.setLUT` but the new LUT is computed on a
+        background thread, so that the work (particularly the gamma
+        correction) doesn't use up time on the thread that draws the frames.
+
+        The new LUT is swapped in at the first screen refresh after it's ready.
+        If further calls are made before then, only the newest LUT is kept.
+        So, unlike setLUT, calls for different parts of the LUT (LUTrange) can
+        be dropped if they are made too quickly.
+
+        The current BitsBox.contrast and BitsBox.gamma are used.
+        """
+        with self._asyncLUTlock:
+            self._asyncLUTrequest = (newLUT, gammaCorrect, LUTrange, self.contrast, self.gamma)
+            self._asyncLUTlock.notify()
+        if self._asyncLUTthread is None:
+            self._asyncLUTstopped = False
+            self._asyncLUTthread = threading.Thread(target=self._asyncLUTworker)
+            self._asyncLUTthread.daemon = True
+            self._asyncLUTthread.start()
+
+    def _asyncLUTworker(self):
+        """(private) Runs on the background thread of setLUTAsync, building
+        each requested LUT into its own (back) buffers
+        """
+        while True:
+            with self._asyncLUTlock:
+                while self._asyncLUTrequest is None and not self._asyncLUTstopped:
+                    self._asyncLUTlock.wait()
+                if self._asyncLUTstopped:
+                    return
+                newLUT, gammaCorrect, LUTrange, contrast, gamma = self._asyncLUTrequest
+                self._asyncLUTrequest = None
+                generation = self._asyncLUTgeneration
+            try:
+                startII, endII = _LUTrangeToIndices(LUTrange)
+                nEntries = endII-startII
+                LUT = numpy.empty((nEntries,3),'d')
+                encoded = numpy.empty((2*nEntries,3),numpy.uint8)
+                self._buildLUT(LUT, encoded, numpy.empty((nEntries,3),numpy.uint16),
+                               numpy.empty(nEntries,'d'), newLUT, gammaCorrect, contrast, gamma)
+            except Exception, err:
+                logging.error("BitsBox.setLUTAsync() failed: %s" %err)
+                continue
+            with self._asyncLUTlock:
+                if generation != self._asyncLUTgeneration:
+                    continue #setLUT has been called since it was requested
+                #replaces any LUT that hasn't been used yet
+                self._asyncLUTready = (startII, endII, LUT, encoded)
+
+    def _stopAsyncLUT(self):
+        """(private) Stop the thread of setLUTAsync (dropping any LUT that it
+        hasn't finished or that hasn't been swapped in yet)
+        """
+        if self._asyncLUTthread is None:
+            return
+        with self._asyncLUTlock:
+            self._asyncLUTstopped = True
+            self._asyncLUTrequest = self._asyncLUTready = None
+            self._asyncLUTlock.notify()
+        self._asyncLUTthread.join()
+        self._asyncLUTthread = None
+
+    def _swapAsyncLUT(self):
+        """(private) If a LUT from setLUTAsync is ready then put it in place
+        (called at each screen refresh, by _drawLUTtoScreen)
+        """
+        if self._asyncLUTready is None:
+            return
+        with self._asyncLUTlock:
+            startII, endII, LUT, encoded = self._asyncLUTready
+            self._asyncLUTready = None
+            self.LUT[startII:endII] = LUT
+            self._HEADandLUT[12+2*startII:12+2*endII,0,:] = encoded
+        self._markLUTdirty(startII, endII)
+
+    def enableLUTcache(self, maxSize=64):
+        """Keep the most recent LUTs created by setLUT (and so setContrast and
+        setGamma) so that repeating the same settings is just a copy of the
+        stored values, rather than recalculating them (and, particularly,
+        repeating the gamma correction).
+
+        The cache is available as BitsBox.LUTcache (which counts the cache
+        hits and misses). Call BitsBox.LUTcache.clear() if the monitor
+        calibration changes.
+
+        :Parameters:
+            maxSize : int
+                the maximum number of LUTs to keep
+        """
+        self.LUTcache = LUTCache(maxSize=maxSize)
+    def disableLUTcache(self):
+        """Stop caching LUTs (see :meth:`BitsBox.enableLUTcache`)
+        """
+        self.LUTcache = None
+    def _LUTcacheKey(self, newLUT, gammaCorrect, startII, endII):
+        """(private) The key for the LUT that setLUT would create with these
+        settings (only the settings that affect the result are included)
+        """
+        if newLUT is None:
+            LUTkey = ('contrast', self.contrast)
+        elif type(newLUT) in [float, int] or (newLUT.shape==()):
+            LUTkey = ('value', float(newLUT))
+        else:
+            newLUT = numpy.ascontiguousarray(newLUT)
+            LUTkey = (newLUT.shape, newLUT.dtype.str, hashlib.sha1(newLUT.tostring()).hexdigest())
+        if gammaCorrect==True:
+            gammaKey = _gammaRGB(self.gamma)
+        else:
+            gammaKey = None
+        return (LUTkey, gammaKey, startII, endII)
+
+    def _markLUTdirty(self, startII, endII):
+        """(private) Record that LUT entries startII:endII have changed since
+        the header+LUT row was last sent to the screen.
+
+        Changes accumulate into a single range (self._LUTdirty) that is only
+        cleared by whatever consumes it.
+        """
+        if self._LUTdirty is None:
+            self._LUTdirty = (startII, endII)
+        else:
+            self._LUTdirty = (min(startII, self._LUTdirty[0]), max(endII, self._LUTdirty[1]))
+
+    def precomputeLUTs(self, contrasts=None, gammas=None, LUTranges=None,
+                       newLUTs=None, gammaCorrect=True):
+        """Build the header+LUT rows for a whole sequence of LUTs in one go,
+        ready for LUT animation with :meth:`BitsBox.usePrecomputedLUT`
+
+        Each argument is either None or a sequence with one entry per LUT (all
+        sequences must have the same length, N). Each LUT is built just as
+        :meth:`BitsBox.setLUT` would build it from the current LUT, so the
+        entries outside each LUTrange are left as they are now.
+
+        :Parameters:
+            contrasts : sequence of floats
+                contrast of each LUT (default is BitsBox.contrast)
+            gammas : sequence
+                gamma of each LUT, each a float or [R,G,B] (default is BitsBox.gamma)
+            LUTranges : sequence
+                the LUTrange of each LUT, as for setLUT (default is 1.0)
+            newLUTs : sequence
+                LUT values to use instead of a contrast ramp, each as for setLUT
+            gammaCorrect : True or False
+                whether to gamma-correct the new values (as for setLUT)
+
+        :return: an (N,524,3) uint8 array with one header+LUT row per LUT
+
+        **Example**::
+
+            rows = bitsBox.precomputeLUTs(contrasts=numpy.linspace(0,1,100))
+            for frameN in range(100):
+                bitsBox.usePrecomputedLUT(rows, frameN)
+                win.flip()
+
+        """
+        nEach = [len(arg) for arg in [contrasts, gammas, LUTranges, newLUTs] if arg is not None]
+        if len(nEach)==0 or min(nEach)!=max(nEach):
+            raise ValueError('precomputeLUTs needs one or more sequences, all of the same length')
+        nLUTs = nEach[0]
+        if contrasts is None:
+            contrasts = [self.contrast]*nLUTs
+        if gammas is None:
+            gammas = [self.gamma]*nLUTs
+        if LUTranges is None:
+            LUTranges = [1.0]*nLUTs
+        contrasts = numpy.asarray(contrasts, 'd')
+
+        #which entries of each LUT are going to be set
+        starts, ends = numpy.array([_LUTrangeToIndices(thisRange) for thisRange in LUTranges]).T
+        indices = numpy.arange(256)
+        inRange = (indices>=starts[:,None]) & (indices<ends[:,None])
+
+        LUTs = numpy.empty((nLUTs,256,3),'d')
+        LUTs[:] = self.LUT
+        if newLUTs is None:
+            #create LUTs from scratch (based on contrast), with the same
+            #arithmetic as _buildLUT so the results are identical
+            stepLengths = 2.0/(ends-starts-1)
+            ramps = (indices-starts[:,None])*(stepLengths*contrasts/2.0)[:,None]
+            ramps += ((1.0-contrasts)/2.0)[:,None]
+            LUTs[inRange] = ramps[inRange][:,None]
+        else:
+            for n, thisLUT in enumerate(newLUTs):
+                thisLUT = numpy.asarray(thisLUT, 'd')
+                if thisLUT.ndim==1:
+                    thisLUT = thisLUT[:,None] #replicate to other channels
+                LUTs[n, starts[n]:ends[n], :] = thisLUT
+
+        #do gamma correction, once for all the LUTs sharing each gamma
+        if gammaCorrect==True and hasattr(self.win.monitor, 'lineariseLums'):
+            sameGamma = {}
+            for n, thisGamma in enumerate(gammas):
+                sameGamma.setdefault(_gammaRGB(thisGamma), []).append(n)
+            for thisGamma, rows in sameGamma.items():
+                theseLUTs = LUTs[rows]
+                theseLUTs[inRange[rows]] = self.win.monitor.lineariseLums(theseLUTs[inRange[rows]],
+                                                                         overrideGamma=list(thisGamma))
+                LUTs[rows] = theseLUTs
+
+        #encode all the LUTs into bits++ rows
+        rows = numpy.empty((nLUTs,524,3),numpy.uint8)
+        rows[:,:12,:] = encode.bitsPlusPlusHeader
+        encode.packLUT(LUTs, rows[:,12:,:])
+        return rows
+
+    def scheduleLUTs(self, timeline, ringSize=64):
+        """Set LUTs automatically at particular screen refreshes (counting
+        from the next one, which is frame 0), for LUT animation.
+
+        The LUTs are built in advance on a background thread, so there's very
+        little to do at each refresh. See :class:`LUTScheduler` for how to check
+        that the LUTs were ready in time.
+
+        :Parameters:
+            timeline : a dict (or list of pairs) of frameN:settings, where the
+                settings for each frame are any of:
+                    - a (contrast, LUTrange) tuple
+                    - a dict of setLUT arguments (newLUT, gammaCorrect,
+                      LUTrange) and/or contrast and gamma
+                    - a LUT (as for the newLUT argument of setLUT)
+            ringSize : the number of LUTs that can be built in advance
+
+        :return: the :class:`LUTScheduler`
+
+        **Example**::
+
+            timeline = dict([(frameN, (numpy.sin(frameN/10.0), [63,127]))
+                             for frameN in range(600)])
+            scheduler = bitsBox.scheduleLUTs(timeline)
+            for frameN in range(600):
+                win.flip()
+            print scheduler.missedDeadlines
+
+        """
+        if self._LUTscheduler is not None:
+            self._LUTscheduler.stop()
+        self._LUTscheduler = LUTScheduler(self, timeline, ringSize=ringSize)
+        return self._LUTscheduler
+
+    def usePrecomputedLUT(self, LUTs, index):
+        """Use one of the header+LUT rows created by :meth:`BitsBox.precomputeLUTs`
+        (it will take effect at the next screen refresh, like setLUT).
+
+        This only copies a single row into place so it is cheap enough to
+        call on every frame.
+
+        :Parameters:
+            LUTs : the (N,524,3) array returned by precomputeLUTs
+            index : int, the LUT (row) to use
+        """
+        row = LUTs[index]
+        self._HEADandLUT[:,0,:] = row
+        #keep self.LUT in step with the values the box will receive
+        numpy.multiply(row[12::2], 256.0, out=self.LUT)
+        self.LUT += row[13::2]
+        self.LUT /= (2**16-1)
+        self._markLUTdirty(0, 256)
 
     def _drawLUTtoScreen(self):
         """(private) Used to set the LUT on the Bits++.
         Used to draw the LUT to the screen when in 'bits++' mode (not mono++ or colour++).
         Should not be needed by user if attached to a ``psychopy.visual.Window()``
         since this will automatically draw the LUT as part of the screen refresh.
+
+        The header+LUT row is kept in a texture, which is only updated (for
+        the entries that changed) after the LUT has been changed.
         """
-        #push the projection matrix and set to orthorgaphic
+        if self.profiler is not None:
+            self.profiler.begin('LUT')
+        self._prepareLUT()
 
+        #push the matrices and set to orthorgaphic
         GL.glMatrixMode(GL.GL_PROJECTION)
         GL.glPushMatrix()
         GL.glLoadIdentity()
         GL.glOrtho( 0, self.win.size[0],self.win.size[1], 0, 0, 1 )	#this also sets the 0,0 to be top-left
-        #but return to modelview for rendering
         GL.glMatrixMode(GL.GL_MODELVIEW)
+        GL.glPushMatrix()
         GL.glLoadIdentity()
 
-        #draw the pixels
-        GL_multitexture.glActiveTextureARB(GL_multitexture.GL_TEXTURE0_ARB)
-        GL.glEnable(GL.GL_TEXTURE_2D)
+        #draw the row as a textured quad (no texture on unit 1)
+        GL.glActiveTexture(GL.GL_TEXTURE1)
         GL.glBindTexture(GL.GL_TEXTURE_2D, 0)
-        GL_multitexture.glActiveTextureARB(GL_multitexture.GL_TEXTURE1_ARB)
+        GL.glActiveTexture(GL.GL_TEXTURE0)
         GL.glEnable(GL.GL_TEXTURE_2D)
+        GL.glBindTexture(GL.GL_TEXTURE_2D, self._LUTtexture)
+        GL.glTexEnvi(GL.GL_TEXTURE_ENV, GL.GL_TEXTURE_ENV_MODE, GL.GL_REPLACE)
+        GL.glBegin(GL.GL_QUADS)
+        GL.glTexCoord2f(0,0); GL.glVertex2i(0, 0)
+        GL.glTexCoord2f(1,0); GL.glVertex2i(524, 0)
+        GL.glTexCoord2f(1,1); GL.glVertex2i(524, 1)
+        GL.glTexCoord2f(0,1); GL.glVertex2i(0, 1)
+        GL.glEnd()
         GL.glBindTexture(GL.GL_TEXTURE_2D, 0)
-        GL.glRasterPos2i(0,1)
-        GL.glDrawPixelsub(GL.GL_RGB, self._HEADandLUT)
-        #GL.glDrawPixels(524,1, GL.GL_RGB,GL.GL_UNSIGNED_BYTE, self._HEADandLUTstr)
-        #return to 3D mode (go and pop the projection matrix)
+
+        #return to 3D mode (go and pop the matrices)
+        GL.glPopMatrix()
         GL.glMatrixMode( GL.GL_PROJECTION )
         GL.glPopMatrix()
         GL.glMatrixMode( GL.GL_MODELVIEW )
+        if self.profiler is not None:
+            self.profiler.end('LUT')
+
+    def enableProfiler(self, frameBudget=None, nFrames=300):
+        """Start measuring the time that the Bits sections of each frame take
+        on the graphics card (and CPU), using a :class:`GPUProfiler` (which is
+        then BitsBox.profiler). The sections are:
+
+            - 'encode': from :meth:`loadShader` to :meth:`revertShader`
+            - 'LUT': drawing the header+LUT row (:meth:`_drawLUTtoScreen`)
+            - 'output': :meth:`drawOutput` or :meth:`drawStimulus`
+
+        The results arrive a frame or more later, without stalling the card.
+        Frames taking longer than `frameBudget` (default is the window's
+        monitorFramePeriod, or 1/60 s) are flagged as overruns. See
+        GPUProfiler.frames and GPUProfiler.stats()
+        """
+        if frameBudget is None:
+            frameBudget = getattr(self.win, 'monitorFramePeriod', None) or 1/60.0
+        if self.profiler is not None:
+            self.profiler.delete()
+        self.profiler = GPUProfiler(frameBudget=frameBudget, nFrames=nFrames)
+        return self.profiler
+
+    def disableProfiler(self):
+        """Stop measuring (see enableProfiler)
+        """
+        if self.profiler is not None:
+            self.profiler.delete()
+            self.profiler = None
+
+    def _prepareLUT(self):
+        """(private) Bring the LUT texture up to date for the coming frame
+        (taking any LUT from setLUTAsync() or scheduleLUTs())
+        """
+        self._swapAsyncLUT()
+        if self._LUTscheduler is not None:
+            self._LUTscheduler.onFlip()
+        self._updateLUTtexture()
+
+    def drawOutput(self, imageTexture):
+        """Draw the whole output for the current mode in a single pass, from
+        an image in a texture (e.g. the texture of the window's framebuffer
+        object, which must be the same size as the window) to the current
+        framebuffer (e.g. the back buffer). This uses a modern (GLSL 3.30 core)
+        program with one full-screen triangle:
+
+            - in bits++ mode the image is copied and the header+LUT row is
+              written to the top line in the same pass (so
+              :meth:`_drawLUTtoScreen` isn't needed)
+            - in mono++ and color++ modes the image is gamma corrected and
+              encoded (instead of :meth:`loadShader`/:meth:`revertShader`)
+
+        :Parameters:
+            imageTexture : the id of a GL_TEXTURE_2D
+
+        """
+        if self._outputPass is None:
+            if not haveShaders:
+                raise ImportError, 'BitsBox.drawOutput() needs pycrsltd.shaders (and pyglet)'
+            gammaTableSize = None
+            if self.mode != 'bits++' and self.gammaTable is not None:
+                gammaTableSize = len(self.gammaTable)
+            self._outputPass = shaders.OutputPass(self.mode, gammaTableSize=gammaTableSize)
+            if self.mode != 'bits++' and gammaTableSize is None:
+                self._updateShaderGamma()
+        textures = {}
+        if self.mode == 'bits++':
+            self._prepareLUT()
+            textures[3] = (GL.GL_TEXTURE_2D, self._LUTtexture)
+        elif self.gammaTable is not None:
+            textures[2] = (GL.GL_TEXTURE_1D, self._getGammaLUTtexture().id)
+        if self.profiler is not None:
+            self.profiler.begin('output')
+        self._outputPass.draw(imageTexture, textures)
+        if self.profiler is not None:
+            self.profiler.end('output')
+
+    def drawStimulus(self, stimulus):
+        """Draw a :class:`shaders.ProceduralStimulus` (e.g. a grating or gabor)
+        over the whole window in mono++ or color++ mode. The stimulus is
+        computed by the output program itself, at full precision, and gamma
+        corrected and encoded in the same pass, so there's no image texture
+        at all. Changing its parameters from frame to frame (with
+        stimulus.setParams()) just changes the program's uniforms.
+        """
+        if self.mode == 'bits++':
+            logging.error('BitsBox.drawStimulus() is for mono++ and color++ modes')
+            return
+        if not haveShaders:
+            raise ImportError, 'BitsBox.drawStimulus() needs pycrsltd.shaders (and pyglet)'
+        outputPass = self._stimulusPasses.get(stimulus.kind)
+        if outputPass is None:
+            gammaTableSize = None
+            if self.gammaTable is not None:
+                gammaTableSize = len(self.gammaTable)
+            outputPass = shaders.OutputPass(self.mode, gammaTableSize=gammaTableSize,
+                                            source=stimulus.source)
+            self._stimulusPasses[stimulus.kind] = outputPass
+            if gammaTableSize is None:
+                self._updateShaderGamma()
+        stimulus.applyTo(outputPass.uniforms, self.win.size)
+        textures = {}
+        if self.gammaTable is not None:
+            textures[2] = (GL.GL_TEXTURE_1D, self._getGammaLUTtexture().id)
+        if self.profiler is not None:
+            self.profiler.begin('output')
+        outputPass.draw(None, textures)
+        if self.profiler is not None:
+            self.profiler.end('output')
+
+    def _updateLUTtexture(self):
+        """(private) Create the texture for the header+LUT row, the first time
+        it's needed, and then upload just the pixels of any LUT entries that
+        have changed (see BitsBox._LUTdirty)
+        """
+        GL.glPixelStorei(GL.GL_UNPACK_ALIGNMENT, 1)
+        if getattr(self, '_LUTtexture', None) is None:
+            self._LUTtexture = GL.glGenTextures(1)
+            GL.glBindTexture(GL.GL_TEXTURE_2D, self._LUTtexture)
+            GL.glTexParameteri(GL.GL_TEXTURE_2D, GL.GL_TEXTURE_MIN_FILTER, GL.GL_NEAREST)
+            GL.glTexParameteri(GL.GL_TEXTURE_2D, GL.GL_TEXTURE_MAG_FILTER, GL.GL_NEAREST)
+            GL.glTexParameteri(GL.GL_TEXTURE_2D, GL.GL_TEXTURE_WRAP_S, GL.GL_CLAMP_TO_EDGE)
+            GL.glTexParameteri(GL.GL_TEXTURE_2D, GL.GL_TEXTURE_WRAP_T, GL.GL_CLAMP_TO_EDGE)
+            GL.glTexImage2D(GL.GL_TEXTURE_2D, 0, GL.GL_RGB8, 524, 1, 0,
+                            GL.GL_RGB, GL.GL_UNSIGNED_BYTE, self._HEADandLUT)
+            self._LUTdirty = None
+        elif self._LUTdirty is not None:
+            startII, endII = self._LUTdirty
+            GL.glBindTexture(GL.GL_TEXTURE_2D, self._LUTtexture)
+            GL.glTexSubImage2D(GL.GL_TEXTURE_2D, 0, 12+2*startII, 0, 2*(endII-startII), 1,
+                               GL.GL_RGB, GL.GL_UNSIGNED_BYTE,
+                               self._HEADandLUT[12+2*startII:12+2*endII])
+            self._LUTdirty = None
+        GL.glBindTexture(GL.GL_TEXTURE_2D, 0)
 
     def setContrast(self,contrast,LUTrange=1.0):
         """Optional parameter LUTrange determines which entries of the LUT
         will be set to this contrast
 
         :Parameters:
-            contrast : float in the range 0:1
-                The contrast for the range being set
+            contrast : float in the range -1:1
+                The contrast for the range being set (negative values
+                invert the polarity)
             LUTrange : float or array
                 If a float is given then this is the fraction of the LUT to be used.
                 If an array of floats is given, these will specify the start/stop points
@@ -423,8 +1867,16 @@ class BitsBox(object):
                 will set the lower-middle quarter of the LUT
                 (which might be useful in LUT animation paradigms)
 
+        In mono++ and color++ modes this sets the contrast of the shader's
+        gamma correction instead (for the whole screen, from the next
+        :meth:`loadShader`).
+
         """
         self.contrast = contrast
+        if self.mode != 'bits++':
+            #the shader applies contrast to the whole screen (LUTrange is ignored)
+            self._updateShaderGamma()
+            return
         #setLUT uses contrast automatically
         self.setLUT(newLUT=None, gammaCorrect=True, LUTrange=LUTrange)
 
@@ -433,27 +1885,293 @@ class BitsBox(object):
         Currently also resets the LUT to be a linear contrast
         ramp spanning its full range. May change this to read
         the current LUT, undo previous gamm and then apply
-        new one?"""
+        new one?
+
+        In mono++ and color++ modes this sets the encoding gamma of the shader
+        instead (1/newGamma, from the next :meth:`loadShader`)."""
         self.gamma=newGamma
+        if self.mode != 'bits++':
+            #takes effect at the next loadShader()
+            self._updateShaderGamma()
+            return
         self.setLUT() #easiest way to update
-    def loadShader(self):
-        """Load the shader for the current Bits mode (mono++ or color++)
+    def warmup(self):
+        """Do the OpenGL setup for the current mode now (e.g. before the first
+        trial) rather than when it's first needed: compiles the shader for
+        mono++ or color++ modes and creates the LUT texture for bits++ mode.
+        """
+        if self.mode == 'bits++':
+            self._updateLUTtexture()
+        else:
+            self._getShader()
+    def _getShader(self):
+        """(private) Returns the program for the current mode, compiling it (and
+        setting its default uniforms) the first time it's needed
         """
-        self.lastShaderProg = GL.glGetIntegerv(GL.GL_CURRENT_PROGRAM)
         if self.mode == 'color++':
-            GL.glUseProgram(self.colorModeShader)
-            print 'using color shader'
+            if self.colorModeShader is None:
+                self.colorModeShader = self._compileShader(shaders.bitsColorModeFrag)
+                self.uniforms['sampleSpacing'] = 1.0
+            return self.colorModeShader
         elif self.mode == 'mono++':
-            GL.glUseProgram(self.monoModeShader)
-            print 'using mono shader'
+            if self.monoModeShader is None:
+                self.monoModeShader = self._compileShader(shaders.bitsMonoModeFrag)
+                self.uniforms.update(Image=0, moduloLUT=1)
+                self._moduloLUTtexture = shaders.getModuloLUTtexture()
+            return self.monoModeShader
+    def _compileShader(self, fragment):
+        """(private) Get the program for this fragment shader and the
+        UniformState (self.uniforms) that holds its gamma-correction settings
+        """
+        if not haveShaders:
+            raise ImportError, 'BitsBox needs pycrsltd.shaders (and pyglet) for %s mode' %self.mode
+        if self.gammaTable is not None:
+            prog = shaders.getProgram(fragment=fragment, attachments=[shaders.gammaCorrectionLUTFrag])
+            self.uniforms = shaders.UniformState(prog, ICMGammaLUT=2,
+                                                 ICMGammaLUTSize=float(len(self.gammaTable)))
+            self._getGammaLUTtexture()
+            return prog
+        prog = shaders.getProgram(fragment=fragment, attachments=[shaders.gammaCorrectionFrag])
+        self.uniforms = shaders.UniformState(prog)
+        self.uniforms.setGammaParams(**shaders.ICMdefaults)
+        self._updateShaderGamma()
+        return prog
+    def setGammaTable(self, table, start=None):
+        """Use a gamma table (e.g. a measured inverse gamma) for the gamma
+        correction in mono++ and color++ modes, rather than the power-law
+        gamma and contrast (so :meth:`setGamma` and :meth:`setContrast` have
+        no effect while it's in use).
+
+        :Parameters:
+            table : n or n x 3 array of floats (0.0:1.0), or None
+                The output for n evenly spaced input values from 0.0 to 1.0
+                (for each gun, or the same for all). The shader interpolates
+                linearly between them. None reverts to power-law correction.
+            start : None or int
+                None (the default) if `table` is the whole table. Otherwise
+                `table` replaces just the entries of the current table from
+                index `start` (so start=0 with a shorter table changes its
+                first entries). A ValueError is raised if there's no current
+                table or those entries aren't all in it.
+
+        Changing entries, or giving a whole table of the same size as the
+        current one, just updates the texture (which needs the window's OpenGL
+        context current). Otherwise the program changes.
+        """
+        if self.mode == 'bits++':
+            logging.error('BitsBox.setGammaTable() is for mono++ and color++ modes, use setLUT() in bits++ mode')
+            return
+        if table is not None:
+            table = numpy.array(table, 'd')
+            if table.ndim==1:
+                table = table[:,None].repeat(3, axis=1)
+        if start is not None:
+            if table is None or self.gammaTable is None:
+                raise ValueError, 'BitsBox.setGammaTable() can only change entries (start=%i) of a table that is in use' %start
+            if start<0 or start+len(table)>len(self.gammaTable):
+                raise ValueError, "Gamma table entries %i:%i aren't all in the current table of %i" \
+                                  %(start, start+len(table), len(self.gammaTable))
+        elif table is not None and self.gammaTable is not None and len(table)==len(self.gammaTable):
+            start = 0 #new values for the current table
+        if start is not None:
+            #a change to the values of the current table
+            self.gammaTable[start:start+len(table)] = table
+            if self._gammaLUTtexture is not None:
+                self._gammaLUTtexture.update(table, start)
+            return
+        #a different type or size of table means a different program and texture
+        self.gammaTable = table
+        if self._gammaLUTtexture is not None:
+            self._gammaLUTtexture.delete()
+            self._gammaLUTtexture = None
+        self._releaseShaders()
+    def _releaseShaders(self):
+        """(private) Release the programs (and shared textures) of this BitsBox
+        so that they're deleted if no other window is using them
+        """
+        for prog in [self.monoModeShader, self.colorModeShader]:
+            if prog is not None:
+                shaders.release(prog)
+        if self._moduloLUTtexture is not None:
+            shaders.release(self._moduloLUTtexture, kind='texture')
+        if self._outputPass is not None:
+            self._outputPass.delete()
+            self._outputPass = None
+        for outputPass in self._stimulusPasses.values():
+            outputPass.delete()
+        self._stimulusPasses = {}
+        self.monoModeShader = self.colorModeShader = None
+        self._moduloLUTtexture = None
+        self.uniforms = None
+    def _getGammaLUTtexture(self):
+        """(private) The texture for self.gammaTable, created when first needed
+        """
+        if self._gammaLUTtexture is None:
+            self._gammaLUTtexture = shaders.GammaLUTTexture(self.gammaTable)
+        return self._gammaLUTtexture
+    def _updateShaderGamma(self):
+        """(private) Set the shaders' gamma-correction uniforms from
+        self.contrast and self.gamma (they're sent to OpenGL by loadShader or
+        drawOutput)
+        """
+        #(in-Lmin)/(Lmax-Lmin) == 0.5+contrast*(in-0.5) for this luminance range
+        #(reversed, Lmin>Lmax, for a negative contrast)
+        contrast = self.contrast
+        if abs(contrast)<1.0e-6:
+            contrast = 1.0e-6
+        gamma = _gammaRGB(self.gamma)
+        outputPasses = [self._outputPass]+self._stimulusPasses.values()
+        for uniforms in [self.uniforms]+[thisPass and thisPass.uniforms for thisPass in outputPasses]:
+            if uniforms is None:
+                continue #not compiled yet, so this will be done when it is
+            uniforms.setGammaParams(encodingGamma=[1.0/thisGamma for thisGamma in gamma],
+                                    minInLuminance=0.5-0.5/contrast,
+                                    maxInLuminance=0.5+0.5/contrast)
+    def close(self):
+        """Free the OpenGL objects used by this BitsBox, e.g. before its window
+        is closed (which should be the current context). Programs and textures
+        that are shared with other windows (see :class:`shaders.ShareGroup`)
+        are only deleted once none of them is using them.
+        """
+        self.disableProfiler()
+        if self.mode == 'bits++':
+            self._stopAsyncLUT()
+            if self._LUTscheduler is not None:
+                self._LUTscheduler.stop()
+            if getattr(self, '_LUTtexture', None) is not None:
+                GL.glDeleteTextures([self._LUTtexture])
+                self._LUTtexture = None
+            if self._outputPass is not None:
+                self._outputPass.delete()
+                self._outputPass = None
         else:
+            if self._gammaLUTtexture is not None:
+                self._gammaLUTtexture.delete()
+                self._gammaLUTtexture = None
+            self._releaseShaders()
+    def loadShader(self):
+        """Load the shader for the current Bits mode (mono++ or color++)
+
+        The shader is compiled the first time this is called (unless
+        :meth:`warmup` was called already).
+        """
+        if self.mode not in ['mono++', 'color++']:
             logging.error('Bits.loadShader() called, but Bits is in %s mode' %self.mode)
+            return
+        prog = self._getShader()
+        if self.profiler is not None:
+            self.profiler.begin('encode')
+        self.lastShaderProg = GL.glGetIntegerv(GL.GL_CURRENT_PROGRAM)
+        GL.glUseProgram(prog)
+        self.uniforms.flush()
+        if self.mode == 'mono++':
+            #the image is on unit 0, the moduloLUT on 1 and any gamma table on 2
+            GL.glActiveTexture(GL.GL_TEXTURE1)
+            GL.glBindTexture(GL.GL_TEXTURE_1D, self._moduloLUTtexture)
+            GL.glActiveTexture(GL.GL_TEXTURE0)
+        if self._gammaLUTtexture is not None:
+            self._gammaLUTtexture.bind(2)
     def revertShader(self):
         """Reverts OpenGL to use the shader being used at the point that
         Bits.loadShader() was last called.
         """
         GL.glUseProgram(self.lastShaderProg)
+        if self.profiler is not None:
+            self.profiler.end('encode')
+
+    def drawEncodedFrame(self, frame):
+        """Draw a frame that has already been encoded for the current mode (e.g.
+        by :mod:`pycrsltd.encode` or from a :class:`~pycrsltd.stimbank.StimulusBank`)
+        directly to the screen, with its first row at the top of the window.
 
+        The frame must not be encoded again when the window is drawn, so don't
+        use loadShader() (or a PsychoPy bitsMode window) at the same time.
+
+        :Parameters:
+            frame : uint8 array (height, width, 3)
+        """
+        frame = numpy.ascontiguousarray(frame)
+        GL.glMatrixMode(GL.GL_PROJECTION)
+        GL.glPushMatrix()
+        GL.glLoadIdentity()
+        GL.glOrtho( 0, self.win.size[0],self.win.size[1], 0, 0, 1 )	#this also sets the 0,0 to be top-left
+        GL.glMatrixMode(GL.GL_MODELVIEW)
+        GL.glLoadIdentity()
+        #draw the rows downwards from the top-left, with no padding between rows
+        GL.glPixelStorei(GL.GL_UNPACK_ALIGNMENT, 1)
+        GL.glRasterPos2i(0,0)
+        GL.glPixelZoom(1.0, -1.0)
+        GL.glDrawPixels(frame.shape[1], frame.shape[0], GL.GL_RGB, GL.GL_UNSIGNED_BYTE, frame)
+        GL.glPixelZoom(1.0, 1.0)
+        GL.glMatrixMode( GL.GL_PROJECTION )
+        GL.glPopMatrix()
+        GL.glMatrixMode( GL.GL_MODELVIEW )
+
+    def playFrames(self, frames, LUTs=None, nBuffers=3):
+        """Play a sequence of frames that have already been encoded for the
+        current mode, one per screen refresh. Frames are uploaded through a
+        ring of pixel buffer objects (see :class:`PBOFrameUploader`), so that
+        each frame uploads while the previous one is drawn.
+
+        The number of stalls (waiting for a buffer to be free) for each frame
+        is stored in BitsBox.frameStalls.
+
+        :Parameters:
+            frames : any sequence or iterator of uint8 (height, width, 3) frames
+            LUTs : optional header+LUT rows, one per frame (bits++ mode only)
+            nBuffers : number of PBOs (and textures) in the ring
+
+        :return: the number of frames played
+        """
+        frames = iter(frames)
+        try:
+            frame = next(frames)
+        except StopIteration:
+            return 0
+        uploader = PBOFrameUploader(frame.shape[1], frame.shape[0], nBuffers=nBuffers)
+        try:
+            texture = uploader.upload(frame)
+            nPlayed = 0
+            while texture is not None:
+                #start uploading the next frame before drawing this one
+                nextFrame = next(frames, None)
+                if nextFrame is not None:
+                    nextTexture = uploader.upload(nextFrame)
+                else:
+                    nextTexture = None
+                if LUTs is not None:
+                    self.usePrecomputedLUT(LUTs, nPlayed)
+                uploader.draw(texture, self.win.size)
+                self.win.flip()
+                nPlayed += 1
+                texture = nextTexture
+        finally:
+            self.frameStalls = uploader.stalls
+            uploader.delete()
+        return nPlayed
+
+    def playBank(self, bank, startFrame=0, nFrames=None, readAhead=8, nBuffers=3):
+        """Play frames from a :class:`~pycrsltd.stimbank.StimulusBank`, one per
+        screen refresh, reading them from disk as they are needed (with
+        `readAhead` frames read in advance, in the background) and uploading
+        them with :meth:`BitsBox.playFrames`.
+
+        If the bank has a header+LUT row per frame (and we're in bits++ mode)
+        then that LUT is used for each frame too.
+
+        :return: the number of frames played
+        """
+        if bank.mode!=self.mode:
+            logging.warning("Playing a bank of %s frames, but BitsBox is in %s mode" %(bank.mode, self.mode))
+        if self.mode=='bits++' and bank.LUTs is not None and len(bank.LUTs)==len(bank):
+            LUTs = bank.LUTs[startFrame:]
+        else:
+            LUTs = None
+        stream = bank.stream(startFrame=startFrame, nFrames=nFrames, readAhead=readAhead)
+        try:
+            return self.playFrames((frame for frameN, frame in stream), LUTs=LUTs, nBuffers=nBuffers)
+        finally:
+            stream.stop()
 
 #The following all require access to the dll and aren't likely to have any effect
 try:
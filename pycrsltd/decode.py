@@ -0,0 +1,113 @@
+#!/usr/bin/env python
+#coding=utf-8
+
+# Copyright (c) Cambridge Research Systems (CRS) Ltd
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+
+"""Decode Bits++, Mono++ and Color++ framebuffer contents (using numpy).
+
+These are the inverse of the encodings in :mod:`pycrsltd.bits` (the Bits++
+header+LUT row), :mod:`pycrsltd.shaders` and :mod:`pycrsltd.encode`, so they
+can be used to check what was actually sent to the display, e.g. from
+`glReadPixels()` or `BitsSharp.getVideoLine()`.
+
+Framebuffer images are arrays of R,G,B values (uint8 or int) and can be a
+single image or a stack of images (any number of leading dimensions).
+
+NB glReadPixels() returns the rows bottom-to-top, so the Bits++ header+LUT
+row (the top line of the screen) is the last row of the array it returns.
+"""
+
+__docformat__ = "restructuredtext en"
+
+import numpy
+from encode import bitsPlusPlusHeader
+
+def _shiftedOr(hiBytes, loBytes, out):
+    """(private) out = hiBytes<<8 | loBytes, without intermediate arrays
+    """
+    numpy.left_shift(hiBytes, 8, out=out, dtype=numpy.uint16, casting='unsafe')
+    numpy.bitwise_or(out, loBytes, out=out, casting='unsafe')
+    return out
+
+def isBitsPlusPlusRow(row):
+    """Returns True (or an array of True/False for a stack) where `row`
+    starts with the bits++ header that tells the box a LUT follows
+
+    :Parameters:
+        row : array (..., nPixels, 3), e.g. one line of the screen
+    """
+    row = numpy.asarray(row)
+    if row.shape[-2]<524:
+        return numpy.zeros(row.shape[:-2], bool)
+    return (row[...,:12,:]==bitsPlusPlusHeader).all(axis=-1).all(axis=-1)
+
+def bitsPlusPlusLUT(row, out=None, checkHeader=True):
+    """Decode the LUT from a bits++ header+LUT row (or stack of rows)
+
+    :Parameters:
+        row : array (..., nPixels, 3) of the screen line, where nPixels>=524
+        out : optional uint16 array (..., 256, 3) for the result
+        checkHeader : if True then raise a ValueError when the row doesn't
+            start with the bits++ header
+
+    :return: the LUT as uint16 values in an array (..., 256, 3)
+    """
+    row = numpy.asarray(row)
+    if checkHeader and not numpy.all(isBitsPlusPlusRow(row)):
+        raise ValueError("The row does not start with the bits++ header+LUT")
+    if out is None:
+        out = numpy.empty(row.shape[:-2]+(256,3), numpy.uint16)
+    #the LUT follows the 12-pixel header as pairs of pixels (MSB then LSB)
+    return _shiftedOr(row[...,12:524:2,:], row[...,13:524:2,:], out)
+
+def monoPlusPlus(image, out=None):
+    """Decode a Mono++ image (or stack of images) into 16-bit luminance values
+    (8 most significant bits in red and 8 least significant bits in green)
+
+    :Parameters:
+        image : array (..., height, width, 3)
+        out : optional uint16 array (..., height, width) for the result
+
+    :return: uint16 array (..., height, width)
+    """
+    image = numpy.asarray(image)
+    if out is None:
+        out = numpy.empty(image.shape[:-1], numpy.uint16)
+    return _shiftedOr(image[...,0], image[...,1], out)
+
+def colorPlusPlus(image, out=None):
+    """Decode a Color++ image (or stack of images) into 16-bit R,G,B values.
+    Each pair of pixels has the high bytes in the even pixel and the low bytes
+    in the odd pixel, so the decoded image is half the width.
+
+    :Parameters:
+        image : array (..., height, width, 3), with an even width
+        out : optional uint16 array (..., height, width/2, 3) for the result
+
+    :return: uint16 array (..., height, width/2, 3)
+    """
+    image = numpy.asarray(image)
+    if image.shape[-2]%2:
+        raise ValueError("Color++ images should have an even number of columns")
+    if out is None:
+        out = numpy.empty(image.shape[:-2]+(image.shape[-2]//2,3), numpy.uint16)
+    return _shiftedOr(image[...,0::2,:], image[...,1::2,:], out)
@@ -0,0 +1,478 @@
+#!/usr/bin/env python
+#coding=utf-8
+
+# Copyright (c) Cambridge Research Systems (CRS) Ltd
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+"""Encode images for Mono++ and Color++ modes on the CPU (using numpy).
+
+These produce the same 8-bit RGB framebuffer contents as the shaders in
+:mod:`pycrsltd.shaders` (including the gamma correction stage of
+`gammaCorrectionFrag`) so they can be used to pre-encode stimuli offline, or
+on a machine without a suitable graphics card.
+
+Images are float arrays with values 0.0:1.0 and can be a single image or a
+stack of images (any number of leading dimensions). Large stacks are
+processed in chunks of frames so that the temporary arrays stay small.
+
+Note that, as for the screen, the first row of the array is just the first
+row of the image (the encodings act on each row independently).
+"""
+
+__docformat__ = "restructuredtext en"
+
+import time
+import multiprocessing
+import numpy
+from numpy.lib.format import open_memmap
+try:
+    from psychopy import logging
+except:
+    import logging
+
+#standardised names for the modes (as used by BitsBox)
+modeNames = {'bits':'bits++', 'bits++':'bits++',
+             'color':'color++', 'color++':'color++',
+             'colour':'color++', 'colour++':'color++',
+             'mono':'mono++', 'mono++':'mono++',
+             }
+
+#the 12 pixels (R,G,B) that precede the LUT to tell bits++ that a LUT follows
+bitsPlusPlusHeader = numpy.array([[ 36, 106, 133],
+                                  [ 63, 136, 163],
+                                  [  8,  19, 138],
+                                  [211,  25,  46],
+                                  [  3, 115, 164],
+                                  [112,  68,   9],
+                                  [ 56,  41,  49],
+                                  [ 34, 159, 208],
+                                  [  0,   0,   0],
+                                  [  0,   0,   0],
+                                  [  0,   0,   0],
+                                  [  0,   0,   0]], numpy.uint8)
+
+#default values for the gamma correction (no correction), which are also the
+#defaults of the shaders' uniforms (shaders.ICMdefaults)
+defaultGammaParams = {'encodingGamma': (1.0, 1.0, 1.0),
+                      'minInLuminance': (0.0, 0.0, 0.0),
+                      'maxInLuminance': (1.0, 1.0, 1.0),
+                      'outputGain': (1.0, 1.0, 1.0),
+                      'outputBias': (0.0, 0.0, 0.0),
+                      'clampToColorRange': (0.0, 1.0),
+                      }
+
+def _gammaParams(params, channel=None):
+    """(private) Returns the complete set of gamma correction parameters (as
+    arrays) from the defaults updated with `params`. If `channel` is given then
+    only that channel of each (R,G,B) parameter is used, like gammaCorrect1()
+    """
+    params = dict(params)
+    gammaTable = params.pop('gammaTable', None)
+    for key in params:
+        if key not in defaultGammaParams:
+            raise TypeError("Unknown gamma correction parameter '%s'" %key)
+    allParams = dict(defaultGammaParams)
+    allParams.update(params)
+    for key in allParams:
+        val = numpy.asarray(allParams[key], 'd')
+        if key!='clampToColorRange':
+            if val.size==1:
+                val = val.repeat(3)
+            if channel is not None:
+                val = val[channel]
+        allParams[key] = val
+    if gammaTable is not None:
+        #the shader's table is a 16-bit float texture, so round to that precision
+        gammaTable = numpy.asarray(gammaTable, numpy.float16).astype('d')
+        if gammaTable.ndim==1:
+            gammaTable = gammaTable[:,None].repeat(3, axis=1)
+        if channel is not None:
+            gammaTable = gammaTable[:,channel]
+    allParams['gammaTable'] = gammaTable
+    return allParams
+
+def _gammaCorrect(values, out, params):
+    """(private) The gamma correction stage of the shaders, written into `out`
+    (a float array) using the complete, preprocessed `params`
+    """
+    if params['gammaTable'] is not None:
+        return _lookupGamma(values, out, params['gammaTable'])
+    minLum, maxLum = params['minInLuminance'], params['maxInLuminance']
+    #clamp input to valid [minInLuminance, maxInLuminance] range (which is
+    #reversed for inverted contrast) and normalise
+    numpy.clip(values, numpy.minimum(minLum, maxLum), numpy.maximum(minLum, maxLum), out=out)
+    out -= minLum
+    out *= 1.0/(maxLum-minLum)
+    #map through power function with gamma coeff (unless it has no effect)
+    if numpy.any(params['encodingGamma']!=1.0):
+        numpy.power(out, params['encodingGamma'], out=out)
+    out *= params['outputGain']
+    out += params['outputBias']
+    #clamp output to range given by clampToColorRange
+    numpy.clip(out, params['clampToColorRange'][0], params['clampToColorRange'][1], out=out)
+    return out
+
+def _lookupGamma(values, out, table):
+    """(private) The gamma correction of `shaders.gammaCorrectionLUTFrag`:
+    values (clamped to 0.0:1.0) are linearly interpolated from the evenly
+    spaced entries of `table` (n or n x nChannels, matching values)
+    """
+    xs = numpy.linspace(0.0, 1.0, len(table))
+    if table.ndim==1:
+        out[...] = numpy.interp(values, xs, table)
+    else:
+        for chanN in range(table.shape[1]):
+            out[...,chanN] = numpy.interp(values[...,chanN], xs, table[:,chanN])
+    return out
+
+def gammaCorrect(image, out=None, **gammaParams):
+    """Apply the gamma correction of `shaders.gammaCorrectionFrag` (the
+    gammaCorrect3() function) to an RGB image, or stack of images::
+
+        out = bias + gain * ( ( (in - Lmin) / (Lmax - Lmin) ) ^ Gamma )
+
+    clamped to the range `clampToColorRange`.
+
+    :Parameters:
+        image : float array whose last dimension is R,G,B
+        out : optional float array (same shape as image) for the result
+        encodingGamma, minInLuminance, maxInLuminance, outputGain, outputBias :
+            each a float or (R,G,B), the same as the uniforms of the shader
+            (but without the 'ICM' prefix)
+        clampToColorRange : (min, max) of the output
+        gammaTable : optional n or n x 3 array (e.g. a measured inverse gamma
+            table) to use instead of all the parameters above, like
+            `shaders.gammaCorrectionLUTFrag`. Input values 0.0:1.0 are
+            interpolated linearly between its entries
+
+    :return: the gamma-corrected image (`out` if that was given)
+    """
+    image = numpy.asarray(image)
+    if out is None:
+        out = numpy.empty(image.shape, 'd')
+    return _gammaCorrect(image[...,:3], out, _gammaParams(gammaParams))
+
+def packLUT(LUT, out, scratch=None):
+    """Pack a LUT of floats (0.0:1.0, final dims nx3) into 16-bit
+    values, stored as interleaved most/least significant bytes in `out`
+    (uint8, final dims 2nx3), which is how bits++ expects to read them.
+
+    If given, `scratch` (uint16, same shape as LUT) is used for the 16-bit
+    values, so that no temporary arrays are needed.
+    """
+    if scratch is None:
+        scratch = numpy.empty(LUT.shape, numpy.uint16)
+    numpy.multiply(LUT, 2**16-1, out=scratch, casting='unsafe') #go from float to uint16
+    #set most significant bits
+    numpy.right_shift(scratch, 8, out=out[...,0::2,:], casting='unsafe')
+    #set least significant bits
+    numpy.bitwise_and(scratch, 255, out=out[...,1::2,:], casting='unsafe')
+
+def bitsPlusPlusLUT(LUT, out=None):
+    """Create the bits++ header+LUT row(s) for a LUT (or stack of LUTs), as
+    drawn on the top line of the screen by BitsBox in bits++ mode
+
+    :Parameters:
+        LUT : float array (..., 256, 3) with values 0.0:1.0
+        out : optional uint8 array (..., 524, 3) for the result
+
+    :return: uint8 array (..., 524, 3)
+    """
+    LUT = numpy.asarray(LUT, 'd')
+    if out is None:
+        out = numpy.empty(LUT.shape[:-2]+(524,3), numpy.uint8)
+    out[...,:12,:] = bitsPlusPlusHeader
+    packLUT(LUT, out[...,12:,:])
+    return out
+
+def moduloLUT(nEntries=256):
+    """The entries of the `moduloLUT` texture used by `shaders.bitsMonoModeFrag`
+    (as uint8, i.e. the texture's values are these/255).
+
+    The shader looks up the fractional part of (16-bit value)/256 in this
+    (nearest-neighbour) texture to get the low byte of the value, so texel i
+    holds floor(i*256/nEntries), which is just i for the usual 256 entries.
+    """
+    return (numpy.arange(nEntries)*256//nEntries).astype(numpy.uint8)
+
+def _asFrames(arr, frameDims):
+    """(private) Returns a view of `arr` as a stack of frames (with a single
+    leading dimension) without copying. Raises ValueError if that would need
+    a copy, because writing to a copy would lose the results.
+    """
+    frames = arr.view()
+    try:
+        frames.shape = (-1,)+arr.shape[len(arr.shape)-frameDims:]
+    except AttributeError:
+        raise ValueError("The `out` array must be contiguous so that it can be written in chunks")
+    return frames
+
+def monoPlusPlus(image, out=None, chunkSize=16, **gammaParams):
+    """Encode a luminance image (or stack of images) for Mono++ mode, as the
+    `shaders.bitsMonoModeFrag` shader does (including its gamma correction,
+    the `gammaCorrect1` function of `gammaCorrectionFrag`).
+
+    The 16-bit luminance is stored with the 8 most significant bits in the red
+    channel and 8 least significant bits in the green channel. Blue is 0.
+
+    :Parameters:
+        image : float array (..., height, width) with values 0.0:1.0
+            (for an RGB image pass just its red channel, `image[...,0]`, as
+            that is what the shader uses)
+        out : optional uint8 array (..., height, width, 3) for the result
+        chunkSize : int, the number of frames encoded at a time
+        gamma correction parameters : as for :func:`gammaCorrect` but only
+            the first (red) value of each is used, like the shader
+
+    :return: the encoded uint8 array (`out` if that was given)
+    """
+    image = numpy.asarray(image)
+    if out is None:
+        out = numpy.empty(image.shape+(3,), numpy.uint8)
+    elif out.shape!=image.shape+(3,):
+        raise ValueError("`out` should have shape %s not %s" %(image.shape+(3,), out.shape))
+    params = _gammaParams(gammaParams, channel=0)
+    frames = image.reshape((-1,)+image.shape[-2:])
+    outFrames = _asFrames(out, 3)
+
+    #preallocate the buffers for one chunk
+    lums = numpy.empty((min(chunkSize, len(frames)),)+frames.shape[1:], 'd')
+    lums16 = numpy.empty(lums.shape, numpy.uint16)
+    for startN in range(0, len(frames), chunkSize):
+        chunk = frames[startN:startN+chunkSize]
+        theseLums, these16 = lums[:len(chunk)], lums16[:len(chunk)]
+        thisOut = outFrames[startN:startN+len(chunk)]
+        _gammaCorrect(chunk, theseLums, params)
+        #remap 0.0:1.0 to 0:65535 (the moduloLUT in the shader truncates)
+        theseLums *= 65535.0
+        numpy.floor(theseLums, out=theseLums)
+        these16[:] = theseLums
+        #high byte (8 MSBs) in red, low byte (8 LSBs) in green, blue is 0
+        numpy.right_shift(these16, 8, out=thisOut[...,0], casting='unsafe')
+        numpy.bitwise_and(these16, 255, out=thisOut[...,1], casting='unsafe')
+        thisOut[...,2] = 0
+    return out
+
+def colorPlusPlus(image, out=None, sampleSpacing=1.0, chunkSize=16, **gammaParams):
+    """Encode an RGB image (or stack of images) for Color++ mode, as the
+    `shaders.bitsColorModeFrag` shader would.
+
+    Each 16-bit color value is split into its 8 most significant bits, stored
+    in an even pixel, and its 8 least significant bits, stored in the
+    following (odd) pixel. So each pair of output pixels is a single Color++
+    pixel, read from column `floor(2*pairN*sampleSpacing)` of the image.
+
+    :Parameters:
+        image : float array (..., height, width, 3 or 4) with values 0.0:1.0
+        out : optional uint8 array (..., height, outWidth, 3) for the result.
+            By default outWidth is just wide enough to use every sampled
+            column (the same width as the image, for sampleSpacing=1.0)
+        sampleSpacing : float
+            as the shader uniform; 1.0 uses every other column of the image
+            and 0.5 uses every column, doubling the width of the output
+        chunkSize : int, the number of frames encoded at a time
+        gamma correction parameters : as for :func:`gammaCorrect`
+
+    :return: the encoded uint8 array (`out` if that was given)
+    """
+    image = numpy.asarray(image)
+    height, width = image.shape[-3:-1]
+    if out is None:
+        nPairs = int(numpy.ceil(width/(2.0*sampleSpacing)))
+        out = numpy.empty(image.shape[:-2]+(2*nPairs, 3), numpy.uint8)
+    elif out.shape[:-2]!=image.shape[:-2] or out.shape[-1]!=3 or out.shape[-2]%2:
+        raise ValueError("`out` should have shape %s (with an even width), not %s"
+                         %(image.shape[:-2]+('outWidth', 3), out.shape))
+    nPairs = out.shape[-2]//2
+    srcCols = numpy.floor(numpy.arange(nPairs)*2*sampleSpacing).astype(int)
+    if srcCols[-1]>=width:
+        raise ValueError("The image is too narrow for %i pixel pairs with sampleSpacing=%s" %(nPairs, sampleSpacing))
+    params = _gammaParams(gammaParams)
+    frames = image.reshape((-1,)+image.shape[-3:])
+    outFrames = _asFrames(out, 3)
+
+    #preallocate the buffers for one chunk
+    colors = numpy.empty((min(chunkSize, len(frames)), height, nPairs, 3), 'd')
+    colors16 = numpy.empty(colors.shape, numpy.uint16)
+    for startN in range(0, len(frames), chunkSize):
+        chunk = frames[startN:startN+chunkSize]
+        theseColors, these16 = colors[:len(chunk)], colors16[:len(chunk)]
+        thisOut = outFrames[startN:startN+len(chunk)]
+        _gammaCorrect(chunk[:,:,srcCols,:3], theseColors, params)
+        #remap 0.0:1.0 to 0:65535, with rounding
+        theseColors *= 65535.0
+        theseColors += 0.5
+        numpy.floor(theseColors, out=theseColors)
+        these16[:] = theseColors
+        #high bytes in even pixels, low bytes in odd pixels
+        numpy.right_shift(these16, 8, out=thisOut[:,:,0::2,:], casting='unsafe')
+        numpy.bitwise_and(these16, 255, out=thisOut[:,:,1::2,:], casting='unsafe')
+    return out
+
+def bitsPlusPlus(image, out=None, LUT=None, chunkSize=16):
+    """Encode an RGB image (or stack of images) for bits++ mode, where each
+    8-bit value is an index into the LUT of the box.
+
+    :Parameters:
+        image : float array (..., height, width, 3 or 4) with values 0.0:1.0
+            (these are rounded to the nearest of the 256 LUT entries)
+        out : optional uint8 array (..., height, width, 3) for the result
+        LUT : optional float LUT (256x3) or header+LUT row (524x3 uint8) to
+            write over the top line of each image (which must be at least 524
+            pixels wide)
+        chunkSize : int, the number of frames encoded at a time
+
+    :return: the encoded uint8 array (`out` if that was given)
+    """
+    image = numpy.asarray(image)
+    if out is None:
+        out = numpy.empty(image.shape[:-1]+(3,), numpy.uint8)
+    elif out.shape!=image.shape[:-1]+(3,):
+        raise ValueError("`out` should have shape %s not %s" %(image.shape[:-1]+(3,), out.shape))
+    frames = image.reshape((-1,)+image.shape[-3:])
+    outFrames = _asFrames(out, 3)
+    if LUT is not None:
+        LUT = numpy.asarray(LUT)
+        if LUT.shape!=(524,3):
+            LUT = bitsPlusPlusLUT(LUT)
+
+    indices = numpy.empty((min(chunkSize, len(frames)),)+frames.shape[1:-1]+(3,), 'd')
+    for startN in range(0, len(frames), chunkSize):
+        chunk = frames[startN:startN+chunkSize]
+        theseIndices = indices[:len(chunk)]
+        thisOut = outFrames[startN:startN+len(chunk)]
+        numpy.clip(chunk[...,:3], 0.0, 1.0, out=theseIndices)
+        theseIndices *= 255.0
+        theseIndices += 0.5
+        numpy.floor(theseIndices, out=theseIndices)
+        thisOut[:] = theseIndices
+        if LUT is not None:
+            thisOut[:,0,:524,:] = LUT
+    return out
+
+def encodeFrames(frames, mode, out=None, chunkSize=16, **kwargs):
+    """Encode an image (or stack of images) for any of the BitsBox modes
+    ('bits++', 'mono++' or 'color++'), by calling :func:`bitsPlusPlus`,
+    :func:`monoPlusPlus` or :func:`colorPlusPlus`. Mono++ uses the red channel
+    of RGB frames.
+
+    Other keyword arguments are passed on to the encoding function.
+    """
+    mode = modeNames.get(mode, mode)
+    if mode=='bits++':
+        return bitsPlusPlus(frames, out=out, chunkSize=chunkSize, **kwargs)
+    elif mode=='mono++':
+        return monoPlusPlus(frames[...,0], out=out, chunkSize=chunkSize, **kwargs)
+    elif mode=='color++':
+        return colorPlusPlus(frames, out=out, chunkSize=chunkSize, **kwargs)
+    else:
+        raise ValueError("Unknown mode '%s', should be one of %s" %(mode, sorted(modeNames)))
+
+def encodedShape(frameShape, mode, sampleSpacing=1.0):
+    """Returns the shape of the encoded version of an RGB image (or stack)
+    of shape `frameShape` (..., height, width, 3) in the given mode
+    """
+    mode = modeNames.get(mode, mode)
+    if mode=='color++':
+        nPairs = int(numpy.ceil(frameShape[-2]/(2.0*sampleSpacing)))
+        return tuple(frameShape[:-2])+(2*nPairs, 3)
+    return tuple(frameShape[:-1])+(3,)
+
+def _openFrames(source):
+    """(private) Returns the frames from `source` as an array, where source is
+    a filename (of a .npy file, memory-mapped) or the array itself
+    """
+    if isinstance(source, basestring):
+        return numpy.load(source, mmap_mode='r')
+    return source
+
+def _encodeMovieChunk(args):
+    """(private) Encode frames startN:endN of a movie straight into the
+    memory-mapped output file (run in the worker processes of encodeMovie)
+    """
+    source, filename, startN, endN, mode, chunkSize, kwargs = args
+    if isinstance(source, basestring):
+        frames = numpy.load(source, mmap_mode='r')[startN:endN]
+    else:
+        frames = source #we were sent just these frames
+    movie = numpy.load(filename, mmap_mode='r+')
+    encodeFrames(frames, mode, out=movie[startN:endN], chunkSize=chunkSize, **kwargs)
+    movie.flush()
+    return endN-startN
+
+def encodeMovie(frames, filename, mode, nProcesses=None, framesPerTask=64,
+                chunkSize=16, **kwargs):
+    """Encode a long movie (a stack of RGB frames) for one of the BitsBox
+    modes, splitting the frames across a pool of processes. The encoded
+    frames are written straight into a memory-mapped .npy file, so the
+    movie never needs to fit in memory.
+
+    :Parameters:
+        frames : float array (nFrames, height, width, 3) with values 0.0:1.0,
+            or the filename of a .npy file holding one. Workers read
+            directly from the file, but an array has to be sent to them.
+        filename : the .npy file for the encoded movie (uint8)
+        mode : 'bits++', 'mono++' or 'color++'
+        nProcesses : number of worker processes (default is one per CPU).
+            With nProcesses=1 the movie is encoded in this process.
+        framesPerTask : number of frames given to a worker at a time
+        chunkSize : number of frames encoded at once by each worker
+        other keyword arguments : passed to :func:`encodeFrames`
+            (e.g. the gamma correction or sampleSpacing)
+
+    :return: (movie, framesPerSec) where movie is the encoded frames as a
+        read-only memory-mapped array
+
+    **Example**::
+
+        movie, fps = encode.encodeMovie('gratings.npy', 'gratingsMono.npy', 'mono++')
+
+    """
+    t0 = time.time()
+    if modeNames.get(mode, mode) not in modeNames.values():
+        raise ValueError("Unknown mode '%s', should be one of %s" %(mode, sorted(modeNames)))
+    theseFrames = _openFrames(frames)
+    nFrames = len(theseFrames)
+    outShape = encodedShape(theseFrames.shape, mode, kwargs.get('sampleSpacing', 1.0))
+    movie = open_memmap(filename, mode='w+', dtype=numpy.uint8, shape=outShape)
+    del movie #workers open it themselves
+
+    if isinstance(frames, basestring):
+        tasks = [(frames, filename, startN, min(startN+framesPerTask, nFrames),
+                  mode, chunkSize, kwargs) for startN in range(0, nFrames, framesPerTask)]
+    else:
+        tasks = [(theseFrames[startN:startN+framesPerTask], filename, startN,
+                  min(startN+framesPerTask, nFrames), mode, chunkSize, kwargs)
+                 for startN in range(0, nFrames, framesPerTask)]
+    if nProcesses==1:
+        for task in tasks:
+            _encodeMovieChunk(task)
+    else:
+        pool = multiprocessing.Pool(nProcesses)
+        try:
+            for nDone in pool.imap_unordered(_encodeMovieChunk, tasks):
+                pass
+        finally:
+            pool.close()
+            pool.join()
+
+    framesPerSec = nFrames/(time.time()-t0)
+    logging.info("Encoded %i frames for %s mode at %.1f frames/sec" %(nFrames, mode, framesPerSec))
+    return numpy.load(filename, mmap_mode='r'), framesPerSec
@@ -32,11 +32,18 @@
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
 # THE SOFTWARE.
 
+import os, hashlib, struct
+import numpy
 from ctypes import *
 from pyglet import gl
-
-FRAG = gl.GL_FRAGMENT_SHADER_ARB
-VERT = gl.GL_VERTEX_SHADER_ARB
+import encode
+try:
+    from psychopy import logging
+except:
+    import logging
+
+FRAG = gl.GL_FRAGMENT_SHADER
+VERT = gl.GL_VERTEX_SHADER
 shaderTypes=[FRAG, VERT]
 
 class ShaderCode:
@@ -47,7 +54,8 @@ class ShaderCode:
         else:
             self.type=shaderType
 
-def compileProgram(vertex=None, fragment=None, attachments=[]):
+def compileProgram(vertex=None, fragment=None, attachments=[], binaryRetrievable=False,
+                   compiledAttachments=None):
     """Create and compile a vertex and fragment shader pair from their sources (strings)
 
     Usage::
@@ -59,6 +67,12 @@ def compileProgram(vertex=None, fragment=None, attachments=[]):
         - vertex is the main vertex shader source (or ShaderCode object)
         - fragment is the main fragment shader source (or ShaderCode object)
         - attachments is a list of ShaderCode objects, with valid shaderType set
+        - binaryRetrievable tells the driver that we'll want the binary of
+          the linked program (see :func:`getProgram`)
+        - compiledAttachments is an optional dict of attachments that have
+          already been compiled, {source: shader}. Attachments are taken from
+          it (or compiled and added to it) and are not deleted with the
+          program, so they can be shared by several programs
 
     """
 
@@ -67,18 +81,18 @@ def compileProgram(vertex=None, fragment=None, attachments=[]):
 
     def compileShader( source, shaderType ):
             """Compile shader source of given type (only needed by compileProgram)"""
-            shader = gl.glCreateShaderObjectARB(shaderType)
+            shader = gl.glCreateShader(shaderType)
 
             #were we given a source string or a ShaderCode object?
             if hasattr(source, 'src'): source = source.src
 
             prog = c_char_p(source)
             length = c_int(-1)
-            gl.glShaderSourceARB(shader,
+            gl.glShaderSource(shader,
                               1,
                               cast(byref(prog), POINTER(POINTER(c_char))),
                               byref(length))
-            gl.glCompileShaderARB(shader)
+            gl.glCompileShader(shader)
 
             #check for errors
             status = c_int()
@@ -89,35 +103,427 @@ def compileProgram(vertex=None, fragment=None, attachments=[]):
                 # create a buffer for the log
                 buffer = create_string_buffer(status.value)#from ctypes
                 # retrieve the log text
-                gl.glGetProgramInfoLog(shader, status, None, buffer)
+                gl.glGetShaderInfoLog(shader, status, None, buffer)
                 # print the log to the console
                 print buffer.value
                 gl.glDeleteShader(shader)
                 raise ValueError, 'Shader compilation failed'
             return shader
 
-    program = gl.glCreateProgramObjectARB()
+    program = gl.glCreateProgram()
 
     #compile attachments before main vertex and frag progs
+    compiled = []
     for thisAttachment in attachments:
-        attachment = compileShader(thisAttachment, thisAttachment.type)
-        gl.glAttachObjectARB(program, attachment)
+        if compiledAttachments is None:
+            compiled.append(compileShader(thisAttachment, thisAttachment.type))
+            continue
+        if thisAttachment.src not in compiledAttachments:
+            compiledAttachments[thisAttachment.src] = compileShader(thisAttachment, thisAttachment.type)
+        gl.glAttachShader(program, compiledAttachments[thisAttachment.src])
     if vertex:
-            vertexShader = compileShader(vertex, VERT)
-            gl.glAttachObjectARB(program, vertexShader)
+            compiled.append(compileShader(vertex, VERT))
     if fragment:
-            fragmentShader = compileShader(fragment, FRAG)
-            gl.glAttachObjectARB(program, fragmentShader)
+            compiled.append(compileShader(fragment, FRAG))
+    for shader in compiled:
+        gl.glAttachShader(program, shader)
     #compile the overall program
-    gl.glValidateProgramARB( program )
-    gl.glLinkProgramARB(program)
-    #cleanup
-    if vertex:
-            gl.glDeleteObjectARB(vertexShader)
-    if fragment:
-            gl.glDeleteObjectARB(fragmentShader)
+    if binaryRetrievable:
+        gl.glProgramParameteri(program, gl.GL_PROGRAM_BINARY_RETRIEVABLE_HINT, gl.GL_TRUE)
+    gl.glLinkProgram(program)
+    #cleanup (the shaders are freed along with the program)
+    for shader in compiled:
+        gl.glDeleteShader(shader)
+    status = c_int()
+    gl.glGetProgramiv(program, gl.GL_LINK_STATUS, byref(status))
+    if not status.value:
+        gl.glGetProgramiv(program, gl.GL_INFO_LOG_LENGTH, byref(status))
+        buffer = create_string_buffer(status.value)
+        gl.glGetProgramInfoLog(program, status, None, buffer)
+        print buffer.value
+        gl.glDeleteProgram(program)
+        raise ValueError, 'Shader program failed to link'
     return program
 
+class UniformState(object):
+    """The values of the uniforms of one shader program, kept in python so that
+    they can be changed cheaply at any time. The uniform locations are only
+    looked up once, and only the values that have changed are sent to OpenGL
+    by :meth:`flush` (which needs the program to be in use)::
+
+        state = UniformState(prog, sampleSpacing=1.0)
+        state.setGammaParams(encodingGamma=1/2.2)
+        ...
+        gl.glUseProgram(prog)
+        state.flush()
+
+    Values are floats or sequences of 1-4 floats (set with glUniform1f..4f),
+    or ints (e.g. for samplers, set with glUniform1i..4i).
+
+    Programs from :func:`getProgram` are shared, so several UniformStates
+    (e.g. those of two BitsBoxes) can hold values for the same program. The
+    share group records which of them last flushed each program, and if that
+    wasn't this one then all of this one's values are sent, not just those
+    that changed.
+    """
+    def __init__(self, program, **values):
+        self.program = program
+        self._locations = {}
+        self._values = {}
+        self._dirty = set()
+        self.update(values)
+    def location(self, name):
+        """The location of the uniform `name` in the program (-1 if it isn't
+        used by the program), only asking OpenGL the first time
+        """
+        if name not in self._locations:
+            self._locations[name] = gl.glGetUniformLocation(self.program, c_char_p(name))
+        return self._locations[name]
+    def __getitem__(self, name):
+        return self._values[name]
+    def __setitem__(self, name, value):
+        if not hasattr(value, '__len__'):
+            value = (value,)
+        if all([isinstance(val, (int, long)) for val in value]):
+            value = tuple([int(val) for val in value])
+        else:
+            value = tuple([float(val) for val in value])
+        if self._values.get(name) != value:
+            self._values[name] = value
+            self._dirty.add(name)
+    def update(self, values={}, **kwargs):
+        """Set several uniforms at once (like dict.update)
+        """
+        for name, value in values.items()+kwargs.items():
+            self[name] = value
+    def setGammaParams(self, **gammaParams):
+        """Set the ICM* uniforms of :data:`gammaCorrectionFrag`. The parameters
+        have the same names as for :func:`pycrsltd.encode.gammaCorrect`
+        (e.g. encodingGamma, minInLuminance...) and any not given are unchanged.
+        ICMReciprocalLuminanceRange follows from the min and max luminances.
+        """
+        for key, val in gammaParams.items():
+            if key not in ICMdefaults:
+                raise TypeError("Unknown gamma correction parameter '%s'" %key)
+            if key!='clampToColorRange' and not hasattr(val, '__len__'):
+                val = (val, val, val)
+            val = [float(thisVal) for thisVal in val]
+            self['ICM'+key[0].upper()+key[1:]] = val
+        minLum = self._values.get('ICMMinInLuminance', ICMdefaults['minInLuminance'])
+        maxLum = self._values.get('ICMMaxInLuminance', ICMdefaults['maxInLuminance'])
+        self['ICMReciprocalLuminanceRange'] = [1.0/(hi-lo) for lo, hi in zip(minLum, maxLum)]
+    def flush(self):
+        """Send any changed values to OpenGL (the program must be in use)
+        """
+        owners = getShareGroup().uniformOwners
+        if owners.get(self.program) is self:
+            names = self._dirty
+        else:
+            #another UniformState has set this program's uniforms since
+            names = self._values.keys()
+            owners[self.program] = self
+        for name in names:
+            loc = self.location(name)
+            if loc < 0:
+                continue
+            value = self._values[name]
+            if isinstance(value[0], int):
+                _glUniformNi[len(value)](loc, *value)
+            else:
+                _glUniformNf[len(value)](loc, *value)
+        self._dirty.clear()
+
+_glUniformNf = {1: gl.glUniform1f, 2: gl.glUniform2f, 3: gl.glUniform3f, 4: gl.glUniform4f}
+_glUniformNi = {1: gl.glUniform1i, 2: gl.glUniform2i, 3: gl.glUniform3i, 4: gl.glUniform4i}
+
+class GammaLUTTexture(object):
+    """A 1D texture holding a gamma table (e.g. a measured inverse gamma) for
+    :data:`gammaCorrectionLUTFrag`. It is uploaded once, when created, and
+    :meth:`update` replaces all or part of it with a single sub-image upload.
+
+    The entries are 16-bit floats by default (internalFormat=GL_RGB16F), which
+    keeps 11 significant bits. Use gl.GL_RGB16 for exact 16-bit (unsigned
+    normalised) entries if the card supports linear filtering of those.
+
+    Needs the OpenGL context current (on creation and for update/bind).
+    """
+    def __init__(self, table, internalFormat=gl.GL_RGB16F):
+        table = self._asTable(table)
+        self.size = len(table)
+        self.internalFormat = internalFormat
+        texture = c_uint()
+        gl.glGenTextures(1, byref(texture))
+        self.id = texture.value
+        gl.glBindTexture(gl.GL_TEXTURE_1D, self.id)
+        #linear interpolation between entries (clamped to the first and last)
+        gl.glTexParameteri(gl.GL_TEXTURE_1D, gl.GL_TEXTURE_MIN_FILTER, gl.GL_LINEAR)
+        gl.glTexParameteri(gl.GL_TEXTURE_1D, gl.GL_TEXTURE_MAG_FILTER, gl.GL_LINEAR)
+        gl.glTexParameteri(gl.GL_TEXTURE_1D, gl.GL_TEXTURE_WRAP_S, gl.GL_CLAMP_TO_EDGE)
+        gl.glTexImage1D(gl.GL_TEXTURE_1D, 0, internalFormat, self.size, 0,
+                        gl.GL_RGB, gl.GL_FLOAT, table.ctypes.data)
+        gl.glBindTexture(gl.GL_TEXTURE_1D, 0)
+    def _asTable(self, table):
+        """(private) Returns the table as contiguous float32 RGB entries
+        """
+        table = numpy.asarray(table, numpy.float32)
+        if table.ndim==1:
+            table = table[:,None].repeat(3, axis=1)
+        return numpy.ascontiguousarray(table)
+    def update(self, table, start=0):
+        """Replace the entries from `start` with `table` (n or n x 3)
+        """
+        table = self._asTable(table)
+        if start<0 or start+len(table)>self.size:
+            raise ValueError("Gamma table entries %i:%i don't fit in a table of %i"
+                             %(start, start+len(table), self.size))
+        gl.glBindTexture(gl.GL_TEXTURE_1D, self.id)
+        gl.glTexSubImage1D(gl.GL_TEXTURE_1D, 0, start, len(table),
+                           gl.GL_RGB, gl.GL_FLOAT, table.ctypes.data)
+        gl.glBindTexture(gl.GL_TEXTURE_1D, 0)
+    def bind(self, unit=2):
+        """Bind the texture to texture `unit` (leaving unit 0 active)
+        """
+        gl.glActiveTexture(gl.GL_TEXTURE0+unit)
+        gl.glBindTexture(gl.GL_TEXTURE_1D, self.id)
+        gl.glActiveTexture(gl.GL_TEXTURE0)
+    def delete(self):
+        """Free the texture (it can't be used after this)
+        """
+        if self.id:
+            gl.glDeleteTextures(1, byref(c_uint(self.id)))
+            self.id = 0
+
+#the default parameters of gammaCorrectionFrag (no correction), which are
+#also those of the CPU encoders
+ICMdefaults = encode.defaultGammaParams
+
+class ShareGroup(object):
+    """The OpenGL objects (programs, shared textures and compiled attachments)
+    that can be used by all the contexts of one share group, e.g. the windows
+    for several Bits boxes. Each object has a reference count and is deleted
+    when the last user releases it (see :func:`getProgram`,
+    :func:`getModuloLUTtexture` and :func:`release`).
+
+    Use :func:`getShareGroup` rather than creating these directly.
+    """
+    def __init__(self, key):
+        self.key = key
+        self.objects = {} #(kind, name): the OpenGL id
+        self.refCounts = {} #(kind, name): number of users
+        self.compiledAttachments = {} #source: shader (see compileProgram)
+        self.uniformOwners = {} #program: the UniformState that last flushed it
+    def acquire(self, kind, name, create):
+        """Returns the id of the object of this kind ('program' or 'texture')
+        and name, calling create() to make it if it doesn't exist yet, and
+        adds a reference to it
+        """
+        if (kind, name) not in self.objects:
+            self.objects[(kind, name)] = create()
+            self.refCounts[(kind, name)] = 0
+        self.refCounts[(kind, name)] += 1
+        return self.objects[(kind, name)]
+    def release(self, kind, glId):
+        """Removes a reference to an object (by its kind and OpenGL id),
+        deleting it if that was the last one. Returns False if the object
+        isn't from this share group
+        """
+        for thisKind, name in self.objects.keys():
+            if thisKind==kind and self.objects[(kind, name)]==glId:
+                break
+        else:
+            return False
+        self.refCounts[(kind, name)] -= 1
+        if self.refCounts[(kind, name)] > 0:
+            return True
+        del self.objects[(kind, name)], self.refCounts[(kind, name)]
+        if kind == 'program':
+            gl.glDeleteProgram(glId)
+            self.uniformOwners.pop(glId, None)
+        else:
+            gl.glDeleteTextures(1, byref(c_uint(glId)))
+        if not [key for key in self.objects if key[0]=='program']:
+            #no programs left to need the attachments
+            for shader in self.compiledAttachments.values():
+                gl.glDeleteShader(shader)
+            self.compiledAttachments.clear()
+        return True
+
+#the ShareGroups that have been used in this session, by key
+_shareGroups = {}
+#where getProgram() stores the binaries of linked programs. None (the default)
+#to not store them, e.g. set it to os.path.join(os.path.expanduser('~'),
+#'.pycrsltd', 'shaderCache') to reuse them between sessions
+programCacheDir = None
+
+def _glString(name):
+    """(private) Returns one of the glGetString() values as a python string
+    """
+    return cast(gl.glGetString(name), c_char_p).value or ''
+
+def _shareGroupKey():
+    """(private) Returns an identifier for the share group of the current
+    OpenGL context: pyglet's object space (which pyglet contexts share when
+    they're created with share=) or else the platform's handle for the context
+    (so other contexts are each treated as a share group of their own)
+    """
+    if gl.current_context is not None:
+        return gl.current_context.object_space
+    from OpenGL import platform
+    return platform.PLATFORM.GetCurrentContext()
+
+def getShareGroup():
+    """Returns the :class:`ShareGroup` of the current OpenGL context
+    """
+    key = _shareGroupKey()
+    if key not in _shareGroups:
+        _shareGroups[key] = ShareGroup(key)
+    return _shareGroups[key]
+
+def forgetShareGroup():
+    """Forget the :class:`ShareGroup` of the current OpenGL context, without
+    deleting anything, when its last context is about to be destroyed (which
+    deletes its objects anyway). Otherwise a later context that happens to
+    get the same handle would be given programs that no longer exist.
+    """
+    _shareGroups.pop(_shareGroupKey(), None)
+
+def release(glId, kind='program'):
+    """Release a program from :func:`getProgram` (or kind='texture', a
+    texture from :func:`getModuloLUTtexture`), deleting it if nothing else in
+    its share group is using it. Needs a context of that share group current.
+    """
+    if not getShareGroup().release(kind, glId):
+        logging.warning("Can't release %s %i, it isn't from the current share group" %(kind, glId))
+
+def programKey(vertex=None, fragment=None, attachments=[]):
+    """Returns a key (a hex string) that identifies a program made from these
+    shaders (as for :func:`compileProgram`) on the current graphics card and
+    driver.
+    """
+    key = hashlib.sha1()
+    for name in [gl.GL_VENDOR, gl.GL_RENDERER, gl.GL_VERSION]:
+        key.update(_glString(name)+'\0')
+    for code, shaderType in [(thisAttachment, thisAttachment.type) for thisAttachment in attachments]+\
+                            [(vertex, VERT), (fragment, FRAG)]:
+        if code:
+            key.update('%i:%s\0' %(shaderType, getattr(code, 'src', code)))
+    return key.hexdigest()
+
+def getProgram(vertex=None, fragment=None, attachments=[], cacheDir=None):
+    """Get a linked program from its shaders (arguments as for
+    :func:`compileProgram`), but only compiling them if necessary.
+
+    Programs are shared by all the contexts of a share group (see
+    :class:`ShareGroup`) and each call adds a reference to the program, so
+    call :func:`release` when it's no longer needed. Attachments (e.g.
+    the gamma correction) are only compiled once per share group.
+
+    If `cacheDir` is given (or shaders.programCacheDir has been set, it is
+    None by default) the binary of each linked program is also stored there
+    so it can be reloaded in future sessions, with `glProgramBinary`, as long
+    as the graphics card and driver (and the shaders) are unchanged. If that
+    fails for any reason, the shaders are just compiled again.
+
+    Use cacheDir=False to not store or load binaries even if
+    shaders.programCacheDir is set.
+    """
+    key = programKey(vertex, fragment, attachments)
+    shareGroup = getShareGroup()
+    if cacheDir is None:
+        cacheDir = programCacheDir
+    def create():
+        program = None
+        if cacheDir:
+            program = _loadProgramBinary(key, cacheDir)
+        if program is None:
+            program = compileProgram(vertex, fragment, attachments, binaryRetrievable=bool(cacheDir),
+                                     compiledAttachments=shareGroup.compiledAttachments)
+            if cacheDir:
+                _saveProgramBinary(program, key, cacheDir)
+        return program
+    return shareGroup.acquire('program', key, create)
+
+def _createModuloLUTtexture():
+    """(private) Make the texture for getModuloLUTtexture()
+    """
+    entries = encode.moduloLUT(256)
+    texture = c_uint()
+    gl.glGenTextures(1, byref(texture))
+    gl.glBindTexture(gl.GL_TEXTURE_1D, texture)
+    gl.glTexParameteri(gl.GL_TEXTURE_1D, gl.GL_TEXTURE_MIN_FILTER, gl.GL_NEAREST)
+    gl.glTexParameteri(gl.GL_TEXTURE_1D, gl.GL_TEXTURE_MAG_FILTER, gl.GL_NEAREST)
+    gl.glTexParameteri(gl.GL_TEXTURE_1D, gl.GL_TEXTURE_WRAP_S, gl.GL_CLAMP_TO_EDGE)
+    gl.glPixelStorei(gl.GL_UNPACK_ALIGNMENT, 1)
+    gl.glTexImage1D(gl.GL_TEXTURE_1D, 0, gl.GL_R8, len(entries), 0,
+                    gl.GL_RED, gl.GL_UNSIGNED_BYTE, entries.ctypes.data)
+    gl.glBindTexture(gl.GL_TEXTURE_1D, 0)
+    return texture.value
+
+def getModuloLUTtexture():
+    """Returns the id of the `moduloLUT` texture needed by
+    :data:`bitsMonoModeFrag` (a 256-entry, nearest-neighbour GL_TEXTURE_1D
+    whose entries are given by :func:`pycrsltd.encode.moduloLUT`), creating it
+    the first time it's needed in the current share group. As for
+    :func:`getProgram`, use :func:`release` (with kind='texture') when done.
+    """
+    return getShareGroup().acquire('texture', 'moduloLUT', _createModuloLUTtexture)
+
+def _loadProgramBinary(key, cacheDir):
+    """(private) Returns a program created from a binary stored by
+    _saveProgramBinary, or None if that isn't possible
+    """
+    filename = os.path.join(cacheDir, key+'.bin')
+    if not os.path.isfile(filename):
+        return None
+    program = None
+    try:
+        f = open(filename, 'rb')
+        try:
+            binaryFormat, = struct.unpack('<I', f.read(4))
+            binary = f.read()
+        finally:
+            f.close()
+        program = gl.glCreateProgram()
+        gl.glProgramBinary(program, binaryFormat, binary, len(binary))
+        status = c_int()
+        gl.glGetProgramiv(program, gl.GL_LINK_STATUS, byref(status))
+        if status.value:
+            return program
+        #the driver rejected it (e.g. it has been updated)
+        gl.glDeleteProgram(program)
+        program = None
+        os.remove(filename)
+    except Exception, err:
+        logging.warning("Couldn't load shader program binary %s (%s)" %(filename, err))
+        if program is not None:
+            gl.glDeleteProgram(program)
+    return None
+
+def _saveProgramBinary(program, key, cacheDir):
+    """(private) Store the binary of a linked program (if the driver gives us
+    one) for _loadProgramBinary
+    """
+    try:
+        length = c_int()
+        gl.glGetProgramiv(program, gl.GL_PROGRAM_BINARY_LENGTH, byref(length))
+        if not length.value:
+            return
+        binary = create_string_buffer(length.value)
+        binaryFormat = c_uint()
+        gl.glGetProgramBinary(program, length, None, byref(binaryFormat), binary)
+        if not os.path.isdir(cacheDir):
+            os.makedirs(cacheDir)
+        filename = os.path.join(cacheDir, key+'.bin')
+        #write then rename, so other processes never see a partial file
+        f = open(filename+'.tmp%i' %os.getpid(), 'wb')
+        try:
+            f.write(struct.pack('<I', binaryFormat.value)+binary.raw)
+        finally:
+            f.close()
+        os.rename(f.name, filename)
+    except Exception, err:
+        logging.warning("Couldn't save shader program binary (%s)" %err)
+
 gammaCorrectionFrag= ShaderCode(src="""
 /* Shader for gamma correction of RGB and Luminance textures.
  * Uses extended formula for gamma correction:
@@ -153,8 +559,10 @@ vec4 gammaCorrect3(vec4 incolor)
     /* Return alpha component unmodified: */
     outcolor.a = incolor.a;
 
-    /* Clamp input to valid [ICMMinInLuminance ; ICMMaxInLuminance] range: */
-    incolor.rgb = clamp(incolor.rgb, ICMMinInLuminance, ICMMaxInLuminance);
+    /* Clamp input to valid [ICMMinInLuminance ; ICMMaxInLuminance] range */
+    /* (which is reversed for inverted contrast): */
+    incolor.rgb = clamp(incolor.rgb, min(ICMMinInLuminance, ICMMaxInLuminance),
+                        max(ICMMinInLuminance, ICMMaxInLuminance));
 
     /* Convert clamped input to normalized 0-1 interval: */
     incolor.rgb = (incolor.rgb - ICMMinInLuminance) * ICMReciprocalLuminanceRange;
@@ -172,8 +580,10 @@ float gammaCorrect1(float incolor)
 {
     float outcolor;
 
-    /* Clamp input to valid [ICMMinInLuminance ; ICMMaxInLuminance] range: */
-    incolor = clamp(incolor, ICMMinInLuminance.r, ICMMaxInLuminance.r);
+    /* Clamp input to valid [ICMMinInLuminance ; ICMMaxInLuminance] range */
+    /* (which is reversed for inverted contrast): */
+    incolor = clamp(incolor, min(ICMMinInLuminance.r, ICMMaxInLuminance.r),
+                    max(ICMMinInLuminance.r, ICMMaxInLuminance.r));
 
     /* Convert clamped input to normalized 0-1 interval: */
     incolor = (incolor - ICMMinInLuminance.r) * ICMReciprocalLuminanceRange.r;
@@ -188,6 +598,38 @@ float gammaCorrect1(float incolor)
 }
 """, shaderType=FRAG)
 
+gammaCorrectionLUTFrag = ShaderCode(src="""
+/* Alternative to gammaCorrectionFrag (with the same functions) that looks up
+ * each channel in a 1D texture (e.g. a measured inverse gamma table) rather
+ * than using a power function. Input values are clamped to 0.0-1.0 and
+ * interpolated linearly between the ICMGammaLUTSize entries of the table.
+ * Use with shaders.GammaLUTTexture.
+ */
+
+uniform sampler1D ICMGammaLUT;
+uniform float     ICMGammaLUTSize;
+
+vec3 gammaLUTcoord(vec3 incolor)
+{
+    /* Map 0.0 and 1.0 to the centres of the first and last texels: */
+    return (clamp(incolor, 0.0, 1.0) * (ICMGammaLUTSize - 1.0) + 0.5) / ICMGammaLUTSize;
+}
+
+vec4 gammaCorrect3(vec4 incolor)
+{
+    vec3 coord = gammaLUTcoord(incolor.rgb);
+    return vec4(texture1D(ICMGammaLUT, coord.r).r,
+                texture1D(ICMGammaLUT, coord.g).g,
+                texture1D(ICMGammaLUT, coord.b).b,
+                incolor.a);
+}
+
+float gammaCorrect1(float incolor)
+{
+    return texture1D(ICMGammaLUT, gammaLUTcoord(vec3(incolor)).r).r;
+}
+""", shaderType=FRAG)
+
 bitsMonoModeFrag=ShaderCode(src="""
 /* Mono++ output formatter
  *
@@ -213,11 +655,17 @@ bitsMonoModeFrag=ShaderCode(src="""
 uniform sampler2DRect Image;
 uniform sampler1D moduloLUT;
 
+/* Declare external function for luminance conversion: */
+float gammaCorrect1(float incolor);
+
 void main()
 {
     /* Retrieve RGBA HDR input color value. */
     float incolor = texture2DRect(Image, gl_TexCoord[0].st).r;
 
+    /* Apply some luminance transformation (clamping, gamma correction etc.): */
+    incolor = gammaCorrect1(incolor);
+
     /* Remap red channel from 0.0 - 1.0 to 0 to 65535: */
     float index = (incolor * 65535.0) / 256.0;
 
@@ -395,4 +843,329 @@ void main()
     /* Fix alpha channel to 1.0. */
     gl_FragColor.a = 1.0;
 }
-""", shaderType=FRAG)
\ No newline at end of file
+""", shaderType=FRAG)
+#The single-pass output stage (see OutputPass). These use GLSL 3.30 core, so
+#the gamma correction attachments are given the same version
+def _coreVersion(code):
+    """(private) A GLSL 3.30 core version of one of the (GLSL 1.10) attachments
+    """
+    src = code.src.replace('texture1D(', 'texture(')
+    return ShaderCode(src="#version 330 core\n"+src, shaderType=code.type)
+
+gammaCorrectionCoreFrag = _coreVersion(gammaCorrectionFrag)
+gammaCorrectionLUTCoreFrag = _coreVersion(gammaCorrectionLUTFrag)
+
+outputPassVert = ShaderCode(src="""
+#version 330 core
+/* Full-screen triangle for the output pass (vertices at (-1,-1), (3,-1)
+ * and (-1,3) cover the whole viewport with a single primitive). */
+layout(location = 0) in vec2 position;
+
+void main()
+{
+    gl_Position = vec4(position, 0.0, 1.0);
+}
+""", shaderType=VERT)
+
+bitsPlusPlusOutputFrag = ShaderCode(src="""
+#version 330 core
+/* Bits++ output: the image is passed through unchanged except for the top
+ * line of the screen, which carries the T-Lock header and the LUT (the
+ * 524x1 HeadAndLUT texture). The image should be the size of the window. */
+uniform sampler2D Image;
+uniform sampler2D HeadAndLUT;
+out vec4 fragColor;
+
+void main()
+{
+    ivec2 pos = ivec2(gl_FragCoord.xy);
+    if (pos.y == textureSize(Image, 0).y - 1 && pos.x < 524)
+        fragColor = texelFetch(HeadAndLUT, ivec2(pos.x, 0), 0);
+    else
+        fragColor = texelFetch(Image, pos, 0);
+}
+""", shaderType=FRAG)
+
+imageSourceCoreFrag = ShaderCode(src="""
+#version 330 core
+/* The source of the mono++/color++ output passes: pixels of the Image
+ * texture (e.g. the window's framebuffer object). See also the procedural
+ * stimuli, which compute imageColor() instead. */
+uniform sampler2D Image;
+
+vec4 imageColor(ivec2 pos)
+{
+    return texelFetch(Image, pos, 0);
+}
+""", shaderType=FRAG)
+
+monoPlusPlusOutputFrag = ShaderCode(src="""
+#version 330 core
+/* Mono++ output: as bitsMonoModeFrag, 8 MSBs of the 16-bit luminance (from
+ * the red channel) in red and 8 LSBs in green, but with the low byte
+ * computed directly rather than from a moduloLUT texture. */
+out vec4 fragColor;
+
+vec4 imageColor(ivec2 pos);
+float gammaCorrect1(float incolor);
+
+void main()
+{
+    float incolor = gammaCorrect1(imageColor(ivec2(gl_FragCoord.xy)).r);
+    float index = floor(incolor * 65535.0);
+    fragColor = vec4(floor(index / 256.0) / 255.0, mod(index, 256.0) / 255.0, 0.0, 1.0);
+}
+""", shaderType=FRAG)
+
+colorPlusPlusOutputFrag = ShaderCode(src="""
+#version 330 core
+/* Color++ output: as bitsColorModeFrag, high bytes in even pixels and low
+ * bytes in odd pixels, with each pair of pixels reading column
+ * floor(2*pairN*sampleSpacing) of the image. */
+uniform float     sampleSpacing;
+out vec4 fragColor;
+
+vec4 imageColor(ivec2 pos);
+vec4 gammaCorrect3(vec4 incolor);
+
+void main()
+{
+    ivec2 pos = ivec2(gl_FragCoord.xy);
+    int readCol = int(floor(float(pos.x - pos.x % 2) * sampleSpacing));
+    vec4 incolor = gammaCorrect3(imageColor(ivec2(readCol, pos.y)));
+    vec3 index = floor(incolor.rgb * 65535.0 + 0.5) + 0.01;
+    if (pos.x % 2 == 0)
+        fragColor.rgb = floor(index / 256.0) / 255.0;
+    else
+        fragColor.rgb = mod(index, 256.0) / 255.0;
+    fragColor.a = 1.0;
+}
+""", shaderType=FRAG)
+
+outputPassFrags = {'bits++': bitsPlusPlusOutputFrag,
+                   'mono++': monoPlusPlusOutputFrag,
+                   'color++': colorPlusPlusOutputFrag}
+
+class OutputPass(object):
+    """The whole output stage for a Bits mode in one draw call: a full-screen
+    triangle (from a vertex buffer) drawn with the program for the mode,
+    reading the image to be shown from a texture (e.g. the window's
+    framebuffer object) the same size as the window.
+
+    In mono++ and color++ modes the image can instead be computed by the
+    program, from `source`, an attachment that defines
+    `vec4 imageColor(ivec2 pos)` (see :class:`ProceduralStimulus`).
+
+    Texture units are:
+        - 0: the image (GL_TEXTURE_2D), unless there's a `source`
+        - 2: the gamma table, if gammaTableSize is given (see GammaLUTTexture)
+        - 3: the 524x1 header+LUT row in bits++ mode (GL_TEXTURE_2D)
+
+    The program's uniforms are in `self.uniforms` (a UniformState) and are
+    flushed by :meth:`draw`.
+
+    Needs the OpenGL context current (on creation and for draw/delete).
+    """
+    def __init__(self, mode, gammaTableSize=None, source=None):
+        self.mode = mode
+        attachments = []
+        if mode != 'bits++':
+            if gammaTableSize:
+                attachments = [gammaCorrectionLUTCoreFrag]
+            else:
+                attachments = [gammaCorrectionCoreFrag]
+            attachments.append(source or imageSourceCoreFrag)
+        elif source is not None:
+            raise ValueError, "OutputPass can't use a `source` in bits++ mode"
+        self.program = getProgram(vertex=outputPassVert, fragment=outputPassFrags[mode],
+                                  attachments=attachments)
+        self.uniforms = UniformState(self.program, Image=0)
+        if mode == 'bits++':
+            self.uniforms['HeadAndLUT'] = 3
+        elif gammaTableSize:
+            self.uniforms.update(ICMGammaLUT=2, ICMGammaLUTSize=float(gammaTableSize))
+        else:
+            self.uniforms.setGammaParams(**ICMdefaults)
+        if mode == 'color++':
+            self.uniforms['sampleSpacing'] = 1.0
+        #the triangle
+        vertices = (c_float*6)(-1.0, -1.0, 3.0, -1.0, -1.0, 3.0)
+        vao, vbo = c_uint(), c_uint()
+        gl.glGenVertexArrays(1, byref(vao))
+        gl.glGenBuffers(1, byref(vbo))
+        self.vao, self.vbo = vao.value, vbo.value
+        gl.glBindVertexArray(self.vao)
+        gl.glBindBuffer(gl.GL_ARRAY_BUFFER, self.vbo)
+        gl.glBufferData(gl.GL_ARRAY_BUFFER, sizeof(vertices), vertices, gl.GL_STATIC_DRAW)
+        gl.glEnableVertexAttribArray(0)
+        gl.glVertexAttribPointer(0, 2, gl.GL_FLOAT, gl.GL_FALSE, 0, None)
+        gl.glBindVertexArray(0)
+        gl.glBindBuffer(gl.GL_ARRAY_BUFFER, 0)
+    def draw(self, imageTexture=None, textures={}):
+        """Draw the image (the id of a GL_TEXTURE_2D, or None if the pass has
+        a `source`) to the current framebuffer, encoded for the mode.
+
+        `textures` gives any other textures to bind, as {unit: (target, id)}.
+        """
+        for unit, (target, texture) in textures.items():
+            gl.glActiveTexture(gl.GL_TEXTURE0+unit)
+            gl.glBindTexture(target, texture)
+        gl.glActiveTexture(gl.GL_TEXTURE0)
+        if imageTexture is not None:
+            gl.glBindTexture(gl.GL_TEXTURE_2D, imageTexture)
+        gl.glUseProgram(self.program)
+        self.uniforms.flush()
+        gl.glBindVertexArray(self.vao)
+        gl.glDrawArrays(gl.GL_TRIANGLES, 0, 3)
+        gl.glBindVertexArray(0)
+        gl.glUseProgram(0)
+    def delete(self):
+        """Free the vertex buffer and array, and release the program (which
+        is only deleted if nothing else in the share group is using it)
+        """
+        if self.vao:
+            gl.glDeleteVertexArrays(1, byref(c_uint(self.vao)))
+            gl.glDeleteBuffers(1, byref(c_uint(self.vbo)))
+            release(self.program)
+            self.vao = self.vbo = 0
+
+#Procedural stimuli for the mono++/color++ output passes (see ProceduralStimulus).
+#Each defines imageColor() from the position, in window pixels
+_stimulusHeader = """
+#version 330 core
+uniform vec2  stimCentre;   /* pixels, from the bottom-left of the window */
+uniform float stimOri;      /* degrees clockwise (0 is vertical bars) */
+uniform float stimSf;       /* cycles per pixel */
+uniform float stimPhase;    /* cycles */
+uniform float stimContrast;
+uniform float stimMean;     /* the background luminance */
+uniform vec3  stimColor;    /* the contrast of each gun */
+
+const float TWOPI = 6.283185307179586;
+
+vec2 stimPos(ivec2 pos)
+{
+    return vec2(pos) + 0.5 - stimCentre;
+}
+
+/* The sinusoidal modulation (-1:1) at xy for a grating of this orientation,
+ * spatial frequency and phase */
+float sineCarrier(vec2 xy, float ori, float sf, float phase)
+{
+    float theta = radians(ori);
+    return sin(TWOPI * (sf * dot(xy, vec2(cos(theta), -sin(theta))) + phase));
+}
+
+vec4 stimulusColor(float modulation)
+{
+    return vec4(stimMean * (1.0 + modulation * stimColor), 1.0);
+}
+"""
+
+sineGratingFrag = ShaderCode(src=_stimulusHeader+"""
+vec4 imageColor(ivec2 pos)
+{
+    return stimulusColor(stimContrast * sineCarrier(stimPos(pos), stimOri, stimSf, stimPhase));
+}
+""", shaderType=FRAG)
+
+squareGratingFrag = ShaderCode(src=_stimulusHeader+"""
+vec4 imageColor(ivec2 pos)
+{
+    return stimulusColor(stimContrast * sign(sineCarrier(stimPos(pos), stimOri, stimSf, stimPhase)));
+}
+""", shaderType=FRAG)
+
+gaborFrag = ShaderCode(src=_stimulusHeader+"""
+uniform float stimSigma;    /* s.d. of the gaussian envelope, pixels */
+
+vec4 imageColor(ivec2 pos)
+{
+    vec2 xy = stimPos(pos);
+    float envelope = exp(-dot(xy, xy) / (2.0 * stimSigma * stimSigma));
+    return stimulusColor(stimContrast * envelope * sineCarrier(xy, stimOri, stimSf, stimPhase));
+}
+""", shaderType=FRAG)
+
+plaidFrag = ShaderCode(src=_stimulusHeader+"""
+/* the second grating */
+uniform float stimOri2;
+uniform float stimSf2;
+uniform float stimPhase2;
+uniform float stimContrast2;
+
+vec4 imageColor(ivec2 pos)
+{
+    vec2 xy = stimPos(pos);
+    return stimulusColor(stimContrast * sineCarrier(xy, stimOri, stimSf, stimPhase)
+                         + stimContrast2 * sineCarrier(xy, stimOri2, stimSf2, stimPhase2));
+}
+""", shaderType=FRAG)
+
+stimulusFrags = {'sine': sineGratingFrag,
+                 'square': squareGratingFrag,
+                 'gabor': gaborFrag,
+                 'plaid': plaidFrag}
+
+class ProceduralStimulus(object):
+    """A stimulus (grating, gabor or plaid) that is computed for each pixel
+    by the mono++/color++ output program itself, at full precision, rather
+    than being drawn to a texture first. So changes (e.g. of phase or
+    contrast) from frame to frame only change uniforms. Draw it with
+    :meth:`pycrsltd.bits.BitsBox.drawStimulus`::
+
+        grating = ProceduralStimulus('sine', sf=0.02, contrast=0.1)
+        for frameN in range(100):
+            grating.setParams(phase=frameN/50.0)
+            bitsBox.drawStimulus(grating)
+            win.flip()
+
+    The luminance is mean*(1+contrast*carrier*color), for each gun.
+
+    :Parameters:
+        kind : 'sine', 'square', 'gabor' or 'plaid'
+        centre : (x,y) in pixels from the bottom-left of the window
+            (None for the centre of the window)
+        ori : degrees clockwise (0 gives vertical bars)
+        sf : spatial frequency in cycles per pixel
+        phase : in cycles
+        contrast : of the carrier, 0.0:1.0
+        mean : the mean luminance, 0.0:1.0
+        color : (R,G,B) the contrast of each gun (as a fraction of `contrast`)
+        sigma : the s.d. of the gaussian envelope (pixels) for a gabor
+        ori2, sf2, phase2, contrast2 : the second grating of a plaid
+
+    """
+    defaults = {'centre': None, 'ori': 0.0, 'sf': 0.05, 'phase': 0.0,
+                'contrast': 1.0, 'mean': 0.5, 'color': (1.0, 1.0, 1.0)}
+    extraDefaults = {'sine': {},
+                     'square': {},
+                     'gabor': {'sigma': 20.0},
+                     'plaid': {'ori2': 90.0, 'sf2': 0.05, 'phase2': 0.0, 'contrast2': 1.0}}
+    def __init__(self, kind='sine', **params):
+        if kind not in stimulusFrags:
+            raise ValueError("Unknown kind of ProceduralStimulus '%s' (should be one of %s)"
+                             %(kind, stimulusFrags.keys()))
+        self.kind = kind
+        self.source = stimulusFrags[kind]
+        self.params = dict(self.defaults)
+        self.params.update(self.extraDefaults[kind])
+        self.setParams(**params)
+    def setParams(self, **params):
+        """Change any of the parameters (they take effect when the stimulus
+        is next drawn)
+        """
+        for key in params:
+            if key not in self.params:
+                raise TypeError("'%s' isn't a parameter of a %s stimulus" %(key, self.kind))
+        self.params.update(params)
+    def applyTo(self, uniforms, winSize):
+        """Set the parameters in the UniformState of an OutputPass that uses
+        this stimulus as its source (only those that changed are sent to
+        OpenGL when it's drawn)
+        """
+        for key, val in self.params.items():
+            if key=='centre' and val is None:
+                val = (winSize[0]/2.0, winSize[1]/2.0)
+            #(always floats, even if given as ints)
+            uniforms['stim'+key[0].upper()+key[1:]] = numpy.asarray(val, 'd').tolist()
@@ -0,0 +1,246 @@
+#!/usr/bin/env python
+#coding=utf-8
+
+# Copyright (c) Cambridge Research Systems (CRS) Ltd
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+
+"""Banks of pre-encoded stimulus frames, stored on disk for fast playback.
+
+A bank is a single file holding a set of frames already encoded for one of
+the BitsBox modes ('bits++', 'mono++' or 'color++') along with that mode and,
+optionally, a set of bits++ header+LUT rows (e.g. one per frame for LUT
+animation). Banks are memory-mapped when read, so opening even a very large
+bank is instant and frames are only read from disk as they are used.
+
+File layout (all page-aligned so that frames can be mapped directly):
+
+    - 8 bytes: the format identifier, `CRSBANK1`
+    - 4 bytes: length of the header (little-endian uint32)
+    - the header: a JSON dictionary (mode, nFrames, frameShape, offsets...)
+    - the frames: uint8 (nFrames, height, width, 3), rows top-to-bottom
+    - the header+LUT rows, if any: uint8 (nLUTs, 524, 3)
+
+**Example**::
+
+    from pycrsltd import stimbank
+    stimbank.writeBank('gratings.bank', encodedFrames, mode='mono++')
+
+    bank = stimbank.StimulusBank('gratings.bank')
+    for frameN, frame in bank.stream(readAhead=8):
+        win.bits.drawEncodedFrame(frame)
+        win.flip()
+
+"""
+
+__docformat__ = "restructuredtext en"
+
+import json, mmap, struct, threading
+import numpy
+import encode
+
+formatID = 'CRSBANK1'
+_align = mmap.ALLOCATIONGRANULARITY
+
+def _aligned(nBytes):
+    """(private) Round nBytes up to a multiple of the mmap page alignment
+    """
+    return -(-nBytes//_align)*_align
+
+def createBank(filename, mode, nFrames, height, width, LUTs=None, info=None):
+    """Create a new (empty) bank file and return a writable memory-mapped array
+    of its frames, for filling in (e.g. by `encode.encodeFrames(..., out=frames)`)
+
+    :Parameters:
+        filename : the file to create (will be overwritten)
+        mode : 'bits++', 'mono++' or 'color++' (the mode the frames are encoded for)
+        nFrames, height, width : size of the encoded frames
+        LUTs : optional header+LUT rows (nLUTs, 524, 3) e.g. from
+            `BitsBox.precomputeLUTs()`
+        info : optional dictionary of extra information to store (must be
+            possible to save as JSON)
+
+    :return: uint8 memory-mapped array (nFrames, height, width, 3)
+    """
+    if mode not in encode.modeNames:
+        raise ValueError("Unknown mode '%s', should be one of %s" %(mode, sorted(encode.modeNames)))
+    frameShape = (height, width, 3)
+    frameBytes = height*width*3
+    nLUTs = 0
+    if LUTs is not None:
+        LUTs = numpy.asarray(LUTs, numpy.uint8).reshape([-1,524,3])
+        nLUTs = len(LUTs)
+    header = {'mode': encode.modeNames[mode],
+              'nFrames': nFrames,
+              'frameShape': frameShape,
+              'nLUTs': nLUTs,
+              'info': info or {},
+              }
+    #the header is written first with dummy offsets to find its size
+    header['framesOffset'] = header['LUTsOffset'] = 0
+    headerSize = len(formatID)+4+len(json.dumps(header))+32 #room for the offsets
+    header['framesOffset'] = _aligned(headerSize)
+    header['LUTsOffset'] = header['framesOffset']+_aligned(nFrames*frameBytes)
+    headerStr = json.dumps(header)
+    fileSize = header['LUTsOffset']+nLUTs*524*3
+
+    f = open(filename, 'wb')
+    try:
+        f.write(formatID+struct.pack('<I', len(headerStr))+headerStr)
+        f.truncate(fileSize)
+        if nLUTs:
+            f.seek(header['LUTsOffset'])
+            f.write(LUTs.tostring())
+    finally:
+        f.close()
+    return numpy.memmap(filename, dtype=numpy.uint8, mode='r+',
+                        offset=header['framesOffset'], shape=(nFrames,)+frameShape)
+
+def writeBank(filename, frames, mode, LUTs=None, info=None, **kwargs):
+    """Write a stack of frames to a new bank file.
+
+    :Parameters:
+        filename : the file to create (will be overwritten)
+        frames : the frames (nFrames, height, width, 3). If these are uint8 they
+            are assumed to be encoded already. Otherwise they are encoded with
+            `encode.encodeFrames()` (to which any other keyword arguments are
+            passed), one chunk at a time straight into the file.
+        mode, LUTs, info : as for :func:`createBank`
+    """
+    frames = numpy.asarray(frames)
+    if frames.dtype==numpy.uint8:
+        shape = frames.shape
+    else:
+        shape = encode.encodedShape(frames.shape, mode, kwargs.get('sampleSpacing', 1.0))
+    out = createBank(filename, mode, len(frames), shape[1], shape[2], LUTs=LUTs, info=info)
+    if frames.dtype==numpy.uint8:
+        out[:] = frames
+    else:
+        encode.encodeFrames(frames, mode, out=out, **kwargs)
+    out.flush()
+    del out
+
+class StimulusBank(object):
+    """Read a bank of pre-encoded frames (see :func:`writeBank`).
+
+    The file is memory-mapped so nothing is read until it's used. Frames are
+    returned as read-only numpy arrays that are views of the mapped file
+    (no copies)::
+
+        bank = StimulusBank('gratings.bank')
+        print bank.mode, len(bank), bank.frameShape
+        frame = bank[10]
+
+    """
+    def __init__(self, filename):
+        self.filename = filename
+        self._file = open(filename, 'rb')
+        try:
+            ID = self._file.read(len(formatID))
+            if ID!=formatID:
+                raise IOError("%s is not a stimulus bank (it starts %r)" %(filename, ID))
+            headerLen, = struct.unpack('<I', self._file.read(4))
+            header = json.loads(self._file.read(headerLen))
+            self._mmap = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        except:
+            self._file.close()
+            raise
+        self.header = header
+        self.mode = header['mode']
+        self.frameShape = tuple(header['frameShape'])
+        self.info = header['info']
+        self.frames = numpy.frombuffer(self._mmap, numpy.uint8,
+                                       count=header['nFrames']*numpy.prod(self.frameShape),
+                                       offset=header['framesOffset'])
+        self.frames = self.frames.reshape((header['nFrames'],)+self.frameShape)
+        if header['nLUTs']:
+            self.LUTs = numpy.frombuffer(self._mmap, numpy.uint8, count=header['nLUTs']*524*3,
+                                         offset=header['LUTsOffset']).reshape([-1,524,3])
+        else:
+            self.LUTs = None
+    def __len__(self):
+        return len(self.frames)
+    def __getitem__(self, index):
+        return self.frames[index]
+    def stream(self, startFrame=0, nFrames=None, readAhead=8):
+        """Returns a :class:`BankStream` to iterate through the frames, reading
+        ahead of the current frame in the background
+        """
+        return BankStream(self, startFrame=startFrame, nFrames=nFrames, readAhead=readAhead)
+    def close(self):
+        """Release the file (any frames still in use keep the mapping open)
+        """
+        self.frames = self.LUTs = self._mmap = None
+        self._file.close()
+
+class BankStream(object):
+    """Iterate through frames of a :class:`StimulusBank`, while a background
+    thread reads the next `readAhead` frames from disk (by touching each of
+    their pages) so that they are already in memory when they're needed.
+
+    Each item is a (frameN, frame) tuple, where the frame is a view of the
+    mapped file. `BankStream.readUpTo` is the frame that has been read up to.
+    """
+    def __init__(self, bank, startFrame=0, nFrames=None, readAhead=8):
+        self.bank = bank
+        if nFrames is None:
+            nFrames = len(bank)-startFrame
+        self.startFrame = startFrame
+        self.endFrame = min(startFrame+nFrames, len(bank))
+        self.readAhead = readAhead
+        self.readUpTo = startFrame
+        self._currentFrame = startFrame
+        self._condition = threading.Condition()
+        self._stopped = False
+        self._thread = threading.Thread(target=self._readFrames)
+        self._thread.daemon = True
+        self._thread.start()
+    def _readFrames(self):
+        """(private) Runs in the background thread, touching each page of the
+        frames ahead of the current frame
+        """
+        pageStep = mmap.PAGESIZE
+        while True:
+            with self._condition:
+                while not self._stopped and self.readUpTo>=min(self._currentFrame+self.readAhead, self.endFrame):
+                    if self.readUpTo>=self.endFrame:
+                        return
+                    self._condition.wait()
+                if self._stopped:
+                    return
+                #don't bother reading frames that have already been used
+                frameN = self.readUpTo = max(self.readUpTo, self._currentFrame)
+            flat = self.bank.frames[frameN].reshape(-1)
+            flat[::pageStep].sum() #reading a byte of each page loads it
+            with self._condition:
+                self.readUpTo = frameN+1
+    def __iter__(self):
+        for frameN in range(self.startFrame, self.endFrame):
+            with self._condition:
+                self._currentFrame = frameN
+                self._condition.notify()
+            yield frameN, self.bank.frames[frameN]
+        self.stop()
+    def stop(self):
+        """Stop reading ahead (e.g. if the playback is ended early)
+        """
+        with self._condition:
+            self._stopped = True
+            self._condition.notify()
@@ -0,0 +1,111 @@
+"""Helper for the tests of the BitsSharp serial protocol (without a Bits#).
+
+FakeSerial stands in for the serial port of a Bits#: it replies to the
+commands written to it, after a latency, in several chunks (as the real box's
+replies can arrive).
+"""
+
+import time, threading
+import pyglet
+pyglet.options['shadow_window'] = False #bits imports the shaders, but we've no display
+pyglet.options['debug_gl'] = False #(as for headlessGL)
+from pycrsltd import bits
+
+def videoLine(lineN, nPixels):
+    """The pixels that FakeSerial reports for a video line
+    """
+    return [((lineN+pixN)%256, (2*pixN)%256, (lineN*3)%256) for pixN in range(nPixels)]
+
+class FakeSerial(object):
+    def __init__(self, latency=0.005, chunkSize=5, replyTime=0.0):
+        self.latency = latency
+        self.chunkSize = chunkSize
+        self.replyTime = replyTime #the time the box takes to produce each reply
+        self.timeout = None
+        self.written = []
+        self._incoming = [] #[timeAvailable, chars]
+        self._lock = threading.Lock()
+    def isOpen(self):
+        return True
+    def close(self):
+        pass
+    def reply(self, msg):
+        """The reply to a command (or None for commands without replies)
+        """
+        cmd = msg.strip()
+        if cmd=='$ProductType':
+            return '#ProductType;Bits_Sharp;\n\r'
+        elif cmd=='$SerialNumber':
+            return '#SerialNumber;BS1234\x00\n\r'
+        elif cmd=='$FirmwareDate':
+            return '#FirmwareDate;2013-05-01;\n\r'
+        elif cmd.startswith('$GetVideoLine='):
+            lineN, nPixels = [int(val) for val in cmd.split('[')[1].strip(']').split()]
+            vals = [str(val) for pixel in videoLine(lineN, nPixels) for val in pixel]
+            return '#GetVideoLine;%s;\n\r' %(';'.join(vals))
+        return None
+    def write(self, msg):
+        self.written.append(msg)
+        reply = self.reply(msg)
+        if reply is None:
+            return
+        self.send(reply, self.latency, self.replyTime)
+    def send(self, chars, delay=0.0, gap=0.0):
+        """Have the box send `chars` (e.g. part of a reply) after `delay` secs
+        (and at least `gap` secs after anything still to come)
+        """
+        with self._lock:
+            start = max([time.time()+delay]+[chunk[0]+gap for chunk in self._incoming])
+            for n in range(0, len(chars), self.chunkSize):
+                self._incoming.append([start+n*0.0001, chars[n:n+self.chunkSize]])
+    def _available(self):
+        now = time.time()
+        return ''.join([chars for when, chars in self._incoming if when<=now])
+    def inWaiting(self):
+        with self._lock:
+            return len(self._available())
+    def read(self, n=1):
+        deadline = time.time()+(self.timeout or 0)
+        while True:
+            with self._lock:
+                available = self._available()
+                if len(available)>=n or time.time()>=deadline:
+                    #remove what's been read
+                    chars, remaining = available[:n], len(available[:n])
+                    while remaining:
+                        chunk = self._incoming[0]
+                        if len(chunk[1])<=remaining:
+                            remaining -= len(chunk[1])
+                            self._incoming.pop(0)
+                        else:
+                            chunk[1] = chunk[1][remaining:]
+                            remaining = 0
+                    return chars
+            time.sleep(0.0005)
+
+class FakeBitsSharp(bits.BitsSharp):
+    """A BitsSharp connected to a FakeSerial
+    """
+    def __init__(self, **fakeArgs):
+        self._fakeArgs = fakeArgs
+        bits.BitsSharp.__init__(self, portName='fake')
+    def _connect(self):
+        return FakeSerial(**self._fakeArgs)
+
+class FakeAsyncBitsSharp(bits.AsyncBitsSharp):
+    """An AsyncBitsSharp connected to a FakeSerial
+    """
+    def __init__(self, loop=None, **fakeArgs):
+        self._fakeArgs = fakeArgs
+        bits.AsyncBitsSharp.__init__(self, portName='fake', loop=loop)
+    def _connect(self):
+        return FakeSerial(**self._fakeArgs)
+
+class FakeThreadedBitsSharp(bits.ThreadedBitsSharp):
+    """A ThreadedBitsSharp connected to a FakeSerial
+    """
+    def __init__(self, **fakeArgs):
+        self._fakeArgs = fakeArgs
+        bits.ThreadedBitsSharp.__init__(self, portName='fake')
+    def _connect(self):
+        return FakeSerial(**self._fakeArgs)
@@ -0,0 +1,66 @@
+"""Helper for the tests that need an OpenGL context (but not a Bits box).
+
+On a headless linux machine these can use Mesa's software renderer (llvmpipe)
+through EGL, with no X server at all::
+
+    PYOPENGL_PLATFORM=egl EGL_PLATFORM=surfaceless nosetests pycrsltd/tests
+
+Otherwise a hidden pyglet window is used, and tests are skipped if neither
+is possible.
+"""
+
+import os, sys, ctypes
+from unittest import SkipTest
+
+def _eglContext(width, height):
+    from OpenGL import EGL
+    display = EGL.eglGetDisplay(EGL.EGL_DEFAULT_DISPLAY)
+    major, minor = EGL.EGLint(), EGL.EGLint()
+    EGL.eglInitialize(display, ctypes.pointer(major), ctypes.pointer(minor))
+    attribs = (EGL.EGLint*11)(EGL.EGL_SURFACE_TYPE, EGL.EGL_PBUFFER_BIT,
+                              EGL.EGL_RED_SIZE, 8, EGL.EGL_GREEN_SIZE, 8, EGL.EGL_BLUE_SIZE, 8,
+                              EGL.EGL_RENDERABLE_TYPE, EGL.EGL_OPENGL_BIT, EGL.EGL_NONE)
+    config, nConfigs = EGL.EGLConfig(), EGL.EGLint()
+    EGL.eglChooseConfig(display, attribs, ctypes.pointer(config), 1, ctypes.pointer(nConfigs))
+    if not nConfigs.value:
+        raise RuntimeError("no suitable EGL config")
+    size = (EGL.EGLint*5)(EGL.EGL_WIDTH, width, EGL.EGL_HEIGHT, height, EGL.EGL_NONE)
+    surface = EGL.eglCreatePbufferSurface(display, config, size)
+    EGL.eglBindAPI(EGL.EGL_OPENGL_API)
+    context = EGL.eglCreateContext(display, config, EGL.EGL_NO_CONTEXT, None)
+    EGL.eglMakeCurrent(display, surface, surface, context)
+    def close():
+        #the handle of the context may be reused, so forget its share group
+        shaders = sys.modules.get('pycrsltd.shaders')
+        if shaders is not None:
+            shaders.forgetShareGroup()
+        EGL.eglMakeCurrent(display, EGL.EGL_NO_SURFACE, EGL.EGL_NO_SURFACE, EGL.EGL_NO_CONTEXT)
+        EGL.eglDestroyContext(display, context)
+        EGL.eglDestroySurface(display, surface)
+    return close
+
+def getContext(width=64, height=32):
+    """Make an OpenGL context current and return a function that closes it
+    (or raise SkipTest if that isn't possible)
+    """
+    import pyglet
+    #so that pyglet.gl can be imported without a display, and used with other contexts
+    pyglet.options['shadow_window'] = False
+    pyglet.options['debug_gl'] = False
+    try:
+        if os.environ.get('PYOPENGL_PLATFORM')=='egl':
+            return _eglContext(width, height)
+        win = pyglet.window.Window(width=width, height=height, visible=False)
+        return win.close
+    except Exception, err:
+        raise SkipTest("No OpenGL context available (%s)" %err)
+
+class Win(object):
+    """The parts of a PsychoPy Window that a BitsBox needs
+    """
+    def __init__(self, size=(64,32)):
+        self.size = size
+        self.monitor = None
+        self.nFlips = 0
+    def flip(self):
+        self.nFlips += 1
@@ -0,0 +1,210 @@
+"""Tests for the creation of LUTs by BitsBox (in bits++ mode). These don't
+draw anything so they need pyglet and PyOpenGL, but not an OpenGL context
+"""
+
+import numpy, time, gc, weakref
+import headlessGL
+
+class Monitor(object):
+    """The gamma correction of a PsychoPy Monitor (a simple power law)
+    """
+    def lineariseLums(self, lums, overrideGamma):
+        return numpy.asarray(lums)**(1.0/numpy.asarray(overrideGamma, 'd'))
+
+def _bitsBox(monitor=None):
+    import pyglet
+    pyglet.options['shadow_window'] = False
+    pyglet.options['debug_gl'] = False #(as for headlessGL, which later tests use)
+    from pycrsltd import bits
+    win = headlessGL.Win((600,8))
+    win.monitor = monitor
+    return bits.BitsBox(win, mode='bits++')
+
+def test_precomputeLUTs():
+    #each row is exactly what setLUT would have made
+    bitsBox = _bitsBox(Monitor())
+    contrasts = [1.0, 0.5, 0.123, 0.0, 0.77, 0.3]
+    gammas = [1.0, 2.2, [1.8, 2.0, 2.4], 2.2, 1.0, 3.0]
+    LUTranges = [1.0, 0.5, [63,127], [0.1,0.2], 1.0, [0,255]]
+    rows = bitsBox.precomputeLUTs(contrasts=contrasts, gammas=gammas, LUTranges=LUTranges)
+    assert rows.shape==(6,524,3) and rows.dtype==numpy.uint8
+    for n, (contrast, gamma, LUTrange) in enumerate(zip(contrasts, gammas, LUTranges)):
+        expected = _bitsBox(Monitor())
+        expected.gamma = gamma
+        expected.setContrast(contrast, LUTrange)
+        assert (rows[n]==expected._HEADandLUT[:,0,:]).all()
+        #and using it gives the LUT that setLUT would (to 16 bits)
+        bitsBox.usePrecomputedLUT(rows, n)
+        assert bitsBox._LUTdirty==(0,256)
+        assert (bitsBox._HEADandLUT==expected._HEADandLUT).all()
+        assert numpy.abs(bitsBox.LUT-expected.LUT).max() <= 1.0/65535
+    #and the same with LUTs given explicitly (1D or nx3)
+    newLUTs = [numpy.linspace(0, 1, 65), numpy.random.RandomState(0).uniform(0, 1, (256,3))]
+    bitsBox = _bitsBox(Monitor())
+    rows = bitsBox.precomputeLUTs(newLUTs=newLUTs, gammas=[2.0, 1.5], LUTranges=[[0,64], 1.0])
+    for n, (newLUT, gamma, LUTrange) in enumerate(zip(newLUTs, [2.0, 1.5], [[0,64], 1.0])):
+        expected = _bitsBox(Monitor())
+        expected.gamma = gamma
+        expected.setLUT(newLUT, LUTrange=LUTrange)
+        assert (rows[n]==expected._HEADandLUT[:,0,:]).all()
+
+def test_partialSetLUT():
+    from pycrsltd import encode
+    bitsBox = _bitsBox()
+    bitsBox._LUTdirty = None #(as if sent to the screen)
+    before = bitsBox._HEADandLUT.copy()
+    bitsBox.setContrast(0.3, [63,127])
+    assert bitsBox._LUTdirty==(63,128)
+    #only the rows for those entries are re-encoded...
+    changed = numpy.flatnonzero((bitsBox._HEADandLUT!=before).any(axis=2).any(axis=1))
+    assert changed.min()>=12+2*63 and changed.max()<12+2*128
+    assert (bitsBox._HEADandLUT[:12+2*63]==before[:12+2*63]).all()
+    assert (bitsBox._HEADandLUT[12+2*128:]==before[12+2*128:]).all()
+    #...and those are just the encoding of the new LUT
+    assert (bitsBox._HEADandLUT[:,0,:]==encode.bitsPlusPlusLUT(bitsBox.LUT)).all()
+    #further changes grow the range until it's used
+    bitsBox.setContrast(0.8, 0.1)
+    assert bitsBox._LUTdirty==(63,141)
+    bitsBox.setContrast(0.5, [0.0,0.02])
+    assert bitsBox._LUTdirty==(0,141)
+    assert (bitsBox._HEADandLUT[:,0,:]==encode.bitsPlusPlusLUT(bitsBox.LUT)).all()
+
+def test_LUTcache():
+    from pycrsltd import bits
+    bitsBox, expected = _bitsBox(Monitor()), _bitsBox(Monitor())
+    bitsBox.enableLUTcache(maxSize=2)
+    cache = bitsBox.LUTcache
+    #a repeated setting is a hit, and gives the same LUT
+    for contrast in [0.5, 0.7, 0.5]:
+        bitsBox.setContrast(contrast)
+        expected.setContrast(contrast)
+        assert (bitsBox._HEADandLUT==expected._HEADandLUT).all()
+    assert (cache.hits, cache.misses, len(cache))==(1, 2, 2)
+    #the gamma and range are part of the key
+    bitsBox.gamma = expected.gamma = 2.0
+    bitsBox.setContrast(0.5)
+    expected.setContrast(0.5)
+    assert (bitsBox._HEADandLUT==expected._HEADandLUT).all()
+    assert (cache.hits, cache.misses)==(1, 3)
+    #that evicted the least recently used (contrast 0.7, gamma 1)...
+    bitsBox.gamma = expected.gamma = 1.0
+    bitsBox.setContrast(0.5)
+    assert (cache.hits, cache.misses)==(2, 3)
+    bitsBox.setContrast(0.7)
+    assert (cache.hits, cache.misses)==(2, 4) and len(cache)==2
+    #...as does the LUTCache itself
+    lru = bits.LUTCache(maxSize=2)
+    lru.add('a', 1)
+    lru.add('b', 2)
+    assert lru.get('a')==1 #so 'b' is now the oldest
+    lru.add('c', 3)
+    assert lru.get('b') is None and lru.get('a')==1 and lru.get('c')==3
+    #a newLUT array that's changed in place is a different LUT
+    newLUT = numpy.linspace(0, 1, 256)
+    bitsBox.setLUT(newLUT)
+    newLUT[:128] = 0.25
+    bitsBox.setLUT(newLUT)
+    expected.setLUT(newLUT)
+    assert (bitsBox._HEADandLUT==expected._HEADandLUT).all()
+    assert cache.misses==6
+    bitsBox.setLUT(newLUT.copy())
+    assert cache.hits==3
+    cache.clear()
+    assert len(cache)==0
+
+def test_setLUTAsync():
+    bitsBox, expected = _bitsBox(), _bitsBox()
+    for contrast, LUTrange in [(0.5, 1.0), (0.2, [63,127])]:
+        bitsBox.contrast = contrast
+        bitsBox.setLUTAsync(LUTrange=LUTrange)
+        expected.setContrast(contrast, LUTrange)
+        #wait for the background thread
+        t0 = time.time()
+        while bitsBox._asyncLUTready is None and time.time()-t0<2.0:
+            time.sleep(0.001)
+        #nothing changes until the next screen refresh
+        assert not (bitsBox._HEADandLUT==expected._HEADandLUT).all()
+        bitsBox._swapAsyncLUT()
+        assert (bitsBox._HEADandLUT==expected._HEADandLUT).all()
+        assert (bitsBox.LUT==expected.LUT).all()
+
+def test_setLUTAsyncThenSetLUT():
+    bitsBox, expected = _bitsBox(), _bitsBox()
+    #a setLUT after setLUTAsync wins, even if the async LUT is ready by then
+    bitsBox.contrast = 0.3
+    bitsBox.setLUTAsync()
+    t0 = time.time()
+    while bitsBox._asyncLUTready is None and time.time()-t0<2.0:
+        time.sleep(0.001)
+    bitsBox.setContrast(0.7)
+    expected.setContrast(0.7)
+    bitsBox._swapAsyncLUT()
+    assert (bitsBox._HEADandLUT==expected._HEADandLUT).all()
+    #close() stops the thread, so the BitsBox can be freed
+    thread = bitsBox._asyncLUTthread
+    bitsBox.close()
+    assert not thread.is_alive() and bitsBox._asyncLUTthread is None
+    ref = weakref.ref(bitsBox)
+    del bitsBox
+    gc.collect()
+    assert ref() is None
+
+def test_scheduleLUTs():
+    bitsBox, expected = _bitsBox(), _bitsBox()
+    timeline = {0: (0.5, 1.0),
+                3: (1.0, [63,127]),
+                4: {'newLUT': numpy.linspace(0, 1, 65), 'LUTrange': [0,64]},
+                6: 0.5}
+    scheduler = bitsBox.scheduleLUTs(timeline, ringSize=2)
+    t0 = time.time()
+    while scheduler.nPrefetched<2 and time.time()-t0<2.0:
+        time.sleep(0.001)
+    assert scheduler.prefetchedUpTo==3 #limited by the size of the ring
+    for frameN in range(8):
+        bitsBox._LUTscheduler.onFlip() #as for each screen refresh
+        if frameN in timeline:
+            settings = timeline[frameN]
+            if frameN==0 or frameN==3:
+                expected.setContrast(*settings)
+            elif frameN==4:
+                expected.setLUT(**settings)
+            else:
+                expected.setLUT(numpy.asarray(settings))
+        assert (bitsBox._HEADandLUT==expected._HEADandLUT).all()
+        time.sleep(0.01) #for the next LUT to be built
+    assert scheduler.nApplied==4 and scheduler.missedDeadlines==[]
+
+def test_scheduleLUTsLate():
+    import threading
+    bitsBox, expected = _bitsBox(), _bitsBox()
+    #each LUT can only be built once it's allowed
+    allowed = threading.Semaphore(0)
+    buildLUT = bitsBox._buildLUT
+    def gatedBuildLUT(*args):
+        allowed.acquire()
+        buildLUT(*args)
+    bitsBox._buildLUT = gatedBuildLUT
+    scheduler = bitsBox.scheduleLUTs({0: (0.2, 1.0), 1: (0.4, 1.0), 2: (0.6, 1.0)})
+    for frameN in range(4):
+        if frameN>0:
+            allowed.release()
+            t0 = time.time()
+            while scheduler.nPrefetched<frameN and time.time()-t0<2.0:
+                time.sleep(0.001)
+        scheduler.onFlip()
+        #each LUT is applied a frame late, and each refresh it wasn't is recorded
+        assert scheduler.nApplied==frameN
+        assert scheduler.missedDeadlines==[(n, n) for n in range(min(frameN+1, 3))]
+    expected.setContrast(0.6)
+    assert (bitsBox._HEADandLUT==expected._HEADandLUT).all()
+    scheduler.stop()
+
+if __name__ == "__main__":
+    test_precomputeLUTs()
+    test_partialSetLUT()
+    test_LUTcache()
+    test_setLUTAsync()
+    test_setLUTAsyncThenSetLUT()
+    test_scheduleLUTs()
+    test_scheduleLUTsLate()
+    print 'done'
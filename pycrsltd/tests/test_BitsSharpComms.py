@@ -0,0 +1,328 @@
+"""Tests for the serial protocol of BitsSharp, talking to a fake Bits#
+(see fakeBitsSharp.py)
+"""
+
+import time, threading
+import numpy
+from nose.plugins.skip import SkipTest
+from fakeBitsSharp import FakeBitsSharp, FakeAsyncBitsSharp, FakeThreadedBitsSharp, videoLine
+from pycrsltd.bits import asyncio
+
+def test_getInfo():
+    box = FakeBitsSharp(latency=0.005)
+    t0 = time.time()
+    info = box.getInfo()
+    #a few round trips, not fixed sleeps
+    assert time.time()-t0 < 0.2
+    assert info=={'ProductType': 'Bits_Sharp', 'SerialNumber': 'BS1234',
+                  'FirmwareDate': '2013-05-01'}
+
+def test_readResponse():
+    box = FakeBitsSharp(latency=0.01, chunkSize=3)
+    #two replies arriving together are returned one at a time
+    box.sendMessage('$ProductType')
+    box.sendMessage('$FirmwareDate')
+    assert box.readResponse()=='#ProductType;Bits_Sharp;\n\r'
+    assert box.readResponse()=='#FirmwareDate;2013-05-01;\n\r'
+    #no reply: gives up at the deadline
+    t0 = time.time()
+    assert box.readResponse(timeout=0.05)==''
+    assert 0.04 < time.time()-t0 < 0.5
+
+def test_lateReplies():
+    box = FakeBitsSharp()
+    #a reply that times out part way through...
+    box._com.send('#ProductType;Bits_')
+    box._com.send('Sharp;\n\r', delay=0.1)
+    assert box.readResponse(timeout=0.03)=='#ProductType;Bits_'
+    #...has the rest dropped, rather than taken as the start of the next one
+    assert box._query('SerialNumber')=='BS1234'
+    #and replies to other commands are skipped
+    box._com.send('#FirmwareDate;2013-05-01;\n\r')
+    assert box._query('ProductType')=='Bits_Sharp'
+
+def test_getVideoLine():
+    box = FakeBitsSharp()
+    vals = box.getVideoLine(lineN=50, nPixels=5)
+    assert (vals==numpy.array(videoLine(50, 5))).all()
+
+def test_stateMirror():
+    box = FakeBitsSharp()
+    sent = box._com.written
+    box.startMonoPlusPlusMode()
+    box.startMonoPlusPlusMode() #already in mono++
+    box.setTemporalDithering(False)
+    box.setTemporalDithering(False)
+    box.setGammaCorrection('linear.txt')
+    box.setGammaCorrection('linear.txt')
+    box.setMonitorEDID('automatic.edid')
+    box.setMonitorEDID('automatic.edid')
+    assert sent==['$monoPlusPlus\r', '$TemporalDithering=[OFF]\r',
+                  '$enableGammaCorrection=[linear.txt]\r', '$setMonitorType=[automatic.edid]\r']
+    assert box.state['mode']=='mono++' and box.state['gammaFile']=='linear.txt'
+    #changes and forced commands are sent
+    box.startColourPlusPlusMode()
+    box.startColourPlusPlusMode(force=True)
+    assert sent[-2:]==['$colourPlusPlus\r', '$colourPlusPlus\r']
+    #the info is only read once
+    info = box.getInfo()
+    nSent = len(sent)
+    assert box.getInfo()==info and len(sent)==nSent
+    #until refreshed, which also forgets the mode etc
+    assert box.refresh()==info and len(sent)==nSent+3
+    assert 'mode' not in box.state
+    box.startColourPlusPlusMode()
+    assert sent[-1]=='$colourPlusPlus\r'
+
+def _expectedRegion(lines, nPixels):
+    return numpy.array([videoLine(lineN, nPixels) for lineN in lines], numpy.uint8)
+
+def test_getVideoRegion():
+    box = FakeBitsSharp(latency=0.02, chunkSize=50)
+    lines = range(100, 140)
+    rows = []
+    def callback(rowN, lineN, row):
+        rows.append((rowN, lineN, row.copy()))
+    t0 = time.time()
+    region = box.getVideoRegion(lines, nPixels=4, callback=callback, maxPending=8)
+    #pipelined, rather than a round trip (latency) per line
+    assert time.time()-t0 < 0.02*len(lines)/2
+    assert region.shape==(40, 4, 3) and region.dtype==numpy.uint8
+    assert (region==_expectedRegion(lines, 4)).all()
+    assert [(rowN, lineN) for rowN, lineN, row in rows]==list(enumerate(lines))
+    assert (rows[5][2]==region[5]).all()
+    #and an int means lines 0 to n-1
+    assert (box.getVideoRegion(3, nPixels=2)==_expectedRegion(range(3), 2)).all()
+
+def test_slowVideoLine():
+    box = FakeBitsSharp()
+    fake = box._com
+    def write(msg, write=fake.write):
+        #the reply for line 1 arrives after getVideoRegion stops waiting for it
+        if msg.startswith('$GetVideoLine=[1 '):
+            fake.written.append(msg)
+            fake.send(fake.reply(msg), delay=0.3)
+        else:
+            write(msg)
+    fake.write = write
+    region = box.getVideoRegion(5, nPixels=3, timeout=0.2)
+    #so that row is left empty, and its reply isn't taken for the next line's
+    assert (region[1]==0).all()
+    expected = _expectedRegion(range(5), 3)
+    assert (region[[0,2,3,4]]==expected[[0,2,3,4]]).all()
+    assert not box._lateReplies['GetVideoLine']
+    #nor is a timed-out query's reply taken for the next one
+    fake.write = lambda msg: fake.send(fake.reply(msg), delay=0.1)
+    assert box._query('ProductType', timeout=0.02)==''
+    assert box._query('ProductType')=='Bits_Sharp'
+
+def _asyncBox(**fakeArgs):
+    if asyncio is None:
+        raise SkipTest('needs asyncio (or trollius)')
+    loop = asyncio.new_event_loop()
+    return loop, FakeAsyncBitsSharp(loop=loop, **fakeArgs)
+
+def test_asyncGetInfo():
+    loop, box = _asyncBox(latency=0.01, chunkSize=3)
+    try:
+        info = loop.run_until_complete(box.getInfo())
+        assert info=={'ProductType': 'Bits_Sharp', 'SerialNumber': 'BS1234',
+                      'FirmwareDate': '2013-05-01'}
+    finally:
+        box.close()
+        loop.close()
+
+def test_asyncConcurrentRequests():
+    loop, box = _asyncBox(latency=0.01)
+    try:
+        #several requests outstanding at once, each gets its own reply
+        lines = [box.getVideoLine(lineN=lineN, nPixels=4) for lineN in [3, 7, 9]]
+        product = box.query('ProductType')
+        results = loop.run_until_complete(asyncio.gather(product, *lines, loop=loop))
+        assert results[0]=='Bits_Sharp'
+        for lineN, vals in zip([3, 7, 9], results[1:]):
+            assert (vals==numpy.array(videoLine(lineN, 4))).all()
+    finally:
+        box.close()
+        loop.close()
+
+def test_asyncGetVideoRegion():
+    loop, box = _asyncBox(latency=0.01, chunkSize=50)
+    try:
+        rowNs = []
+        region = loop.run_until_complete(box.getVideoRegion(range(10, 30), nPixels=8,
+                                         callback=lambda rowN, lineN, row: rowNs.append(rowN)))
+        assert (region==_expectedRegion(range(10, 30), 8)).all()
+        assert rowNs==range(20)
+    finally:
+        box.close()
+        loop.close()
+
+def test_asyncSlowRegion():
+    #a region that takes longer than the timeout for one line, because the box
+    #takes a while over each reply, only needs each line within the timeout
+    loop, box = _asyncBox(latency=0.005, replyTime=0.02)
+    try:
+        sent = []
+        region = loop.run_until_complete(box.getVideoRegion(range(30), nPixels=2, maxPending=4, timeout=0.3,
+                                         callback=lambda rowN, lineN, row: sent.append(len(box._com.written))))
+        assert (region==_expectedRegion(range(30), 2)).all()
+        #and no more than maxPending requests were waiting at once
+        assert max([nSent-rowN-1 for rowN, nSent in enumerate(sent)]) <= 4
+    finally:
+        box.close()
+        loop.close()
+
+def test_asyncTimeout():
+    loop, box = _asyncBox()
+    try:
+        #the fake box never replies to this
+        future = box.request('Unknown', timeout=0.05)
+        try:
+            loop.run_until_complete(future)
+        except asyncio.TimeoutError:
+            pass
+        else:
+            raise AssertionError('request without a reply should time out')
+        #and close() cancels anything still waiting
+        pending = box.query('ProductType')
+        box.close()
+        try:
+            loop.run_until_complete(pending)
+        except asyncio.CancelledError:
+            pass
+        else:
+            raise AssertionError('close() should cancel pending requests')
+    finally:
+        loop.close()
+
+def test_threadedCommands():
+    box = FakeThreadedBitsSharp(latency=0.005, chunkSize=7)
+    try:
+        assert box.getInfo()['SerialNumber']=='BS1234'
+        #several threads reading video lines while another switches modes
+        errors = []
+        def readLines(lineNs):
+            for lineN in lineNs:
+                vals = box.getVideoLine(lineN=lineN, nPixels=6)
+                if not (vals==numpy.array(videoLine(lineN, 6))).all():
+                    errors.append(lineN)
+        def switchModes():
+            for n in range(20):
+                box.startMonoPlusPlusMode()
+                box.startColourPlusPlusMode()
+        threads = [threading.Thread(target=readLines, args=(range(n, 40, 4),)) for n in range(4)]
+        threads.append(threading.Thread(target=switchModes))
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join(5.0)
+        assert errors==[]
+        assert box._com.written.count('$monoPlusPlus\r')==20
+        region = box.getVideoRegion(range(5, 25), nPixels=10, maxPending=4)
+        assert (region==_expectedRegion(range(5, 25), 10)).all()
+        #no reply: gives up at the timeout (but keeps its place, in case the
+        #reply arrives late)
+        t0 = time.time()
+        assert box._query('Unknown', timeout=0.05)==''
+        assert time.time()-t0 < 0.5
+        assert box._waiting['Unknown'][0].abandoned is not None
+    finally:
+        box.close()
+    assert box._thread is None
+
+class SlowSendBox(FakeThreadedBitsSharp):
+    """Pauses after sending each message (as if the thread were pre-empted)
+    """
+    def sendMessage(self, msg):
+        FakeThreadedBitsSharp.sendMessage(self, msg)
+        time.sleep(0.001)
+
+def test_threadedStateMirror():
+    box = SlowSendBox()
+    try:
+        #threads switching modes at once leave the mirror matching the box
+        modes = {'mono++': ('startMonoPlusPlusMode', '$monoPlusPlus\r'),
+                 'color++': ('startColourPlusPlusMode', '$colourPlusPlus\r'),
+                 'bits++': ('startBitsPlusPlusMode', '$BitsPlusPlus\r')}
+        def switch(order):
+            for n in range(30):
+                getattr(box, modes[order[n%3]][0])()
+        threads = [threading.Thread(target=switch, args=(order,))
+                   for order in [['mono++', 'color++', 'bits++'], ['bits++', 'mono++', 'color++']]]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join(5.0)
+        assert box._com.written[-1]==modes[box.state['mode']][1]
+    finally:
+        box.close()
+
+def test_threadedLateReplies():
+    box = FakeThreadedBitsSharp(latency=0.1)
+    try:
+        #a reply that arrives after its request timed out is dropped, not
+        #given to the next request for the same command
+        first = box.request('GetVideoLine', '$GetVideoLine=[5 3]\r')
+        assert first.result(timeout=0.02)==''
+        vals = box.getVideoLine(lineN=7, nPixels=3)
+        assert (vals==numpy.array(videoLine(7, 3))).all()
+        #replies that nobody asked for go to readResponse (as for BitsSharp)
+        box.sendMessage('$ProductType')
+        assert box.readResponse(timeout=1.0)=='#ProductType;Bits_Sharp;\n\r'
+        assert box.readResponse(timeout=0.01)==''
+    finally:
+        box.close()
+
+def test_asyncLateReplies():
+    loop, box = _asyncBox(latency=0.1)
+    try:
+        first = box.getVideoLine(lineN=5, nPixels=3)
+        loop.call_later(0.02, first.cancel)
+        second = box.getVideoLine(lineN=7, nPixels=3)
+        vals = loop.run_until_complete(second)
+        assert first.cancelled()
+        assert (vals==numpy.array(videoLine(7, 3))).all()
+        #replies that nobody asked for go to readResponse, without blocking the loop
+        response = box.readResponse(timeout=1.0)
+        ticks = []
+        def tick():
+            ticks.append(time.time())
+            if not response.done():
+                loop.call_later(0.005, tick)
+        loop.call_soon(tick)
+        box.sendMessage('$ProductType')
+        assert loop.run_until_complete(response)=='#ProductType;Bits_Sharp;\n\r'
+        assert len(ticks)>5
+        try:
+            loop.run_until_complete(box.readResponse(timeout=0.01))
+        except asyncio.TimeoutError:
+            pass
+        else:
+            raise AssertionError("readResponse didn't time out")
+        #and any that arrived before readResponse are kept for it
+        box.sendMessage('$FirmwareDate')
+        loop.run_until_complete(asyncio.sleep(0.2, loop=loop))
+        assert loop.run_until_complete(box.readResponse())=='#FirmwareDate;2013-05-01;\n\r'
+    finally:
+        box.close()
+        loop.close()
+
+if __name__ == "__main__":
+    test_getInfo()
+    test_readResponse()
+    test_lateReplies()
+    test_getVideoLine()
+    test_stateMirror()
+    test_getVideoRegion()
+    test_slowVideoLine()
+    test_asyncGetInfo()
+    test_asyncConcurrentRequests()
+    test_asyncGetVideoRegion()
+    test_asyncSlowRegion()
+    test_asyncTimeout()
+    test_threadedCommands()
+    test_threadedStateMirror()
+    test_threadedLateReplies()
+    test_asyncLateReplies()
+    print 'done'
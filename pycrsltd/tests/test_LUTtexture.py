@@ -0,0 +1,104 @@
+"""Tests for drawing the bits++ header+LUT row (from its texture) to the top
+line of the screen (these need an OpenGL context, see headlessGL.py)
+"""
+
+import numpy
+import headlessGL
+
+def _topLine():
+    from OpenGL import GL
+    GL.glPixelStorei(GL.GL_PACK_ALIGNMENT, 1)
+    line = GL.glReadPixels(0, 7, 600, 1, GL.GL_RGB, GL.GL_UNSIGNED_BYTE) #bottom-up
+    return numpy.frombuffer(line, numpy.uint8).reshape([600,3])
+
+def test_drawLUTtoScreen():
+    closeContext = headlessGL.getContext(600, 8)
+    from pycrsltd import bits, decode
+    from OpenGL import GL
+    try:
+        bitsBox = bits.BitsBox(headlessGL.Win((600,8)), mode='bits++')
+        bitsBox.setContrast(0.5)
+        bitsBox._drawLUTtoScreen()
+        assert bitsBox._LUTdirty is None
+        assert (_topLine()[:524]==bitsBox._HEADandLUT[:,0,:]).all()
+        #change part of the LUT: just that part is updated
+        bitsBox.setContrast(1.0, [63,127])
+        assert bitsBox._LUTdirty==(63,128)
+        bitsBox._drawLUTtoScreen()
+        LUT = decode.bitsPlusPlusLUT(_topLine())
+        assert (LUT==(bitsBox.LUT*65535).astype(numpy.uint16)).all()
+        assert GL.glGetError()==GL.GL_NO_ERROR
+    finally:
+        closeContext()
+
+def test_drawPixels():
+    closeContext = headlessGL.getContext(600, 8)
+    from pycrsltd import bits
+    from OpenGL import GL
+    try:
+        bitsBox = bits.BitsBox(headlessGL.Win((600,8)), mode='bits++')
+        bitsBox.setContrast(0.5)
+        GL.glPixelStorei(GL.GL_UNPACK_ALIGNMENT, 1)
+        GL.glWindowPos2i(0, 7)
+        GL.glDrawPixels(524,1, GL.GL_RGB,GL.GL_UNSIGNED_BYTE, bitsBox._HEADandLUTstr)
+        assert (_topLine()[:524]==bitsBox._HEADandLUT[:,0,:]).all()
+        #it follows later changes to the LUT
+        bitsBox.setContrast(-1.0, [63,127])
+        GL.glDrawPixels(524,1, GL.GL_RGB,GL.GL_UNSIGNED_BYTE, bitsBox._HEADandLUTstr)
+        assert (_topLine()[:524]==bitsBox._HEADandLUT[:,0,:]).all()
+        assert GL.glGetError()==GL.GL_NO_ERROR
+    finally:
+        closeContext()
+
+def test_profiler():
+    closeContext = headlessGL.getContext(600, 8)
+    from pycrsltd import bits
+    from OpenGL import GL
+    try:
+        bitsBox = bits.BitsBox(headlessGL.Win((600,8)), mode='bits++')
+        profiler = bitsBox.enableProfiler(frameBudget=1.0)
+        for frameN in range(5):
+            bitsBox.setContrast(frameN/5.0)
+            bitsBox._drawLUTtoScreen()
+        #results only arrive once the card has finished with them
+        GL.glFinish()
+        profiler.endFrame()
+        assert len(profiler.frames)==5 and not profiler._pending
+        for frame in profiler.frames:
+            assert 0<=frame['gpu']['LUT']<1.0 and frame['cpu']['LUT']>0
+            assert not frame['overran']
+        stats = profiler.stats()
+        assert stats['nFrames']==5 and stats['gpu:LUT']['max']>=stats['gpu:LUT']['mean']
+        #an impossible budget flags every frame
+        profiler.frameBudget = 1e-12
+        bitsBox._drawLUTtoScreen()
+        GL.glFinish()
+        profiler.endFrame()
+        assert profiler.frames[-1]['overran'] and profiler.nOverruns==1
+        #a section begun again before it ended doesn't lose its queries
+        nQueries = len(profiler._allQueries)
+        for n in range(3*profiler.poolSize):
+            profiler.begin('encode')
+        profiler.end('encode')
+        GL.glFinish()
+        profiler.endFrame()
+        assert len(profiler._allQueries)==nQueries and not profiler._open
+        assert len(profiler._freeQueries)==len(profiler._allQueries)
+        #a section still open at the end of the frame ends with it
+        profiler.begin('encode')
+        profiler.endFrame()
+        profiler.end('encode')
+        GL.glFinish()
+        profiler.endFrame()
+        assert 'encode' in profiler.frames[-1]['gpu'] and not profiler._open
+        assert len(profiler._freeQueries)==len(profiler._allQueries)
+        bitsBox.close()
+        assert bitsBox.profiler is None
+    finally:
+        closeContext()
+
+if __name__ == "__main__":
+    test_drawLUTtoScreen()
+    test_drawPixels()
+    test_profiler()
+    print 'done'
@@ -0,0 +1,50 @@
+"""Tests for uploading encoded frames through a ring of pixel buffer objects
+(these need an OpenGL context, see headlessGL.py)
+"""
+
+import numpy
+import headlessGL
+
+def test_PBOFrameUploader():
+    closeContext = headlessGL.getContext(64, 32)
+    from pycrsltd import bits
+    from OpenGL import GL
+    try:
+        frames = numpy.random.randint(0, 256, [6,32,64,3]).astype(numpy.uint8)
+        uploader = bits.PBOFrameUploader(64, 32, nBuffers=3)
+        for frame in frames:
+            texture = uploader.upload(frame)
+            GL.glFinish()
+            GL.glBindTexture(GL.GL_TEXTURE_2D, texture)
+            GL.glPixelStorei(GL.GL_PACK_ALIGNMENT, 1)
+            uploaded = GL.glGetTexImage(GL.GL_TEXTURE_2D, 0, GL.GL_RGB, GL.GL_UNSIGNED_BYTE)
+            uploaded = numpy.frombuffer(uploaded, numpy.uint8).reshape(frame.shape)
+            assert (uploaded==frame).all()
+        #one entry per upload, and after glFinish() there's nothing to wait for
+        assert uploader.stalls==[0]*6 and uploader.nStalls==0
+        uploader.delete()
+    finally:
+        closeContext()
+
+def test_playFrames():
+    closeContext = headlessGL.getContext(64, 32)
+    from pycrsltd import bits
+    from OpenGL import GL
+    try:
+        win = headlessGL.Win((64,32))
+        bitsBox = bits.BitsBox(win, mode='mono++')
+        frames = numpy.random.randint(0, 256, [5,32,64,3]).astype(numpy.uint8)
+        assert bitsBox.playFrames(frames, nBuffers=2)==5
+        assert win.nFlips==5 and len(bitsBox.frameStalls)==5
+        #the last frame should be on the screen (glReadPixels reads bottom-up)
+        GL.glPixelStorei(GL.GL_PACK_ALIGNMENT, 1)
+        onScreen = GL.glReadPixels(0, 0, 64, 32, GL.GL_RGB, GL.GL_UNSIGNED_BYTE)
+        onScreen = numpy.frombuffer(onScreen, numpy.uint8).reshape([32,64,3])
+        assert (onScreen[::-1]==frames[-1]).all()
+    finally:
+        closeContext()
+
+if __name__ == "__main__":
+    test_PBOFrameUploader()
+    test_playFrames()
+    print 'done'
@@ -0,0 +1,43 @@
+"""Tests for decoding Bits++, Mono++ and Color++ framebuffers (checked against
+the encoders)
+"""
+
+from pycrsltd import encode, decode
+import numpy
+
+def test_bitsPlusPlusLUT():
+    LUT16 = numpy.random.randint(0, 2**16, [256,3])
+    row = numpy.zeros([2,600,3], numpy.uint8) #a stack of two screen lines
+    row[:,:12] = encode.bitsPlusPlusHeader
+    row[:,12:524:2] = LUT16>>8
+    row[:,13:524:2] = LUT16&255
+    assert decode.isBitsPlusPlusRow(row).all()
+    assert (decode.bitsPlusPlusLUT(row)==LUT16).all()
+    #a line without the header
+    try:
+        decode.bitsPlusPlusLUT(numpy.zeros([524,3], numpy.uint8))
+    except ValueError:
+        pass
+    else:
+        raise AssertionError("bitsPlusPlusLUT() should check the header")
+
+def test_monoPlusPlus():
+    lums = numpy.random.random([3,10,12])
+    lums16 = decode.monoPlusPlus(encode.monoPlusPlus(lums))
+    assert lums16.shape==lums.shape
+    assert (lums16==numpy.floor(lums*65535)).all()
+
+def test_colorPlusPlus():
+    img = numpy.random.random([3,10,12,3])
+    img16 = decode.colorPlusPlus(encode.colorPlusPlus(img, sampleSpacing=0.5))
+    assert img16.shape==img.shape
+    assert (img16==numpy.floor(img*65535+0.5)).all()
+    #values from BitsSharp.getVideoLine() are ints
+    line = numpy.array([[1,2,3],[4,5,6]])
+    assert (decode.colorPlusPlus(line)==[[260,517,774]]).all()
+
+if __name__ == "__main__":
+    test_bitsPlusPlusLUT()
+    test_monoPlusPlus()
+    test_colorPlusPlus()
+    print 'done'
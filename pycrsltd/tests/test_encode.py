@@ -0,0 +1,96 @@
+"""Tests for the CPU (numpy) versions of the Mono++ and Color++ encodings
+"""
+
+from pycrsltd import encode, decode
+import numpy
+import os, shutil, tempfile
+
+def test_monoPlusPlus():
+    lums = numpy.array([[0.0, 1.0, 0.5, 1000/65535.0]])
+    out = encode.monoPlusPlus(lums)
+    assert out.shape==(1,4,3)
+    assert (out[0,:,0]==[0, 255, 127, 3]).all()
+    assert (out[0,:,1]==[0, 255, 255, 232]).all()
+    assert (out[...,2]==0).all()
+
+def test_colorPlusPlus():
+    img = numpy.zeros([2,4,3])
+    img[:,0] = [0.0, 1.0, 1000/65535.0]
+    img[:,1] = 0.5 #odd columns are not sampled with sampleSpacing=1.0
+    img[:,2] = 0.5
+    out = encode.colorPlusPlus(img)
+    assert out.shape==(2,4,3)
+    assert (out[:,0]==[0, 255, 3]).all() #high bytes
+    assert (out[:,1]==[0, 255, 232]).all() #low bytes
+    assert (out[:,2]==[128, 128, 128]).all() #0.5 rounds up to 32768
+    assert (out[:,3]==[0, 0, 0]).all()
+    #with sampleSpacing=0.5 every column is used and the output is twice as wide
+    out = encode.colorPlusPlus(img, sampleSpacing=0.5)
+    assert out.shape==(2,8,3)
+    assert (out[:,2]==128).all()
+
+def test_gammaCorrect():
+    img = numpy.array([[0.25, 0.5, 2.0]])
+    out = encode.gammaCorrect(img, encodingGamma=[0.5, 1.0, 1.0], outputGain=0.5, outputBias=0.1)
+    assert numpy.allclose(out, [[0.35, 0.35, 0.6]])
+    #a reversed luminance range (a negative contrast) inverts, and still clamps
+    out = encode.gammaCorrect(numpy.array([[-1.0, 0.25, 2.0]]), minInLuminance=1.0, maxInLuminance=0.0)
+    assert numpy.allclose(out, [[1.0, 0.75, 0.0]])
+
+def test_chunksAndOut():
+    #chunked encoding into a preallocated array should match a single pass
+    frames = numpy.random.random([10,6,8,3])
+    whole = encode.colorPlusPlus(frames, chunkSize=100, encodingGamma=0.45)
+    out = numpy.zeros(whole.shape, numpy.uint8)
+    result = encode.colorPlusPlus(frames, out=out, chunkSize=3, encodingGamma=0.45)
+    assert result is out
+    assert (out==whole).all()
+    whole = encode.monoPlusPlus(frames[...,0], chunkSize=100)
+    assert (encode.monoPlusPlus(frames[...,0], chunkSize=4)==whole).all()
+
+def test_bitsPlusPlus():
+    img = numpy.zeros([2,600,3])
+    img[1,:] = [0.0, 0.5, 1.0]
+    LUT = numpy.random.random([256,3])
+    out = encode.bitsPlusPlus(img, LUT=LUT)
+    assert (out[1]==[0, 128, 255]).all()
+    #the top line holds the LUT
+    assert (decode.bitsPlusPlusLUT(out[0])==(LUT*65535).astype(numpy.uint16)).all()
+
+def test_encodeMovie():
+    tmpDir = tempfile.mkdtemp()
+    try:
+        frames = numpy.random.random([20,4,6,3])
+        framesFile = os.path.join(tmpDir, 'frames.npy')
+        numpy.save(framesFile, frames)
+        for mode in ['bits++', 'mono++', 'color++']:
+            expected = encode.encodeFrames(frames, mode)
+            #from an array in this process and from a file in a pool of processes
+            movie, fps = encode.encodeMovie(frames, os.path.join(tmpDir, 'movie.npy'),
+                                            mode, nProcesses=1, framesPerTask=7)
+            assert (movie==expected).all()
+            del movie
+            movie, fps = encode.encodeMovie(framesFile, os.path.join(tmpDir, 'movie.npy'),
+                                            mode, nProcesses=2, framesPerTask=7)
+            assert (movie==expected).all()
+            assert fps>0
+            del movie
+    finally:
+        shutil.rmtree(tmpDir)
+
+def test_moduloLUT():
+    #looking up frac(value/256) in the LUT (as the shader does) gives the low byte
+    values = numpy.arange(65536)
+    LUT = encode.moduloLUT()
+    assert (LUT[((values/256.0)%1.0*256).astype(int)]==values%256).all()
+    assert (encode.moduloLUT(512)[1::2]==numpy.arange(256)).all()
+
+if __name__ == "__main__":
+    test_monoPlusPlus()
+    test_colorPlusPlus()
+    test_gammaCorrect()
+    test_chunksAndOut()
+    test_bitsPlusPlus()
+    test_encodeMovie()
+    test_moduloLUT()
+    print 'done'
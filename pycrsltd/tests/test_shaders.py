@@ -0,0 +1,420 @@
+"""Tests for compiling (and caching) the shader programs (these need an
+OpenGL context, see headlessGL.py)
+"""
+
+import os, shutil, tempfile
+from ctypes import c_int, byref
+import headlessGL
+
+def test_getProgram():
+    closeContext = headlessGL.getContext()
+    from pycrsltd import shaders
+    from pyglet import gl
+    cacheDir = tempfile.mkdtemp()
+    try:
+        shaders._shareGroups.clear()
+        prog = shaders.getProgram(fragment=shaders.bitsColorModeFrag,
+                                  attachments=[shaders.gammaCorrectionFrag], cacheDir=cacheDir)
+        #reused in this context
+        assert prog==shaders.getProgram(fragment=shaders.bitsColorModeFrag,
+                                        attachments=[shaders.gammaCorrectionFrag], cacheDir=cacheDir)
+        #but not for different shaders
+        monoProg = shaders.getProgram(fragment=shaders.bitsMonoModeFrag,
+                                      attachments=[shaders.gammaCorrectionFrag], cacheDir=cacheDir)
+        assert monoProg!=prog
+        #a new session can load the binaries (if the driver provides them)
+        nBinaries = len(os.listdir(cacheDir))
+        shaders._shareGroups.clear()
+        reloaded = shaders.getProgram(fragment=shaders.bitsColorModeFrag,
+                                      attachments=[shaders.gammaCorrectionFrag], cacheDir=cacheDir)
+        status = c_int()
+        gl.glGetProgramiv(reloaded, gl.GL_LINK_STATUS, byref(status))
+        assert status.value
+        assert len(os.listdir(cacheDir))==nBinaries
+        #a corrupt binary is ignored and the program compiled again
+        for filename in os.listdir(cacheDir):
+            open(os.path.join(cacheDir, filename), 'wb').write('\x00'*8)
+        shaders._shareGroups.clear()
+        assert shaders.getProgram(fragment=shaders.bitsColorModeFrag,
+                                  attachments=[shaders.gammaCorrectionFrag], cacheDir=cacheDir)
+        #and if loading it fails the new program isn't leaked
+        created = []
+        glCreateProgram, glProgramBinary = gl.glCreateProgram, gl.glProgramBinary
+        def createProgram():
+            created.append(glCreateProgram())
+            return created[-1]
+        def programBinary(*args):
+            raise gl.GLException('no binaries')
+        gl.glCreateProgram, gl.glProgramBinary = createProgram, programBinary
+        try:
+            open(os.path.join(cacheDir, 'test.bin'), 'wb').write('\x00'*8)
+            assert shaders._loadProgramBinary('test', cacheDir) is None
+        finally:
+            gl.glCreateProgram, gl.glProgramBinary = glCreateProgram, glProgramBinary
+        assert len(created)==1 and not gl.glIsProgram(created[0])
+        #nothing is stored unless asked for
+        assert shaders.programCacheDir is None
+    finally:
+        shaders._shareGroups.clear()
+        shutil.rmtree(cacheDir)
+        closeContext()
+
+def test_lazyBitsShaders():
+    closeContext = headlessGL.getContext()
+    from pycrsltd import bits
+    from OpenGL import GL
+    try:
+        bitsBox = bits.BitsBox(headlessGL.Win((64,32)), mode='color++')
+        #nothing compiled until it's needed, and then only for this mode
+        assert bitsBox.colorModeShader is None and bitsBox.monoModeShader is None
+        bitsBox.loadShader()
+        assert GL.glGetIntegerv(GL.GL_CURRENT_PROGRAM)==bitsBox.colorModeShader
+        assert bitsBox.monoModeShader is None
+        bitsBox.revertShader()
+        assert GL.glGetIntegerv(GL.GL_CURRENT_PROGRAM)==0
+        monoBox = bits.BitsBox(headlessGL.Win((64,32)), mode='mono++')
+        monoBox.warmup()
+        assert monoBox.monoModeShader and monoBox.colorModeShader is None
+    finally:
+        closeContext()
+
+def test_shaderGammaUniforms():
+    closeContext = headlessGL.getContext()
+    from pycrsltd import bits
+    from OpenGL import GL
+    import numpy
+    try:
+        bitsBox = bits.BitsBox(headlessGL.Win((64,32)), mode='color++')
+        bitsBox.setContrast(0.5) #before compiling
+        bitsBox.loadShader()
+        prog = bitsBox.colorModeShader
+        def uniform(name, n=3):
+            values = numpy.zeros(4, 'f')
+            GL.glGetUniformfv(prog, GL.glGetUniformLocation(prog, name), values)
+            return values[:n]
+        assert numpy.allclose(uniform('ICMMinInLuminance'), -0.5)
+        assert numpy.allclose(uniform('ICMReciprocalLuminanceRange'), 0.5)
+        assert not bitsBox.uniforms._dirty
+        #changes are only sent when the shader is next loaded
+        bitsBox.setGamma([2.0, 2.0, 4.0])
+        assert set(bitsBox.uniforms._dirty)==set(['ICMEncodingGamma'])
+        assert numpy.allclose(uniform('ICMEncodingGamma'), 1.0)
+        bitsBox.revertShader()
+        bitsBox.loadShader()
+        assert numpy.allclose(uniform('ICMEncodingGamma'), [0.5, 0.5, 0.25])
+        assert numpy.allclose(uniform('sampleSpacing', 1), 1.0)
+        bitsBox.revertShader()
+        #the mono++ shader also does gamma correction
+        monoBox = bits.BitsBox(headlessGL.Win((64,32)), mode='mono++', gamma=2.0)
+        monoBox.loadShader()
+        assert monoBox.uniforms.location('ICMEncodingGamma')>=0
+        monoBox.revertShader()
+    finally:
+        closeContext()
+
+def test_sharedProgramUniforms():
+    #boxes in the same share group use the same program, but each must draw
+    #with its own uniforms
+    closeContext = headlessGL.getContext()
+    from pycrsltd import bits
+    from OpenGL import GL
+    import numpy
+    try:
+        boxA = bits.BitsBox(headlessGL.Win((64,32)), mode='color++', gamma=2.0)
+        boxB = bits.BitsBox(headlessGL.Win((64,32)), mode='color++', gamma=1.0)
+        def gamma(prog):
+            values = numpy.zeros(4, 'f')
+            GL.glGetUniformfv(prog, GL.glGetUniformLocation(prog, 'ICMEncodingGamma'), values)
+            return values[:3]
+        for box, expected in [(boxA, 0.5), (boxB, 1.0), (boxA, 0.5), (boxA, 0.5), (boxB, 1.0)]:
+            box.loadShader()
+            assert box.colorModeShader==boxA.colorModeShader
+            assert numpy.allclose(gamma(box.colorModeShader), expected)
+            box.revertShader()
+        for box in [boxA, boxB]:
+            box.close()
+    finally:
+        closeContext()
+
+def _drawThroughShader(bitsBox, image):
+    """Draw a float RGB image through the BitsBox's shader and return what
+    reached the framebuffer (top row first)
+    """
+    from OpenGL import GL
+    import numpy
+    height, width = image.shape[:2]
+    GL.glPixelStorei(GL.GL_UNPACK_ALIGNMENT, 1)
+    texture = GL.glGenTextures(1)
+    GL.glBindTexture(GL.GL_TEXTURE_RECTANGLE, texture)
+    GL.glTexParameteri(GL.GL_TEXTURE_RECTANGLE, GL.GL_TEXTURE_MIN_FILTER, GL.GL_NEAREST)
+    GL.glTexParameteri(GL.GL_TEXTURE_RECTANGLE, GL.GL_TEXTURE_MAG_FILTER, GL.GL_NEAREST)
+    GL.glTexImage2D(GL.GL_TEXTURE_RECTANGLE, 0, GL.GL_RGB32F, width, height, 0,
+                    GL.GL_RGB, GL.GL_FLOAT, numpy.ascontiguousarray(image[::-1], numpy.float32))
+    bitsBox.loadShader()
+    GL.glBegin(GL.GL_QUADS)
+    for x, y in [(0,0), (1,0), (1,1), (0,1)]:
+        GL.glTexCoord2f(x*width, y*height)
+        GL.glVertex2f(2*x-1, 2*y-1)
+    GL.glEnd()
+    bitsBox.revertShader()
+    GL.glDeleteTextures([texture])
+    GL.glPixelStorei(GL.GL_PACK_ALIGNMENT, 1)
+    pixels = GL.glReadPixels(0, 0, width, height, GL.GL_RGB, GL.GL_UNSIGNED_BYTE)
+    return numpy.frombuffer(pixels, numpy.uint8).reshape([height, width, 3])[::-1]
+
+def test_gammaTable():
+    closeContext = headlessGL.getContext(64, 8)
+    from pycrsltd import bits, encode, decode
+    import numpy
+    try:
+        bitsBox = bits.BitsBox(headlessGL.Win((64,8)), mode='color++')
+        image = numpy.random.RandomState(1).uniform(0, 1, (8,64,3))
+        table = numpy.linspace(0, 1, 1024)[:,None]**[0.45, 0.5, 0.55]
+        bitsBox.setGammaTable(table)
+        def check():
+            expected = decode.colorPlusPlus(encode.colorPlusPlus(image, gammaTable=bitsBox.gammaTable))
+            drawn = decode.colorPlusPlus(_drawThroughShader(bitsBox, image))
+            #only the precision of the texture filtering differs
+            assert numpy.abs(drawn.astype(int)-expected).max()<=16
+        check()
+        #updating part of the table needn't change the program
+        prog = bitsBox.colorModeShader
+        bitsBox.setGammaTable(numpy.ones((512,3))*0.25, start=512)
+        assert bitsBox.colorModeShader==prog
+        check()
+        #including the first entries
+        bitsBox.setGammaTable(numpy.zeros((16,3)), start=0)
+        assert bitsBox.colorModeShader==prog and len(bitsBox.gammaTable)==1024
+        assert (bitsBox.gammaTable[:16]==0).all() and (bitsBox.gammaTable[16:512]==table[16:512]).all()
+        check()
+        #entries that aren't in the table are an error, not a new table
+        for entries, start in [(numpy.ones((16,3)), 1020), (numpy.ones((16,3)), -1)]:
+            try:
+                bitsBox.setGammaTable(entries, start=start)
+            except ValueError:
+                pass
+            else:
+                raise AssertionError('setGammaTable(start=%i) should fail' %start)
+        assert len(bitsBox.gammaTable)==1024 and bitsBox.colorModeShader==prog
+        #a whole new table of a different size does change the program
+        bitsBox.setGammaTable(table[::4])
+        assert len(bitsBox.gammaTable)==256 and bitsBox.colorModeShader is None
+        check()
+        #back to power-law
+        bitsBox.setGammaTable(None)
+        try:
+            bitsBox.setGammaTable(numpy.ones(16), start=4)
+        except ValueError:
+            pass
+        else:
+            raise AssertionError('setGammaTable(start=4) without a table should fail')
+        assert bitsBox.gammaTable is None
+        bitsBox.setGamma(2.0)
+        expected = encode.colorPlusPlus(image, encodingGamma=0.5)
+        assert numpy.abs(decode.colorPlusPlus(_drawThroughShader(bitsBox, image)).astype(int)
+                         -decode.colorPlusPlus(expected)).max()<=4
+    finally:
+        closeContext()
+
+def _imageTexture(image):
+    """A GL_TEXTURE_2D holding the image (top row first)
+    """
+    from OpenGL import GL
+    import numpy
+    height, width = image.shape[:2]
+    GL.glPixelStorei(GL.GL_UNPACK_ALIGNMENT, 1)
+    texture = GL.glGenTextures(1)
+    GL.glBindTexture(GL.GL_TEXTURE_2D, texture)
+    GL.glTexParameteri(GL.GL_TEXTURE_2D, GL.GL_TEXTURE_MIN_FILTER, GL.GL_NEAREST)
+    GL.glTexParameteri(GL.GL_TEXTURE_2D, GL.GL_TEXTURE_MAG_FILTER, GL.GL_NEAREST)
+    if image.dtype==numpy.uint8:
+        GL.glTexImage2D(GL.GL_TEXTURE_2D, 0, GL.GL_RGB8, width, height, 0,
+                        GL.GL_RGB, GL.GL_UNSIGNED_BYTE, numpy.ascontiguousarray(image[::-1]))
+    else:
+        GL.glTexImage2D(GL.GL_TEXTURE_2D, 0, GL.GL_RGB32F, width, height, 0,
+                        GL.GL_RGB, GL.GL_FLOAT, numpy.ascontiguousarray(image[::-1], numpy.float32))
+    GL.glBindTexture(GL.GL_TEXTURE_2D, 0)
+    return texture
+
+def _readScreen(width, height):
+    from OpenGL import GL
+    import numpy
+    GL.glPixelStorei(GL.GL_PACK_ALIGNMENT, 1)
+    pixels = GL.glReadPixels(0, 0, width, height, GL.GL_RGB, GL.GL_UNSIGNED_BYTE)
+    return numpy.frombuffer(pixels, numpy.uint8).reshape([height, width, 3])[::-1]
+
+def test_drawOutput():
+    closeContext = headlessGL.getContext(600, 8)
+    from pycrsltd import bits, encode, decode
+    from OpenGL import GL
+    import numpy
+    try:
+        rand = numpy.random.RandomState(2)
+        #bits++: the image plus the header+LUT row, in one pass
+        bitsBox = bits.BitsBox(headlessGL.Win((600,8)), mode='bits++')
+        bitsBox.setContrast(0.5)
+        image = rand.randint(0, 256, (8,600,3)).astype(numpy.uint8)
+        bitsBox.drawOutput(_imageTexture(image))
+        drawn = _readScreen(600, 8)
+        assert (drawn[0,:524]==bitsBox._HEADandLUT[:,0,:]).all()
+        assert (drawn[0,524:]==image[0,524:]).all() and (drawn[1:]==image[1:]).all()
+        #mono++ and color++ match the CPU encoders
+        image = rand.uniform(0, 1, (8,600,3))
+        monoBox = bits.BitsBox(headlessGL.Win((600,8)), mode='mono++', gamma=2.0)
+        monoBox.drawOutput(_imageTexture(image))
+        expected = decode.monoPlusPlus(encode.monoPlusPlus(image[...,0], encodingGamma=0.5))
+        assert numpy.abs(decode.monoPlusPlus(_readScreen(600, 8)).astype(int)-expected).max()<=2
+        colorBox = bits.BitsBox(headlessGL.Win((600,8)), mode='color++')
+        colorBox.setContrast(0.5)
+        colorBox.drawOutput(_imageTexture(image))
+        expected = decode.colorPlusPlus(encode.colorPlusPlus(image, minInLuminance=-0.5, maxInLuminance=1.5))
+        assert numpy.abs(decode.colorPlusPlus(_readScreen(600, 8)).astype(int)-expected).max()<=2
+        #a negative contrast inverts the image (in mono++ too)
+        colorBox.setContrast(-1.0)
+        colorBox.drawOutput(_imageTexture(image))
+        expected = decode.colorPlusPlus(encode.colorPlusPlus(1.0-image))
+        assert numpy.abs(decode.colorPlusPlus(_readScreen(600, 8)).astype(int)-expected).max()<=2
+        monoBox.setContrast(-0.5)
+        monoBox.drawOutput(_imageTexture(image))
+        expected = decode.monoPlusPlus(encode.monoPlusPlus(0.75-0.5*image[...,0], encodingGamma=0.5))
+        assert numpy.abs(decode.monoPlusPlus(_readScreen(600, 8)).astype(int)-expected).max()<=2
+        assert GL.glGetError()==GL.GL_NO_ERROR
+    finally:
+        closeContext()
+
+def test_moduloLUT():
+    closeContext = headlessGL.getContext(600, 8)
+    from pycrsltd import bits, encode, decode, shaders
+    from OpenGL import GL
+    import numpy
+    try:
+        monoBox = bits.BitsBox(headlessGL.Win((600,8)), mode='mono++')
+        monoBox.warmup()
+        texture = shaders.getModuloLUTtexture()
+        #one texture per context, shared by all windows
+        assert bits.BitsBox(headlessGL.Win((600,8)), mode='mono++')._getShader() and \
+            shaders.getModuloLUTtexture()==texture
+        GL.glBindTexture(GL.GL_TEXTURE_1D, texture)
+        entries = GL.glGetTexImage(GL.GL_TEXTURE_1D, 0, GL.GL_RED, GL.GL_UNSIGNED_BYTE)
+        GL.glBindTexture(GL.GL_TEXTURE_1D, 0)
+        assert (numpy.frombuffer(entries, numpy.uint8)==encode.moduloLUT()).all()
+        #and the mono++ shader now gives the right low bytes
+        image = numpy.random.RandomState(3).uniform(0, 1, (8,600,3))
+        expected = decode.monoPlusPlus(encode.monoPlusPlus(image[...,0]))
+        drawn = decode.monoPlusPlus(_drawThroughShader(monoBox, image))
+        assert numpy.abs(drawn.astype(int)-expected).max()<=1
+    finally:
+        closeContext()
+
+def test_shareGroups():
+    closeContext = headlessGL.getContext()
+    from pycrsltd import bits, shaders
+    from OpenGL import GL
+    try:
+        shaders._shareGroups.clear()
+        boxes = [bits.BitsBox(headlessGL.Win((64,32)), mode='color++') for n in range(3)]
+        for bitsBox in boxes:
+            bitsBox.warmup()
+        monoBox = bits.BitsBox(headlessGL.Win((64,32)), mode='mono++')
+        monoBox.warmup()
+        #one program for all the color++ windows, and the gamma attachment compiled once
+        prog = boxes[0].colorModeShader
+        assert [bitsBox.colorModeShader for bitsBox in boxes]==[prog]*3
+        shareGroup = shaders.getShareGroup()
+        assert len(shareGroup.compiledAttachments)==1
+        assert shareGroup.refCounts[('texture', 'moduloLUT')]==1
+        #deleted only when the last window is done with it
+        for bitsBox in boxes[:2]:
+            bitsBox.close()
+        assert GL.glIsProgram(prog)
+        boxes[2].close()
+        assert not GL.glIsProgram(prog)
+        assert len(shareGroup.compiledAttachments)==1 #still used by mono++
+        monoBox.close()
+        assert not shareGroup.objects and not shareGroup.compiledAttachments
+    finally:
+        closeContext()
+
+def _stimulusImage(size, kind, params):
+    """The CPU equivalent of a ProceduralStimulus (top row first)
+    """
+    import numpy
+    width, height = size
+    cx, cy = params.get('centre') or (width/2.0, height/2.0)
+    x = numpy.arange(width)[None,:]+0.5-cx
+    y = (height-1-numpy.arange(height))[:,None]+0.5-cy
+    def carrier(ori, sf, phase):
+        theta = numpy.radians(ori)
+        return numpy.sin(2*numpy.pi*(sf*(x*numpy.cos(theta)-y*numpy.sin(theta))+phase))
+    modulation = params['contrast']*carrier(params['ori'], params['sf'], params['phase'])
+    if kind=='gabor':
+        modulation *= numpy.exp(-(x**2+y**2)/(2.0*params['sigma']**2))
+    elif kind=='plaid':
+        modulation += params['contrast2']*carrier(params['ori2'], params['sf2'], params['phase2'])
+    return params['mean']*(1+modulation[...,None]*numpy.asarray(params['color']))
+
+def test_proceduralStimuli():
+    closeContext = headlessGL.getContext(256, 32)
+    from pycrsltd import bits, encode, decode, shaders
+    import numpy
+    try:
+        colorBox = bits.BitsBox(headlessGL.Win((256,32)), mode='color++')
+        for kind, params in [('gabor', dict(sf=0.05, ori=30, sigma=10.0, contrast=0.8, color=(1.0, 0.5, -0.5))),
+                             ('plaid', dict(sf=0.03, ori=0, ori2=90, sf2=0.1, contrast=0.4, contrast2=0.3))]:
+            stim = shaders.ProceduralStimulus(kind, **params)
+            for phase in [0.0, 0.25]:
+                stim.setParams(phase=phase)
+                colorBox.drawStimulus(stim)
+                expected = decode.colorPlusPlus(encode.colorPlusPlus(_stimulusImage((256,32), kind, stim.params)))
+                drawn = decode.colorPlusPlus(_readScreen(256, 32))
+                assert numpy.abs(drawn.astype(int)-expected).max()<=4
+        #mono++, with gamma correction (from the same program after the first frame)
+        monoBox = bits.BitsBox(headlessGL.Win((256,32)), mode='mono++', gamma=2.0)
+        stim = shaders.ProceduralStimulus('sine', sf=0.01, contrast=0.05, centre=(0,0))
+        monoBox.drawStimulus(stim)
+        prog = monoBox._stimulusPasses['sine'].program
+        stim.setParams(ori=45)
+        monoBox.drawStimulus(stim)
+        assert monoBox._stimulusPasses['sine'].program==prog
+        image = _stimulusImage((256,32), 'sine', stim.params)[...,0]
+        expected = decode.monoPlusPlus(encode.monoPlusPlus(image, encodingGamma=0.5))
+        assert numpy.abs(decode.monoPlusPlus(_readScreen(256, 32)).astype(int)-expected).max()<=4
+        colorBox.close()
+        monoBox.close()
+    finally:
+        closeContext()
+
+def test_sharedStimulusUniforms():
+    #two boxes drawing the same kind of stimulus share its program, but each
+    #draws its own parameters
+    closeContext = headlessGL.getContext(256, 32)
+    from pycrsltd import bits, encode, decode, shaders
+    import numpy
+    try:
+        boxA = bits.BitsBox(headlessGL.Win((256,32)), mode='color++')
+        boxB = bits.BitsBox(headlessGL.Win((256,32)), mode='color++')
+        stimA = shaders.ProceduralStimulus('gabor', sf=0.05, ori=30, sigma=10.0, contrast=0.8)
+        stimB = shaders.ProceduralStimulus('gabor', sf=0.1, ori=90, sigma=20.0, contrast=0.3)
+        for box, stim in [(boxA, stimA), (boxB, stimB), (boxA, stimA)]:
+            box.drawStimulus(stim)
+            expected = decode.colorPlusPlus(encode.colorPlusPlus(_stimulusImage((256,32), 'gabor', stim.params)))
+            drawn = decode.colorPlusPlus(_readScreen(256, 32))
+            assert numpy.abs(drawn.astype(int)-expected).max()<=4
+        assert boxA._stimulusPasses['gabor'].program==boxB._stimulusPasses['gabor'].program
+        boxA.close()
+        boxB.close()
+    finally:
+        closeContext()
+
+if __name__ == "__main__":
+    test_getProgram()
+    test_lazyBitsShaders()
+    test_shaderGammaUniforms()
+    test_sharedProgramUniforms()
+    test_gammaTable()
+    test_drawOutput()
+    test_moduloLUT()
+    test_shareGroups()
+    test_proceduralStimuli()
+    test_sharedStimulusUniforms()
+    print 'done'
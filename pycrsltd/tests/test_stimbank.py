@@ -0,0 +1,33 @@
+"""Tests for writing and (memory-mapped) reading of stimulus banks
+"""
+
+from pycrsltd import stimbank, encode
+import numpy
+import os, shutil, tempfile
+
+def test_writeAndRead():
+    tmpDir = tempfile.mkdtemp()
+    try:
+        filename = os.path.join(tmpDir, 'test.bank')
+        frames = numpy.random.random([5,6,8,3])
+        LUTs = encode.bitsPlusPlusLUT(numpy.random.random([5,256,3]))
+        stimbank.writeBank(filename, frames, 'color', LUTs=LUTs, info={'stim':'noise'})
+
+        bank = stimbank.StimulusBank(filename)
+        assert bank.mode=='color++'
+        assert len(bank)==5 and bank.frameShape==(6,8,3)
+        assert bank.info['stim']=='noise'
+        assert (bank.frames==encode.colorPlusPlus(frames)).all()
+        assert (bank.LUTs==LUTs).all()
+        #frames are read-only views of the file, not copies
+        assert not bank[2].flags.writeable
+        #stream (with read-ahead) part of the bank
+        streamed = [frameN for frameN, frame in bank.stream(startFrame=1, nFrames=3, readAhead=2)]
+        assert streamed==[1,2,3]
+        bank.close()
+    finally:
+        shutil.rmtree(tmpDir)
+
+if __name__ == "__main__":
+    test_writeAndRead()
+    print 'done'